@@ -0,0 +1,99 @@
+import os
+import sys
+import json
+import socket
+
+from configobj import ConfigObj
+
+
+def get_socket_path():
+    """
+    Get the path of the Unix socket used by the scenario worker daemon. This
+    can be set with 'socket' in the [system] section of the scenarios conf
+    file; the default is ~/.scenarios.sock.
+
+    Returns:
+        str: Path of the socket.
+
+    """
+    default = os.path.join(os.path.expanduser('~'), '.scenarios.sock')
+    conf_file = os.path.join(os.path.expanduser('~'), 'scenarios.conf')
+    if not os.path.isfile(conf_file):
+        return default
+    config = ConfigObj(conf_file)
+    if 'system' in config and 'socket' in config['system']:
+        return os.path.expanduser(config['system']['socket'])
+    return default
+
+
+def is_daemon_running(socket_path=None):
+    """
+    Check if a scenario worker daemon is accepting connections.
+
+    Args:
+        socket_path (str): Path of the socket; default from get_socket_path.
+
+    Returns:
+        bool: Is the daemon running?
+
+    """
+    if socket_path is None:
+        socket_path = get_socket_path()
+    if not os.path.exists(socket_path):
+        return False
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+    except OSError:
+        return False
+    finally:
+        sock.close()
+    return True
+
+
+def submit_job(job, socket_path=None, stream=None):
+    """
+    Submit a job to the scenario worker daemon and stream back its output.
+
+    A job is a dictionary with an 'mkinputdir' and/or an 'mkscenariogrids'
+    entry, each holding the keyword arguments of make_input_dirs and
+    make_scenario_grids, respectively. If both are given they are chained,
+    and if the 'mkscenariogrids' entry does not have an 'event', the grids
+    are made for every event written by mkinputdir. Relative paths are
+    interpreted relative to 'cwd', which defaults to the current directory.
+
+    Args:
+        job (dict): The job.
+        socket_path (str): Path of the socket; default from get_socket_path.
+        stream (file): Where to write the job output; default is stdout.
+
+    Returns:
+        bool: Did the job succeed?
+
+    """
+    if socket_path is None:
+        socket_path = get_socket_path()
+    if stream is None:
+        stream = sys.stdout
+    job = dict(job)
+    job.setdefault('cwd', os.getcwd())
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(socket_path)
+    status = False
+    try:
+        sock.sendall((json.dumps(job) + '\n').encode())
+        with sock.makefile('r') as f:
+            for line in f:
+                msg = json.loads(line)
+                if msg['type'] == 'output':
+                    stream.write(msg['text'])
+                    stream.flush()
+                elif msg['type'] == 'done':
+                    status = msg['status']
+                    if msg['error']:
+                        stream.write(msg['error'])
+                    break
+    finally:
+        sock.close()
+    return status
@@ -0,0 +1,125 @@
+import os
+import sys
+import json
+import warnings
+import traceback
+import socketserver
+
+from scenarios.grids import get_config
+from scenarios.grids import preload_gmpes
+from scenarios.grids import make_scenario_grids
+from scenarios.input_output import make_input_dirs
+from scenarios.vs30 import open_vs30_store
+from scenarios.client import get_socket_path
+from scenarios.client import is_daemon_running
+
+
+class _SocketWriter(object):
+    """
+    File-like object that sends whatever is written to it to the client as
+    'output' messages.
+    """
+
+    def __init__(self, wfile):
+        self._wfile = wfile
+
+    def write(self, text):
+        if text:
+            msg = {'type': 'output', 'text': text}
+            self._wfile.write((json.dumps(msg) + '\n').encode())
+            self._wfile.flush()
+        return len(text)
+
+    def flush(self):
+        self._wfile.flush()
+
+
+class _JobHandler(socketserver.StreamRequestHandler):
+    """
+    Run one job in the forked child of the daemon, with stdout and stderr
+    streamed back to the client.
+    """
+
+    def handle(self):
+        line = self.rfile.readline().decode()
+        if not line.strip():
+            # Connection check from is_daemon_running
+            return
+        job = json.loads(line)
+        writer = _SocketWriter(self.wfile)
+        sys.stdout = writer
+        sys.stderr = writer
+        try:
+            with warnings.catch_warnings():
+                warnings.simplefilter('always')
+                run_job(job)
+            status = True
+            error = ''
+        except Exception:
+            status = False
+            error = traceback.format_exc()
+        finally:
+            sys.stdout = sys.__stdout__
+            sys.stderr = sys.__stderr__
+        msg = {'type': 'done', 'status': status, 'error': error}
+        self.wfile.write((json.dumps(msg) + '\n').encode())
+        self.wfile.flush()
+
+
+class ScenarioServer(socketserver.ForkingMixIn, socketserver.UnixStreamServer):
+    """
+    Long-lived local scenario worker daemon. The imports, validated config,
+    GMPE sets, and Vs30 store (if configured) are loaded once when the daemon
+    starts; each job runs in a child that is forked from this warm process, so
+    jobs can run concurrently and a failing job cannot take down the daemon.
+    """
+
+    def __init__(self, socket_path=None, verbose=False):
+        if socket_path is None:
+            socket_path = get_socket_path()
+        if os.path.exists(socket_path):
+            if is_daemon_running(socket_path):
+                raise Exception('A scenario daemon is already running on %s.'
+                                % socket_path)
+            os.remove(socket_path)
+        self.socket_path = socket_path
+
+        self.config = get_config()
+        preload_gmpes(self.config, verbose=verbose)
+        if self.config['data'].get('vs30store', ''):
+            # Opened once so that the forked children inherit its memory maps
+            open_vs30_store(self.config['data']['vs30store'])
+
+        socketserver.UnixStreamServer.__init__(self, socket_path, _JobHandler)
+
+    def server_close(self):
+        socketserver.UnixStreamServer.server_close(self)
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+
+def run_job(job):
+    """
+    Run a job in this process; see submit_job for the job format.
+
+    Args:
+        job (dict): The job.
+
+    Returns:
+        list: Ids of the events for which grids were made.
+
+    """
+    if 'cwd' in job:
+        os.chdir(job['cwd'])
+
+    ids = []
+    if 'mkinputdir' in job:
+        ids = make_input_dirs(**job['mkinputdir'])
+
+    if 'mkscenariogrids' in job:
+        kwargs = dict(job['mkscenariogrids'])
+        if 'event' in kwargs:
+            ids = [kwargs.pop('event')]
+        for event in ids:
+            make_scenario_grids(event, **kwargs)
+    return ids
@@ -0,0 +1,233 @@
+import os
+import glob
+import shutil
+import hashlib
+
+import numpy as np
+
+from openquake.hazardlib.gsim.base import DistancesContext
+
+from shakelib.distance import Distance
+from shakelib.rupture.edge_rupture import EdgeRupture
+from shakelib.rupture.quad_rupture import QuadRupture
+
+# Distances that only depend on the rupture geometry and the site mesh, and
+# so are the same for all of the hypocenters (directivity realizations) of a
+# rupture.
+GEOMETRY_DISTANCES = ('rrup', 'rjb', 'rx', 'ry0')
+
+# Distances that depend on the hypocenter, and the name of the rupture method
+# that computes them.
+HYPO_DISTANCES = {'rhypo': 'computeRhyp',
+                  'repi': 'computeRepi'}
+
+# Distances that Distance computes for every GMPE, and that the grid
+# calculations use directly (e.g., rrup for the GMICE).
+BASE_DISTANCES = ('rrup', 'rjb', 'rhypo', 'repi')
+
+
+def get_family_id(id_str):
+    """
+    Get the id of the rupture family that an event belongs to. All of the
+    directivity realizations of a rupture (e.g., 'name_m7p02_se~dir0' and
+    'name_m7p02_se~dir2') share the same family id.
+
+    Args:
+        id_str (str): Event id.
+
+    Returns:
+        str: Family id.
+
+    """
+    return id_str.split('~')[0]
+
+
+def get_geometry_key(rupt, lon, lat, dep):
+    """
+    Compute a key that identifies the rupture geometry and site mesh used
+    for a set of geometry-only distances.
+
+    Args:
+        rupt (Rupture): A ShakeMap Rupture instance.
+        lon (array): Longitudes of the site mesh.
+        lat (array): Latitudes of the site mesh.
+        dep (array): Depths of the site mesh.
+
+    Returns:
+        str: Hex digest of the key.
+
+    """
+    sha = hashlib.sha1()
+    for arr in (rupt.lons, rupt.lats, rupt.depths, lon, lat, dep):
+        arr = np.ascontiguousarray(arr, dtype=float)
+        sha.update(str(arr.shape).encode())
+        sha.update(arr.tobytes())
+    # Only an EdgeRupture has a mesh spacing of its own; the distance code
+    # sets one on other ruptures when it computes their distances
+    if isinstance(rupt, EdgeRupture):
+        sha.update(repr(float(rupt._mesh_dx)).encode())
+    return sha.hexdigest()
+
+
+def read_distance_cache(cache_dir, key, mmap_mode=None):
+    """
+    Read geometry-only distances from a cache directory. Each site mesh
+    (e.g., each tile of a grid) is stored in a subdirectory named by its key.
+
+    Args:
+        cache_dir (str): Path of the cache directory.
+        key (str): Geometry key (see get_geometry_key).
+        mmap_mode (str): Optional mode for memory-mapping the distance
+            arrays; passed to numpy.load.
+
+    Returns:
+        dict: Distance arrays keyed by distance name, or None if the
+        cache does not have an entry for the key.
+
+    """
+    key_dir = os.path.join(cache_dir, key)
+    if not os.path.isdir(key_dir):
+        return None
+
+    dists = {}
+    for name in GEOMETRY_DISTANCES:
+        dfile = os.path.join(key_dir, name + '.npy')
+        if os.path.isfile(dfile):
+            dists[name] = np.load(dfile, mmap_mode=mmap_mode)
+    return dists
+
+
+def write_distance_cache(cache_dir, key, dists):
+    """
+    Write geometry-only distances to a cache directory. The files are
+    written to a temporary directory first so that other realizations of the
+    rupture never read a partially written cache entry.
+
+    Args:
+        cache_dir (str): Path of the cache directory.
+        key (str): Geometry key (see get_geometry_key).
+        dists (dict): Distance arrays keyed by distance name; only the
+            names in GEOMETRY_DISTANCES are written.
+
+    """
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir, exist_ok=True)
+    key_dir = os.path.join(cache_dir, key)
+    tmp_dir = '%s.tmp%i' % (key_dir, os.getpid())
+    if os.path.isdir(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.mkdir(tmp_dir)
+    for name in GEOMETRY_DISTANCES:
+        if name in dists:
+            np.save(os.path.join(tmp_dir, name + '.npy'), dists[name])
+
+    if os.path.isdir(key_dir):
+        shutil.rmtree(key_dir)
+    os.rename(tmp_dir, key_dir)
+
+
+def prune_distance_cache(cache_dir, keys):
+    """
+    Remove the entries of a distance cache that are not in keys (e.g., those
+    written for an earlier grid or rupture geometry of the event), along with
+    any temporary directories left by interrupted writes.
+
+    Args:
+        cache_dir (str): Path of the cache directory.
+        keys (list): Geometry keys to keep (see get_geometry_key).
+
+    """
+    if not os.path.isdir(cache_dir):
+        return
+    keys = set(keys)
+    for name in os.listdir(cache_dir):
+        if name in keys:
+            continue
+        path = os.path.join(cache_dir, name)
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            os.remove(path)
+
+
+def find_distance_cache(datdir, id_str, key, mmap_mode=None):
+    """
+    Look for geometry-only distances computed for any event in the same
+    rupture family, starting with the event itself.
+
+    Args:
+        datdir (str): Path of the ShakeMap data directory.
+        id_str (str): Event id.
+        key (str): Geometry key (see get_geometry_key).
+        mmap_mode (str): Optional mode for memory-mapping the distance
+            arrays; passed to numpy.load.
+
+    Returns:
+        dict: Distance arrays keyed by distance name, or None if no
+        matching cache was found.
+
+    """
+    family = get_family_id(id_str)
+    evt_dirs = [os.path.join(datdir, id_str)]
+    for evt_dir in sorted(glob.glob(os.path.join(
+            datdir, glob.escape(family) + '*'))):
+        if evt_dir not in evt_dirs and \
+           get_family_id(os.path.basename(evt_dir)) == family:
+            evt_dirs.append(evt_dir)
+
+    for evt_dir in evt_dirs:
+        cache_dir = os.path.join(evt_dir, 'input', 'distances')
+        dists = read_distance_cache(cache_dir, key, mmap_mode=mmap_mode)
+        if dists is not None:
+            return dists
+    return None
+
+
+def get_distance_context(gmpe, lon, lat, dep, rupt, datdir=None,
+                         id_str=None):
+    """
+    Compute the distance context for a site mesh. If datdir and id_str are
+    given, the geometry-only distances are shared across the rupture family
+    (i.e., the directivity realizations of a rupture): they are read from the
+    distance cache of any event in the family if one matches, otherwise they
+    are computed and written to the cache in this event's input directory.
+    Only the hypocentral distances are recomputed for each realization.
+
+    Args:
+        gmpe (MultiGMPE): A MultiGMPE or OQ GMPE instance.
+        lon (array): Longitudes of the site mesh.
+        lat (array): Latitudes of the site mesh.
+        dep (array): Depths of the site mesh.
+        rupt (Rupture): A ShakeMap Rupture instance.
+        datdir (str): Path of the ShakeMap data directory (optional).
+        id_str (str): Event id (optional).
+
+    Returns:
+        DistancesContext: The distance context.
+
+    """
+    if datdir is None or id_str is None or \
+       not isinstance(rupt, (QuadRupture, EdgeRupture)):
+        return Distance(gmpe, lon, lat, dep, rupt).getDistanceContext()
+
+    requires = set(gmpe.REQUIRES_DISTANCES) | set(BASE_DISTANCES)
+    key = get_geometry_key(rupt, lon, lat, dep)
+    dists = find_distance_cache(datdir, id_str, key)
+
+    if dists is not None and \
+       requires.issubset(set(dists.keys()) | set(HYPO_DISTANCES.keys())):
+        dx = DistancesContext()
+        for name in requires:
+            if name in dists:
+                setattr(dx, name, dists[name])
+            else:
+                method = getattr(rupt, HYPO_DISTANCES[name])
+                setattr(dx, name, method(lon, lat, dep))
+        return dx
+
+    dx = Distance(gmpe, lon, lat, dep, rupt).getDistanceContext()
+    dists = {name: getattr(dx, name) for name in GEOMETRY_DISTANCES
+             if getattr(dx, name, None) is not None}
+    write_distance_cache(
+        os.path.join(datdir, id_str, 'input', 'distances'), key, dists)
+    return dx
@@ -0,0 +1,57 @@
+import json
+import hashlib
+
+from shakelib.multigmpe import MultiGMPE
+
+# MultiGMPE instances keyed by (GMPE config key, filter IMT); see
+# get_gmpe_key. This lives for the whole process so that runs over many
+# events reuse the same instances.
+_gmpe_cache = {}
+
+
+def get_gmpe_key(config):
+    """
+    Compute a key that identifies the GMPE configuration: the name of the
+    GMPE set, and the gmpe_sets and gmpe_modules sections that
+    MultiGMPE.from_config builds it from. Editing gmpe_sets.conf or
+    modules.conf changes the key.
+
+    Args:
+        config (dict): Validated scenarios config.
+
+    Returns:
+        str: Hex digest of the key.
+
+    """
+    text = json.dumps([config['modeling']['gmpe'],
+                       config['gmpe_sets'],
+                       config['gmpe_modules']], sort_keys=True, default=str)
+    return hashlib.sha1(text.encode()).hexdigest()
+
+
+def get_multigmpe(config, filter_imt=None, verbose=False):
+    """
+    Get the MultiGMPE for the GMPE set in the config, building it with
+    MultiGMPE.from_config only the first time that it is requested for a
+    given filter IMT.
+
+    Args:
+        config (dict): Validated scenarios config, including the gmpe_sets
+            and gmpe_modules sections.
+        filter_imt (IMT): Optional OQ IMT instance; GMPEs that cannot be
+            evaluated for this IMT are filtered out.
+        verbose (bool): Print info when the MultiGMPE is built?
+
+    Returns:
+        MultiGMPE: The MultiGMPE instance.
+
+    """
+    if filter_imt is None:
+        key = (get_gmpe_key(config), None)
+    else:
+        key = (get_gmpe_key(config), str(filter_imt))
+
+    if key not in _gmpe_cache:
+        _gmpe_cache[key] = MultiGMPE.from_config(
+            config, filter_imt=filter_imt, verbose=verbose)
+    return _gmpe_cache[key]
@@ -0,0 +1,903 @@
+import os
+import copy
+import glob
+import multiprocessing
+import warnings
+import pkg_resources
+
+import numpy as np
+from collections import OrderedDict
+from configobj import ConfigObj
+
+from shakemap.utils.config import get_custom_validator
+from shakemap.utils.config import config_error
+
+#-------------------------------------------------------------------------------
+# Openquake utilities
+from openquake.hazardlib import imt, const
+
+from mapio.geodict import GeoDict
+from mapio.gmt import GMTGrid
+from mapio.shake import ShakeGrid
+
+# Shakemap imports
+from shakelib.rupture.point_rupture import PointRupture
+from shakelib.rupture.factory import get_rupture
+from shakelib.rupture.origin import Origin
+from shakelib.sites import Sites
+from shakelib.directivity.rowshandel2013 import Rowshandel2013
+from datetime import datetime
+from shakelib.gmice.wgrw12 import WGRW12
+
+from scenarios.utils import get_extent
+from scenarios.distance import get_distance_context
+from scenarios.distance import get_geometry_key
+from scenarios.distance import prune_distance_cache
+from scenarios.gmpe import get_multigmpe
+from scenarios.manifest import get_run_params
+from scenarios.manifest import make_manifest
+from scenarios.manifest import write_manifest
+from scenarios.manifest import remove_manifest
+from scenarios.vs30 import load_vs30_grid
+from scenarios.vs30 import get_geodict_values
+from scenarios.vs30 import get_window_geodict
+
+
+# Mapping between the IM notation in ShakeMap and the
+# OpenQuake notation for the IMs taht we want
+IMT_DICT = {'pga': 'PGA', 'pgv': 'PGV', 'psa03': 'SA(0.3)',
+            'psa10': 'SA(1.0)', 'psa30': 'SA(3.0)'}
+
+# Number of cells of each tile used to check the error of the rock fast path
+# (see evaluate_rock)
+ROCK_NSAMPLE = 100
+
+# Validated config, cached with the modification times of the scenarios conf
+# file and of the GMPE sets and modules, so that it is only re-read and
+# re-validated when one of them changes.
+_config_cache = {}
+
+
+def get_config():
+    """
+    Read the scenarios conf file in the user home directory, merge in the
+    GMPE sets and modules, and validate it. The result is cached for the
+    process until the conf file or the GMPE sets or modules are modified.
+
+    Returns:
+        dict: Validated config.
+
+    """
+    conf_file = os.path.join(os.path.expanduser('~'), 'scenarios.conf')
+    set_file = pkg_resources.resource_filename(
+        'scenarios', os.path.join('..', 'data', 'gmpe_sets.conf'))
+    module_file = pkg_resources.resource_filename(
+        'scenarios', os.path.join('..', 'data', 'modules.conf'))
+    key = tuple((f, os.path.getmtime(f))
+                for f in [conf_file, set_file, module_file])
+    if key in _config_cache:
+        return copy.deepcopy(_config_cache[key])
+
+    spec_file = pkg_resources.resource_filename(
+        'scenarios', os.path.join('data', 'configspec.conf'))
+    validator = get_custom_validator()
+    config = ConfigObj(conf_file, configspec=spec_file)
+
+    config.merge(ConfigObj(set_file, configspec=spec_file))
+    config.merge(ConfigObj(module_file, configspec=spec_file))
+    results = config.validate(validator)
+    if results != True:
+        config_error(config, results)
+
+    _config_cache.clear()
+    _config_cache[key] = config.dict()
+    return copy.deepcopy(_config_cache[key])
+
+
+def preload_gmpes(config, verbose=False):
+    """
+    Build the unfiltered and per-IMT MultiGMPEs for the configured GMPE set
+    so that they are cached, e.g., before forking worker processes that
+    should inherit them.
+
+    Args:
+        config (dict): Validated config (see get_config).
+        verbose (bool): Print info when the MultiGMPEs are built?
+
+    """
+    get_multigmpe(config, verbose=verbose)
+    for val in IMT_DICT.values():
+        get_multigmpe(config, filter_imt=imt.from_string(val),
+                      verbose=verbose)
+
+
+def str2bool(v):
+    return v.lower() in ("yes", "true", "t", "1")
+
+
+def get_tiles(ny, nx, tile_size=None):
+    """
+    Split the rows of a grid into bands (tiles) that each have at most
+    tile_size cells, but always at least one row.
+
+    Args:
+        ny (int): Number of rows in the grid.
+        nx (int): Number of columns in the grid.
+        tile_size (int): Maximum number of cells per tile; if None or not
+            positive, the whole grid is a single tile.
+
+    Returns:
+        list: List of slices of rows.
+
+    """
+    ny = int(ny)
+    nx = int(nx)
+    if tile_size is None or tile_size <= 0:
+        return [slice(0, ny)]
+    nrows = max(1, int(tile_size // nx))
+    return [slice(i, min(i + nrows, ny)) for i in range(0, ny, nrows)]
+
+
+def subset_context(ctx, index, shape):
+    """
+    Make a shallow copy of an OQ context with every array attribute that
+    covers the grid indexed by index.
+
+    Args:
+        ctx (BaseContext): OQ context (e.g., SitesContext).
+        index (slice, tuple, array): Index into the grid arrays.
+        shape (tuple): Shape of the grid.
+
+    Returns:
+        BaseContext: The subset context.
+
+    """
+    new = copy.copy(ctx)
+    for name, val in vars(ctx).items():
+        if isinstance(val, np.ndarray) and val.shape == shape:
+            setattr(new, name, val[index])
+    return new
+
+
+def get_tile_sites(vs30grid, rows):
+    """
+    Make the sites contexts of a band of rows of the ShakeMap grid from the
+    Vs30 of those rows, so that the site parameters of the whole grid are
+    never built at once.
+
+    Args:
+        vs30grid (Grid2D): Vs30 grid of the ShakeMap grid.
+        rows (slice): Rows of the grid.
+
+    Returns:
+        tuple: The sites context with the Vs30 of the grid (clipped to
+        2000 m/s), and the sites context for rock (760 m/s).
+
+    """
+    gdict = get_geodict_values(vs30grid.getGeoDict())
+    tdict = get_window_geodict(gdict, rows, slice(0, gdict['nx']))
+    sites = Sites(GMTGrid(vs30grid.getData()[rows], tdict))
+    sx = sites.getSitesContext()
+    sx_rock = sites.getSitesContext(rock_vs30=760)
+
+    # Clip Vs30 do avoid interpolation error
+    sx.vs30 = np.clip(sx.vs30, 0, 2000)
+    return sx, sx_rock
+
+
+def get_coarse_nodes(n, factor):
+    """
+    Get the indices of every factor-th row (or column) of a grid, always
+    including the last one.
+
+    Args:
+        n (int): Number of rows (or columns).
+        factor (int): Spacing of the nodes.
+
+    Returns:
+        array: Sorted indices of the nodes.
+
+    """
+    nodes = np.arange(0, n, factor)
+    if nodes[-1] != n - 1:
+        nodes = np.append(nodes, n - 1)
+    return nodes
+
+
+def _get_interp_weights(nodes, n):
+    """
+    Get the indices of the lower nodes and the weights of the upper nodes for
+    linear interpolation from nodes to every index in range(n).
+    """
+    if len(nodes) == 1:
+        return np.zeros(n, dtype=int), np.zeros(n)
+    x = np.arange(n)
+    j = np.clip(np.searchsorted(nodes, x, side='right') - 1,
+                0, len(nodes) - 2)
+    w = (x - nodes[j]) / (nodes[j + 1] - nodes[j])
+    return j, w
+
+
+def bilinear_upsample(coarse, rnodes, cnodes, shape):
+    """
+    Bilinearly interpolate values at the nodes of a sub-grid to the full
+    grid. The interpolation is in row and column index, and the values at
+    the nodes are preserved.
+
+    Args:
+        coarse (array): Values at the nodes, with shape
+            (len(rnodes), len(cnodes)).
+        rnodes (array): Rows of the nodes (see get_coarse_nodes).
+        cnodes (array): Columns of the nodes (see get_coarse_nodes).
+        shape (tuple): Shape of the full grid.
+
+    Returns:
+        array: Values on the full grid.
+
+    """
+    jr, wr = _get_interp_weights(rnodes, shape[0])
+    jc, wc = _get_interp_weights(cnodes, shape[1])
+    jr1 = np.minimum(jr + 1, len(rnodes) - 1)
+    jc1 = np.minimum(jc + 1, len(cnodes) - 1)
+    tmp = coarse[:, jc] * (1 - wc) + coarse[:, jc1] * wc
+    return tmp[jr] * (1 - wr)[:, None] + tmp[jr1] * wr[:, None]
+
+
+def evaluate_rock(gmpe, sx_rock, rx, dx, iimt, stddev_types, rock):
+    """
+    Evaluate the GMPE for rock sites on a tile with the rock fast path. The
+    mean and standard deviation are evaluated on a coarse sub-grid (every
+    rock['factor']-th row and column) and bilinearly interpolated to the
+    tile, except for the cells within rock['rrup'] km of the rupture, which
+    are evaluated directly. The interpolation is checked against direct
+    evaluation on up to rock['nsample'] other cells; if the error in the ln
+    mean or standard deviation exceeds rock['tol'], a warning is issued and
+    the whole tile is evaluated directly.
+
+    Args:
+        gmpe (MultiGMPE): The GMPE.
+        sx_rock (SitesContext): Rock sites context of the tile.
+        rx (RuptureContext): Rupture context.
+        dx (DistancesContext): Distances context of the tile.
+        iimt (IMT): The intensity measure type.
+        stddev_types (list): Standard deviation types.
+        rock (dict): Options of the rock fast path: 'factor', 'rrup',
+            'tol', and 'nsample'.
+
+    Returns:
+        tuple: The ln mean and a list with the standard deviation, as from
+        the GMPE's get_mean_and_stddevs.
+
+    """
+    shape = dx.rrup.shape
+    rnodes = get_coarse_nodes(shape[0], rock['factor'])
+    cnodes = get_coarse_nodes(shape[1], rock['factor'])
+    index = np.ix_(rnodes, cnodes)
+    lnmu_c, lnsd_c = gmpe.get_mean_and_stddevs(
+        subset_context(sx_rock, index, shape), rx,
+        subset_context(dx, index, shape), iimt, stddev_types)
+    lnmu = bilinear_upsample(lnmu_c, rnodes, cnodes, shape)
+    lnsd = bilinear_upsample(lnsd_c[0], rnodes, cnodes, shape)
+
+    # Cells near the rupture, and a sample of the other interpolated cells
+    # for the error check, are evaluated directly
+    near = dx.rrup < rock['rrup']
+    node = np.zeros(shape, dtype=bool)
+    node[index] = True
+    other = np.where(~(near | node).ravel())[0]
+    nsample = min(rock['nsample'], len(other))
+    sample = np.zeros(shape, dtype=bool)
+    if nsample > 0:
+        pick = np.round(np.linspace(0, len(other) - 1, nsample)).astype(int)
+        sample.ravel()[other[pick]] = True
+    direct = near | sample
+    if np.any(direct):
+        lnmu_d, lnsd_d = gmpe.get_mean_and_stddevs(
+            subset_context(sx_rock, direct, shape), rx,
+            subset_context(dx, direct, shape), iimt, stddev_types)
+        err = max(np.max(np.abs(lnmu[sample] - lnmu_d[sample[direct]]),
+                         initial=0.0),
+                  np.max(np.abs(lnsd[sample] - lnsd_d[0][sample[direct]]),
+                         initial=0.0))
+        if err > rock['tol']:
+            warnings.warn(
+                'Rock fast path error of %.3g for %s exceeds the tolerance '
+                'of %.3g; evaluating the full tile.' % (err, iimt,
+                                                        rock['tol']))
+            return gmpe.get_mean_and_stddevs(
+                sx_rock, rx, dx, iimt, stddev_types)
+        lnmu[direct] = lnmu_d
+        lnsd[direct] = lnsd_d[0]
+    return lnmu, [lnsd]
+
+
+def read_event_rupture(input_dir, origin, verbose=False):
+    """
+    Read the rupture of an event from its input directory.
+
+    Args:
+        input_dir (str): Path of the event input directory.
+        origin (Origin): The origin of the event.
+        verbose (bool): Print the rupture file?
+
+    Returns:
+        Rupture: The rupture; a PointRupture if there isn't a rupture file.
+
+    """
+    ruptfiles = sorted(glob.glob(os.path.join(input_dir, '*rupture.json')))
+    if len(ruptfiles) == 0:
+        ruptfiles = sorted(glob.glob(os.path.join(input_dir, '*_fault.txt')))
+
+    if len(ruptfiles) > 0:
+        # There is a rupture
+        ruptfile = ruptfiles[0]
+        if verbose is True:
+            print('Rupture file: %s\n' % ruptfile)
+        return get_rupture(origin, ruptfile)
+    return PointRupture(origin)
+
+
+def get_grid_geodict(origin, rupt, res=30 / 60 / 60, nmax=500000,
+                     extent=None):
+    """
+    Compute the geodictionary of the ShakeMap grid of an event. The
+    resolution is adjusted if the grid would have more than nmax cells.
+
+    Args:
+        origin (Origin): The origin of the event.
+        rupt (Rupture): The rupture of the event.
+        res (float): The resolution in decimal degrees.
+        nmax (int): Maximum number of cells allowed.
+        extent (list): Optional extent: lonmin, latmin, lonmax, latmax;
+            default is from get_extent.
+
+    Returns:
+        GeoDict: The geodictionary.
+
+    """
+    if extent is None:
+        lonmin, lonmax, latmin, latmax = get_extent(origin, rupt)
+    else:
+        lonmin, latmin, lonmax, latmax = extent
+
+    # Adjust extent to be divisible by resolution
+    lonmin = res * np.round(lonmin / res)
+    lonmax = res * np.round(lonmax / res)
+    latmin = res * np.round(latmin / res)
+    latmax = res * np.round(latmax / res)
+
+    lonspan = float(lonmax - lonmin)
+    latspan = float(latmax - latmin)
+
+    # Adjust number of cells if necessary
+    nx = np.floor(lonspan / res) + 1
+    ny = np.floor(latspan / res) + 1
+    ncell = nx * ny
+    if ncell > nmax:
+        res = (-(latspan + lonspan) -
+               np.sqrt(latspan**2 + lonspan**2 + 2 * latspan * lonspan *
+                       (2 * nmax - 1))) / (2 * (1 - nmax))
+        warnings.warn(
+            'resolution adjusted due to max number of cells allowed.')
+        nx = np.floor(lonspan / res) + 1
+        ny = np.floor(latspan / res) + 1
+        ncell = nx * ny
+
+    tmpdict = {'xmin': lonmin, 'xmax': lonmax,
+               'ymin': latmin, 'ymax': latmax,
+               'dx': res, 'dy': res,
+               'nx': nx, 'ny': ny}
+    return GeoDict(tmpdict, adjust='bounds')
+
+
+def get_event_grid(event, res=30 / 60 / 60, nmax=500000, extent=None):
+    """
+    Read the rupture of an event from its input directory and compute the
+    geodictionary of its ShakeMap grid (see get_grid_geodict).
+
+    Args:
+        event (str): Id of the event.
+        res (float): The resolution in decimal degrees.
+        nmax (int): Maximum number of cells allowed.
+        extent (list): Optional extent: lonmin, latmin, lonmax, latmax.
+
+    Returns:
+        tuple: The rupture and the geodictionary.
+
+    """
+    config = get_config()
+    input_dir = os.path.join(
+        config['system']['shakehome'], 'data', event, 'input')
+    origin = Origin.fromFile(os.path.join(input_dir, 'event.xml'))
+    rupt = read_event_rupture(input_dir, origin)
+    sampledict = get_grid_geodict(origin, rupt, res=res, nmax=nmax,
+                                  extent=extent)
+    return rupt, sampledict
+
+
+# Event state for the worker processes of an intra-event pool. It is set
+# before the pool is created so that the forked workers inherit it rather
+# than having it pickled for every tile.
+_pool_state = None
+
+
+def _evaluate_pool_tile(rows):
+    return evaluate_tile(rows, _pool_state)
+
+
+def evaluate_tile(rows, state):
+    """
+    Evaluate the distances, GMPEs, directivity, and MMI for a band of rows of
+    the ShakeMap grid.
+
+    Args:
+        rows (slice): Rows of the grid to evaluate.
+        state (dict): The event state that is shared by all of the tiles; see
+            main().
+
+    Returns:
+        dict: Results for the tile. For each IMT key there is a dictionary
+        with 'mean', 'sigma', 'mean_rock', and 'sigma_rock'; there are also
+        'mmi', 'mmi_sd', and (if directivity is applied) 'fd1' and 'fd3'.
+
+    """
+    config = state['config']
+    rupt = state['rupt']
+    rx = state['rx']
+    stddev_types = state['stddev_types']
+    verbose = state['verbose']
+
+    lon, lat = np.meshgrid(state['lons'], state['lats'][rows])
+    dep = np.zeros_like(lon)
+    sx, sx_rock = get_tile_sites(state['vs30grid'], rows)
+
+    if verbose is True:
+        print('Tile: rows %i to %i' % (rows.start, rows.stop - 1))
+
+    # Compute distances on mesh
+    gmpe = get_multigmpe(config)
+    dx = get_distance_context(gmpe, lon, lat, dep, rupt,
+                              datdir=state.get('datdir'),
+                              id_str=state.get('id_str'))
+
+    if verbose is True:
+        print('Distance context:')
+        print('Min Rrup: %s' % np.min(dx.rrup))
+        print('Max Rrup: %s\n' % np.max(dx.rrup))
+
+    tile = {}
+
+    #---------------------------------------------------------------------------
+    # Directivity
+    #---------------------------------------------------------------------------
+    dirbool = state['dirbool']
+    if dirbool is True:
+        R13 = Rowshandel2013(
+            state['origin'], rupt, lat, lon, dep, dx=1.0, T=[1.0, 3.0],
+            a_weight=0.5, mtype=1)
+        fd1 = R13.getFd()[0]
+        fd3 = R13.getFd()[1]
+        tile['fd1'] = fd1
+        tile['fd3'] = fd3
+
+    #---------------------------------------------------------------------------
+    # Evaluate GMPEs
+    #---------------------------------------------------------------------------
+    for key, val in state['imt_dict'].items():
+        iimt = imt.from_string(val)
+        if verbose is True:
+            print("IMT: %s" % val)
+
+        #-----------------------------------------------------------------------
+        # Get the MultiGMPE, but specifcy the IMT so that it filters out
+        # GMPEs that cannot be evaluated at this IMT; these are cached for
+        # the whole process.
+        #-----------------------------------------------------------------------
+        gmpe = get_multigmpe(config, filter_imt=iimt, verbose=verbose)
+        lnmu, lnsd = gmpe.get_mean_and_stddevs(
+            sx, rx, dx, iimt, stddev_types)
+        if state.get('rock') is not None:
+            lnmu_rock, lnsd_rock = evaluate_rock(
+                gmpe, sx_rock, rx, dx, iimt, stddev_types, state['rock'])
+        else:
+            lnmu_rock, lnsd_rock = gmpe.get_mean_and_stddevs(
+                sx_rock, rx, dx, iimt, stddev_types)
+
+        #-----------------------------------------------------------------------
+        # Handle directivity factors
+        # NOTE: currently, the Rowshandel model does not provide
+        #       equations for adjusting sigma. Asssuming these are
+        #       eventually available, need to move the sigma
+        #       adjustment into this if-statement.
+        #-----------------------------------------------------------------------
+        if dirbool is True:
+            if (key == 'pgv') | (key == 'psa10'):
+                fd = fd1
+            elif (key == 'psa30'):
+                fd = fd3
+            else:
+                # no directivity for pga and psa03
+                fd = 0
+
+            lnmu = lnmu + fd
+            lnmu_rock = lnmu_rock + fd
+
+        tile[key] = {'mean': lnmu,
+                     'sigma': lnsd[0],
+                     'mean_rock': lnmu_rock,
+                     'sigma_rock': lnsd_rock[0]}
+
+    #---------------------------------------------------------------------------
+    # MMI - Convert the PGV field (including directivity) with the GMICE
+    # rather than re-evaluating the PGV GMPEs through VirtualIPE
+    #---------------------------------------------------------------------------
+    gmice = WGRW12()
+    mmi, dmda = gmice.getMIfromGM(tile['pgv']['mean'], imt.PGV(),
+                                  dists=dx.rrup, mag=rx.mag)
+    gm2mi_var = gmice.getGM2MIsd()[imt.PGV()]**2
+    tile['mmi'] = mmi
+    tile['mmi_sd'] = np.sqrt(tile['pgv']['sigma']**2 * dmda**2 + gm2mi_var)
+
+    return tile
+
+
+def make_scenario_grids(event, res=30 / 60 / 60, nmax=500000, mesh_dx=0.5,
+                        extent=None, tile_size=None, nproc=1, family=False,
+                        rock_coarse=None, rock_rrup=20.0, rock_tol=0.05,
+                        verbose=False):
+    """
+    Create the ShakeMap *_estimates.grd and *_sd.grd files, the MMI grids,
+    and rock_grid.xml for an event. Requires an input directory with
+    event.xml and rupture files; the inputs should be created by the
+    'mkinputdir' script or similar. When all of the files are written, a
+    manifest of the outputs is written to input/manifest.json (see
+    scenarios.manifest).
+
+    Args:
+        event (str): Id of the event to process.
+        res (float): The resolution in decimal degrees.
+        nmax (int): Maximum number of cells allowed; resolution is adjusted
+            to ensure this number is not exceeded.
+        mesh_dx (float): The resolution for rupture mesh in km; only used
+            for EdgeRuptures.
+        extent (list): Optional extent: lonmin, latmin, lonmax, latmax.
+        tile_size (int): Maximum number of cells evaluated at once; None
+            evaluates the whole grid at once.
+        nproc (int): Number of processors used to evaluate the tiles; a
+            daemonic process (e.g., a multiprocessing.Pool worker) always
+            uses one.
+        family (bool): Share the geometry-only distances across the
+            directivity realizations of the same rupture?
+        rock_coarse (int): If given, the rock fields (for rock_grid.xml) are
+            evaluated on a sub-grid of every rock_coarse-th row and column
+            and interpolated (see evaluate_rock).
+        rock_rrup (float): Distance (km) within which the rock fields are
+            always evaluated directly.
+        rock_tol (float): Maximum error of the interpolated rock fields (ln
+            units) in the sample cells; tiles that exceed it are evaluated
+            directly.
+        verbose (bool): Print verbose output?
+
+    """
+    global _pool_state
+    id_str = event
+
+    config = get_config()
+
+    shakehome = config['system']['shakehome']
+
+    datdir = os.path.join(shakehome, 'data')
+    evt_dir = os.path.join(datdir, id_str)
+    input_dir = os.path.join(evt_dir, 'input')
+    xml_file = os.path.join(input_dir, 'event.xml')
+
+    # Any existing manifest is stale as soon as we start overwriting outputs
+    params = get_run_params(res, nmax, mesh_dx, extent, rock_coarse,
+                            rock_rrup, rock_tol)
+    remove_manifest(input_dir)
+    outputs = []
+
+    #---------------------------------------------------------------------------
+    # Read in event.xml and create Origin object
+    #---------------------------------------------------------------------------
+    origin = Origin.fromFile(xml_file)
+
+    #---------------------------------------------------------------------------
+    # Read in rupture
+    #---------------------------------------------------------------------------
+    rupt = read_event_rupture(input_dir, origin, verbose=verbose)
+
+    # Set the dx for the rupture meshing
+    rupt._mesh_dx = mesh_dx
+
+    #---------------------------------------------------------------------------
+    # Construct the MultiGMPE, not specific/filtered to an IMT
+    #---------------------------------------------------------------------------
+    gmpe = get_multigmpe(config, verbose=verbose)
+
+    #---------------------------------------------------------------------------
+    # Geodictionary for this ShakeMap, from the extent of the event or the
+    # given extent
+    #---------------------------------------------------------------------------
+    smdict = get_grid_geodict(origin, rupt, res=res, nmax=nmax, extent=extent)
+
+    if verbose is True:
+        print('Geodictionary:')
+        print(smdict)
+        print('')
+
+    #---------------------------------------------------------------------------
+    # Make rupture context
+    #---------------------------------------------------------------------------
+    rx = rupt.getRuptureContext(gmpe)
+
+    if verbose is True:
+        print('Rupture context:')
+        print('Mag: %s' % rx.mag)
+        print('Hyp lat: %s' % rx.hypo_lat)
+        print('Hyp lon: %s' % rx.hypo_lon)
+        print('Hyp dep: %s\n' % rx.hypo_depth)
+
+    #---------------------------------------------------------------------------
+    # Vs30 stuff
+    #---------------------------------------------------------------------------
+    # The sites contexts are made for each tile from its rows of the grid
+    # (see get_tile_sites)
+    vs30grid = load_vs30_grid(config, smdict)
+
+    if verbose is True:
+        vs30 = vs30grid.getData()
+        print('Vs30 grid:')
+        print('Lons: %s to %s' % (smdict.xmin, smdict.xmax))
+        print('Lats: %s to %s' % (smdict.ymin, smdict.ymax))
+        print('Min Vs30: %s' % np.clip(np.min(vs30), 0, 2000))
+        print('Max Vs30: %s\n' % np.clip(np.max(vs30), 0, 2000))
+
+    #---------------------------------------------------------------------------
+    # Standard deviation stuff
+    #---------------------------------------------------------------------------
+
+    # Only use total standard deviation for scenarios since
+    # we never have data to get bias.
+    stddev_types = [const.StdDev.TOTAL]
+
+    #---------------------------------------------------------------------------
+    # Intensity measures (excluding MI)
+    #---------------------------------------------------------------------------
+
+    imt_dict = IMT_DICT
+
+    #---------------------------------------------------------------------------
+    # Mesh calculations
+    #---------------------------------------------------------------------------
+    lats = np.linspace(smdict.ymax, smdict.ymin, smdict.ny)
+    lons = np.linspace(smdict.xmin, smdict.xmax, smdict.nx)
+
+    if verbose is True:
+        print('Mesh:')
+        print('Lons: %s to %s' % (np.min(lons), np.max(lons)))
+        print('Lats: %s to %s' % (np.min(lats), np.max(lats)))
+        print('mesh_dx: %f\n' % rupt._mesh_dx)
+
+    #---------------------------------------------------------------------------
+    # Intensity measure calculation
+    #---------------------------------------------------------------------------
+
+    # Make a dictionary to store intensity measure(s) and
+    # their sigmas.
+
+    orig_shape = vs30grid.getData().shape
+    imdict = {'pga': {'mean': np.zeros(orig_shape),
+                      'sigma': np.zeros(orig_shape)},
+              'pgv': {'mean': np.zeros(orig_shape),
+                      'sigma': np.zeros(orig_shape)},
+              'psa03': {'mean': np.zeros(orig_shape),
+                        'sigma': np.zeros(orig_shape)},
+              'psa10': {'mean': np.zeros(orig_shape),
+                        'sigma': np.zeros(orig_shape)},
+              'psa30': {'mean': np.zeros(orig_shape),
+                        'sigma': np.zeros(orig_shape)}}
+
+    # For rock
+    imdict_rock = {'pga': {'mean': np.zeros(orig_shape),
+                           'sigma': np.zeros(orig_shape)},
+                   'pgv': {'mean': np.zeros(orig_shape),
+                           'sigma': np.zeros(orig_shape)},
+                   'psa03': {'mean': np.zeros(orig_shape),
+                             'sigma': np.zeros(orig_shape)},
+                   'psa10': {'mean': np.zeros(orig_shape),
+                             'sigma': np.zeros(orig_shape)},
+                   'psa30': {'mean': np.zeros(orig_shape),
+                             'sigma': np.zeros(orig_shape)}}
+
+    # MMI
+    mmi = np.zeros(orig_shape)
+    mmi_sd = np.zeros(orig_shape)
+
+    #---------------------------------------------------------------------------
+    # Directivity
+    #---------------------------------------------------------------------------
+    if isinstance(origin.directivity, str):
+        dirbool = str2bool(origin.directivity)
+    else:
+        dirbool = origin.directivity
+    if dirbool is True:
+        fd1 = np.zeros(orig_shape)
+        fd3 = np.zeros(orig_shape)
+
+    #---------------------------------------------------------------------------
+    # Evaluate distances, GMPEs, directivity, and MMI one tile (band of rows)
+    # at a time, so that the memory used by the calculations is bounded by
+    # the tile size.
+    #---------------------------------------------------------------------------
+    state = {'config': config,
+             'origin': origin,
+             'rupt': rupt,
+             'rx': rx,
+             'vs30grid': vs30grid,
+             'lons': lons,
+             'lats': lats,
+             'dirbool': dirbool,
+             'imt_dict': imt_dict,
+             'stddev_types': stddev_types,
+             'verbose': verbose}
+    if rock_coarse is not None and rock_coarse > 1:
+        state['rock'] = {'factor': int(rock_coarse),
+                         'rrup': rock_rrup,
+                         'tol': rock_tol,
+                         'nsample': ROCK_NSAMPLE}
+    if family is True:
+        # In family mode, the geometry-only distances are shared with the
+        # other directivity realizations of this rupture.
+        state['datdir'] = datdir
+        state['id_str'] = id_str
+
+    # Daemonic processes (e.g., multiprocessing.Pool workers) cannot have
+    # children, so the tiles are evaluated in this process.
+    if nproc > 1 and multiprocessing.current_process().daemon:
+        warnings.warn('Cannot evaluate tiles on multiple processors from a '
+                      'daemonic process; using nproc=1.')
+        nproc = 1
+
+    # With multiple processors, the rows are split into more bands than
+    # processors (if the tile size doesn't already do so) to balance the load.
+    if nproc > 1 and tile_size is None:
+        tile_size = int(np.ceil(smdict.nx * smdict.ny / (4 * nproc)))
+    tiles = get_tiles(smdict.ny, smdict.nx, tile_size)
+
+    # Remove the distances cached by earlier runs of this event (e.g., with
+    # another grid) before the tiles write theirs
+    if family is True and not isinstance(rupt, PointRupture):
+        keys = []
+        for rows in tiles:
+            lon, lat = np.meshgrid(lons, lats[rows])
+            keys.append(get_geometry_key(rupt, lon, lat, np.zeros_like(lon)))
+        prune_distance_cache(os.path.join(input_dir, 'distances'), keys)
+
+    def store_tile(rows, tile):
+        for key in imt_dict.keys():
+            imdict[key]['mean'][rows] = tile[key]['mean']
+            imdict[key]['sigma'][rows] = tile[key]['sigma']
+            imdict_rock[key]['mean'][rows] = tile[key]['mean_rock']
+            imdict_rock[key]['sigma'][rows] = tile[key]['sigma_rock']
+        mmi[rows] = tile['mmi']
+        mmi_sd[rows] = tile['mmi_sd']
+        if dirbool is True:
+            fd1[rows] = tile['fd1']
+            fd3[rows] = tile['fd3']
+
+    if nproc > 1 and len(tiles) > 1:
+        # Build the filtered MultiGMPEs before forking so that the workers
+        # inherit them
+        preload_gmpes(config, verbose=verbose)
+        _pool_state = state
+        try:
+            with multiprocessing.get_context('fork').Pool(
+                    min(nproc, len(tiles))) as pool:
+                for rows, tile in zip(
+                        tiles, pool.imap(_evaluate_pool_tile, tiles)):
+                    store_tile(rows, tile)
+        finally:
+            _pool_state = None
+    else:
+        for rows in tiles:
+            store_tile(rows, evaluate_tile(rows, state))
+
+    #-----------------------------------------------------------------------
+    # Write files
+    #-----------------------------------------------------------------------
+
+    # Loop over intensity dictionary (PGA PGV, PSA03, PSA10, PSA30)
+    for key, val in imdict.items():
+        if key != 'pgv':
+            # Note that the output is in units of ln(g), whereas
+            # ShakeMap wants %g
+            mgrid = GMTGrid(100 * np.exp(imdict[key]['mean']), smdict)
+            sgrid = GMTGrid(imdict[key]['sigma'], smdict)
+        else:
+            mgrid = GMTGrid(np.exp(imdict[key]['mean']), smdict)
+            sgrid = GMTGrid(imdict[key]['sigma'], smdict)
+
+        if verbose is True:
+            print('Min %s: %s' % (key, np.min(mgrid.getData())))
+            print('Max %s: %s\n' % (key, np.max(mgrid.getData())))
+
+        # Write to file
+        mgrid.save(os.path.join(input_dir, key + '_estimates.grd'))
+        sgrid.save(os.path.join(input_dir, key + '_sd.grd'))
+        outputs.extend([key + '_estimates.grd', key + '_sd.grd'])
+
+    # Also write directivity factors to a file
+    if dirbool is True:
+        fd1grd = GMTGrid(fd1, smdict)
+        fd3grd = GMTGrid(fd3, smdict)
+        fd1grd.save(os.path.join(input_dir, 'fd1.grd'))
+        fd3grd.save(os.path.join(input_dir, 'fd3.grd'))
+        outputs.extend(['fd1.grd', 'fd3.grd'])
+
+    #---------------------------------------------------------------------------
+    # MMI
+    #---------------------------------------------------------------------------
+    mgrid = GMTGrid(mmi, smdict)
+    sgrid = GMTGrid(mmi_sd, smdict)
+
+    if verbose is True:
+        print('Min MI: %s' % np.min(mgrid.getData()))
+        print('Max MI: %s\n' % np.max(mgrid.getData()))
+
+    # Write to file
+    mgrid.save(os.path.join(input_dir, 'mi_estimates.grd'))
+    sgrid.save(os.path.join(input_dir, 'mi_sd.grd'))
+    outputs.extend(['mi_estimates.grd', 'mi_sd.grd'])
+
+    # Write GMPE set name to a file to put into info.json later
+    gmpefile = open(os.path.join(input_dir, "gmpe_set_name.txt"), "w")
+    gmpefile.write(get_multigmpe(config, filter_imt=imt.PGV()).DESCRIPTION)
+    gmpefile.close()
+    outputs.append('gmpe_set_name.txt')
+
+    # Need to write rock_grid.xml
+    layers = OrderedDict()
+    layers['pga'] = 100 * np.exp(imdict_rock['pga']['mean'])
+    layers['pgv'] = np.exp(imdict_rock['pgv']['mean'])
+    layers['mmi'] = mmi
+    layers['psa03'] = 100 * np.exp(imdict_rock['psa03']['mean'])
+    layers['psa10'] = 100 * np.exp(imdict_rock['psa10']['mean'])
+    layers['psa30'] = 100 * np.exp(imdict_rock['psa30']['mean'])
+    shakeDict = {'event_id': id_str,
+                 'shakemap_id': id_str,
+                 'shakemap_version': 1,
+                 'code_version': '4.0',
+                 'process_timestamp': datetime.utcnow(),
+                 'shakemap_originator': 'us',
+                 'map_status': 'RELEASED',
+                 'shakemap_event_type': 'SCENARIO'}
+    eventDict = {'event_id': id_str,
+                 'magnitude': rx.mag,
+                 'depth': rx.hypo_depth,
+                 'lat': rx.hypo_lat,
+                 'lon': rx.hypo_lon,
+                 'event_timestamp': datetime.utcnow(),
+                 'event_network': 'us',
+                 'event_description': ""}
+    #---------------------------------------------------------------------------
+    # Note: cannot put standard deviations here becaus they go
+    # into uncertainty.xml; in the current version of shakemap there
+    # is no where to put rock grid standard deviations. We should
+    # change this in the next udpate. The uncertainty here is based on
+    # instrumental records and so it is not really meaningful for scenarios.
+    #---------------------------------------------------------------------------
+    uncDict = {'pga': (0, 0),
+               'pgv': (0, 0),
+               'mmi': (0, 0),
+               'psa03': (0, 0),
+               'psa10': (0, 0),
+               'psa30': (0, 0)}
+    shake = ShakeGrid(layers, smdict, eventDict, shakeDict, uncDict)
+    shake.save(os.path.join(input_dir, "rock_grid.xml"), version=1)
+    outputs.append('rock_grid.xml')
+
+    #---------------------------------------------------------------------------
+    # Completion manifest
+    #---------------------------------------------------------------------------
+    write_manifest(input_dir, make_manifest(input_dir, config, params, outputs))
@@ -1,8 +1,16 @@
 import os
+import copy
+import json
 import time
+import hashlib
+import argparse
+import traceback
+import multiprocessing
+import multiprocessing.connection
 
 import numpy as np
 from lxml import etree
+from configobj import ConfigObj
 
 import openquake.hazardlib.geo as geo
 
@@ -14,9 +22,24 @@ from shakelib.rupture.origin import Origin
 from impactutils.time.ancient_time import HistoricTime as ShakeDateTime
 
 from scenarios.utils import get_event_id
+from scenarios.utils import get_event_ids
 from scenarios.utils import get_rupture_edges
 from scenarios.utils import get_hypo
 from scenarios.utils import rake_to_type
+from scenarios.utils import get_trace_corners
+from scenarios.utils import get_polygon_corners
+from scenarios.utils import fix_quads
+from scenarios.rupture_set import load_rupture_set
+from scenarios.rupture_set import get_event_parts
+from scenarios.rupture_set import RuptureSet
+
+# File in the event input directory that holds the source hash of the event
+SOURCE_HASH_FILE = 'source_hash.txt'
+
+# Version of the parsers, which is part of the source hash; increment it when
+# a change to the parsers changes the input directories that they write, so
+# that incremental runs rewrite them
+PARSER_VERSION = 2
 
 
 def write_event_xml(input_dir, rdict, directivity):
@@ -103,7 +126,121 @@ def write_rupture_files(input_dir, rdict):
     ff.close()
 
 
-def parse_bssc2014_ucerf(rupts, args):
+def get_source_hash(event, fmt, args):
+    """
+    Compute a hash of the definition of a rupture in a rupture set file and
+    of the mkinputdir arguments that affect its input directory (reference
+    and directivity). This does not include the timestamps that are written
+    into event.xml, so it only changes if the event actually changes.
+
+    Args:
+        event (dict): The entry for the rupture in the 'events' list of the
+            rupture set file.
+        fmt (str): Format of the rupture set file.
+        args (ArgumentParser): argparse object.
+
+    Returns:
+        str: Hex digest of the hash.
+
+    """
+    sha = hashlib.sha1()
+    sha.update(json.dumps(event, sort_keys=True).encode())
+    sha.update(json.dumps([PARSER_VERSION, fmt.lower(), args.reference,
+                           args.dirind]).encode())
+    return sha.hexdigest()
+
+
+def is_unchanged(datdir, id_str, source_hash):
+    """
+    Check whether the input directory of an event was written from the same
+    source (see get_source_hash).
+
+    Args:
+        datdir (str): Path of the ShakeMap data directory.
+        id_str (str): Event id.
+        source_hash (str): Source hash of the event.
+
+    Returns:
+        bool: Does the input directory have the same source hash?
+
+    """
+    hash_file = os.path.join(datdir, id_str, 'input', SOURCE_HASH_FILE)
+    if not os.path.isfile(hash_file):
+        return False
+    with open(hash_file) as f:
+        return f.read().strip() == source_hash
+
+
+def _get_unchanged(args, id_str, source_hash):
+    """
+    In incremental mode (args.incremental, with the data directory in
+    args.datdir), check whether an event is unchanged before its rupture is
+    built, so that the parsers can skip it.
+
+    Args:
+        args (ArgumentParser): argparse object.
+        id_str (str): Event id.
+        source_hash (str): Source hash of the event.
+
+    Returns:
+        dict: Rupture dictionary marking the event as unchanged, or None if
+        the event has to be parsed.
+
+    """
+    if getattr(args, 'incremental', False) is not True:
+        return None
+    if not is_unchanged(args.datdir, id_str, source_hash):
+        return None
+    return {'id_str': id_str, 'source_hash': source_hash, 'unchanged': True}
+
+
+def _get_parts(rupts, i):
+    """
+    Get the rupture coordinates of an event, split into their parts (see
+    get_event_parts); these come from the compiled arrays for a RuptureSet,
+    so that the parsers do not convert the coordinates of the decoded event.
+
+    Args:
+        rupts (dict): Python translation of rupture json file using json.load
+            method, or a RuptureSet.
+        i (int): Index of the event.
+
+    Returns:
+        list: List of arrays with shape (n, 3) of longitude, latitude, and
+        depth.
+
+    """
+    if isinstance(rupts, RuptureSet):
+        return rupts.get_parts(i)
+    return get_event_parts(rupts['events'][i], rupts['format'])
+
+
+def _quads_to_rupture(quads, origin, group_index, reference):
+    """
+    Build a QuadRupture from the corners of its quadrilaterals.
+
+    Args:
+        quads (array): Corners of the quads (see get_trace_corners); these
+            are the vertices given to fromVertices, not corrected with
+            fix_quads.
+        origin (Origin): Origin of the event.
+        group_index (list): Group index of each quad, or None if each quad
+            is its own group.
+        reference (str): Reference for rupture source.
+
+    Returns:
+        QuadRupture: The rupture.
+
+    """
+    return QuadRupture.fromVertices(
+        quads[:, 0, 0], quads[:, 0, 1], quads[:, 0, 2],
+        quads[:, 1, 0], quads[:, 1, 1], quads[:, 1, 2],
+        quads[:, 2, 0], quads[:, 2, 1], quads[:, 2, 2],
+        quads[:, 3, 0], quads[:, 3, 1], quads[:, 3, 2],
+        origin, group_index=group_index, reference=reference)
+
+
+def iter_bssc2014_ucerf(rupts, args):
     """
     This function is to parse the UCERF3 json file format. The ruptures in
     UCERF3 are very complex and so we don't exepct to get other rupture lists
@@ -111,14 +248,15 @@ def parse_bssc2014_ucerf(rupts, args):
 
     Args:
         rupts (dict): Python translation of rupture json file using json.load
-            method.
+            method, or a RuptureSet.
         args (ArgumentParser): argparse object.
 
-    Returns:
-        dict: Dictionary of rupture information.
+    Yields:
+        dict: Dictionary of rupture information, one rupture at a time. In
+        incremental mode, the events that are unchanged are only marked as
+        such (see _get_unchanged).
 
     """
-    rlist = []
     nrup = len(rupts['events'])
 
     if args.index is not None:
@@ -134,66 +272,67 @@ def parse_bssc2014_ucerf(rupts, args):
         magnitude = rupts['events'][i]['magnitude']
         rake = rupts['events'][i]['rake']
 
-        sections = np.array(rupts['events'][i]['sections'])
-        nsections = len(sections)
+        id_str, eventsourcecode = get_event_ids(
+            event_name, magnitude, args.directivity, args.dirind)
+        source_hash = get_source_hash(rupts['events'][i],
+                                      rupts.get('format', ''), args)
+        unchanged = _get_unchanged(args, id_str, source_hash)
+        if unchanged is not None:
+            yield unchanged
+            continue
 
-        secind = 0
+        sections = rupts['events'][i]['sections']
+        nsections = len(sections)
+        traces = _get_parts(rupts, i)
+
+        # Size the arrays from the number of trace segments in each section
+        n_sec_traces = [len(traces[j]) - 1 for j in range(nsections)]
+        nquad = sum(n_sec_traces)
+        rev = np.empty(nquad)
+        xp0 = np.empty(nquad)
+        xp1 = np.empty(nquad)
+        yp0 = np.empty(nquad)
+        yp1 = np.empty(nquad)
+        zp = np.empty(nquad)
+        dip_sec = np.empty(nquad)
+        strike_sec = np.empty(nquad)
+        width_sec = np.empty(nquad)
         new_seg_ind = []
-        rev = np.array([[]])
-        xp0 = np.array([[]])
-        xp1 = np.array([[]])
-        yp0 = np.array([[]])
-        yp1 = np.array([[]])
-        zp = np.array([[]])
-        dip_sec = np.array([[]])
-        strike_sec = np.array([[]])
-        width_sec = np.array([[]])
+        start = 0
         for j in range(0, nsections):
-            trace_sec = np.array(sections[j]['resampledTrace'])
-            top_sec_lon = trace_sec[:, 0]
-            top_sec_lat = trace_sec[:, 1]
-            top_sec_z = trace_sec[:, 2]
-            n_sec_trace = len(trace_sec) - 1
-            dip_sec = np.append(dip_sec, np.repeat(
-                sections[j]['dip'], n_sec_trace))
-            dipDir_sec = np.repeat(sections[j]['dipDir'], n_sec_trace)
-            strike_sec = np.append(strike_sec, dipDir_sec - 90)
-            width_sec = np.append(width_sec, np.repeat(
-                sections[j]['width'], n_sec_trace))
+            trace_sec = traces[j]
+            n_sec_trace = n_sec_traces[j]
+            sl = slice(start, start + n_sec_trace)
+            dip_sec[sl] = sections[j]['dip']
+            strike_sec[sl] = sections[j]['dipDir'] - 90
+            width_sec[sl] = sections[j]['width']
             rev_sec = sections[j]['reversed']
-            rev = np.append(rev, np.repeat(rev_sec, n_sec_trace))
-            xp0_sec = top_sec_lon[range(0, n_sec_trace)]
-            xp1_sec = top_sec_lon[range(1, n_sec_trace + 1)]
-            yp0_sec = top_sec_lat[range(0, n_sec_trace)]
-            yp1_sec = top_sec_lat[range(1, n_sec_trace + 1)]
-            zp_sec = top_sec_z[range(0, n_sec_trace)]
+            rev[sl] = rev_sec
             if rev_sec is False:
-                xp0 = np.append(xp0, xp0_sec)
-                xp1 = np.append(xp1, xp1_sec)
-                yp0 = np.append(yp0, yp0_sec)
-                yp1 = np.append(yp1, yp1_sec)
-                zp = np.append(zp, zp_sec)
+                xp0[sl] = trace_sec[:-1, 0]
+                xp1[sl] = trace_sec[1:, 0]
+                yp0[sl] = trace_sec[:-1, 1]
+                yp1[sl] = trace_sec[1:, 1]
+                zp[sl] = trace_sec[:-1, 2]
             else:
-                xp0 = np.append(xp0, xp1_sec[::-1])
-                xp1 = np.append(xp1, xp0_sec[::-1])
-                yp0 = np.append(yp0, yp1_sec[::-1])
-                yp1 = np.append(yp1, yp0_sec[::-1])
-                zp = np.append(zp, zp_sec[::-1])
-            new_seg_ind.extend([secind] * n_sec_trace)
-            secind = secind + 1
-
-        # Origin
-        origin = Origin({'mag': 0, 'id': '', 'lat': 0, 'lon': 0, 'depth': 0})
-        rupt = QuadRupture.fromTrace(xp0, yp0, xp1, yp1, zp,
-                                     width_sec, dip_sec, origin, strike=strike_sec,
-                                     group_index=new_seg_ind,
-                                     reference=args.reference)
-
-        quads = rupt.getQuadrilaterals()
+                xp0[sl] = trace_sec[1:, 0][::-1]
+                xp1[sl] = trace_sec[:-1, 0][::-1]
+                yp0[sl] = trace_sec[1:, 1][::-1]
+                yp1[sl] = trace_sec[:-1, 1][::-1]
+                zp[sl] = trace_sec[:-1, 2][::-1]
+            new_seg_ind.extend([j] * n_sec_trace)
+            start = start + n_sec_trace
+
+        # Corners of the quads, and the quads of the rupture that will be
+        # built from them, for placing the hypocenter before the rupture is
+        # built
+        corners = get_trace_corners(xp0, yp0, xp1, yp1, zp, width_sec,
+                                    dip_sec, strike=strike_sec)
+        quads = fix_quads(corners)
         edges = get_rupture_edges(quads, rev)
         hlat, hlon, hdepth = get_hypo(edges, args)
 
-        id_str, eventsourcecode, real_desc = get_event_id(
+        _, _, real_desc = get_event_id(
             event_name, magnitude, args.directivity, args.dirind, quads)
 
         event = {'lat': hlat,
@@ -209,12 +348,8 @@ def parse_bssc2014_ucerf(rupts, args):
                  'created': ShakeDateTime.utcfromtimestamp(int(time.time()))
                  }
 
-        # Update rupture with new origin info
-        origin = Origin(event)
-        rupt = QuadRupture.fromTrace(xp0, yp0, xp1, yp1, zp,
-                                     width_sec, dip_sec, origin, strike=strike_sec,
-                                     group_index=new_seg_ind,
-                                     reference=args.reference)
+        rupt = _quads_to_rupture(corners, Origin(event), new_seg_ind,
+                                 args.reference)
 
         rdict = {'rupture': rupt,
                  'event': event,
@@ -222,15 +357,30 @@ def parse_bssc2014_ucerf(rupts, args):
                  'id_str': id_str,
                  'short_name': short_name,
                  'real_desc': real_desc,
-                 'eventsourcecode': eventsourcecode
+                 'eventsourcecode': eventsourcecode,
+                 'source_hash': source_hash
                  }
 
-        rlist.append(rdict)
+        yield rdict
 
-    return rlist
 
+def parse_bssc2014_ucerf(rupts, args):
+    """
+    List version of iter_bssc2014_ucerf.
 
-def parse_json_nshmp(rupts, args):
+    Args:
+        rupts (dict): Python translation of rupture json file using json.load
+            method, or a RuptureSet.
+        args (ArgumentParser): argparse object.
+
+    Returns:
+        list: List of dictionaries of rupture information.
+
+    """
+    return list(iter_bssc2014_ucerf(rupts, args))
+
+
+def iter_json_nshmp(rupts, args):
     """
     This will hopefully be the most general json format for rutpures.
     Assumes top of ruputure is horizontal and continuous, and that
@@ -240,14 +390,15 @@ def parse_json_nshmp(rupts, args):
 
     Args:
         rupts (dict): Python translation of rupture json file using json.load
-            method.
+            method, or a RuptureSet.
         args (ArgumentParser): argparse object.
 
-    Returns:
-        dict: Dictionary of rupture information.
+    Yields:
+        dict: Dictionary of rupture information, one rupture at a time. In
+        incremental mode, the events that are unchanged are only marked as
+        such (see _get_unchanged).
 
     """
-    rlist = []
     nrup = len(rupts['events'])
 
     if args.index is not None:
@@ -267,16 +418,27 @@ def parse_json_nshmp(rupts, args):
         else:
             rake = np.nan
 
+        id_str, eventsourcecode = get_event_ids(
+            event_name, magnitude, args.directivity, args.dirind, id=id)
+        source_hash = get_source_hash(rupts['events'][i],
+                                      rupts.get('format', ''), args)
+        unchanged = _get_unchanged(args, id_str, source_hash)
+        if unchanged is not None:
+            yield unchanged
+            continue
+
+        trace = _get_parts(rupts, i)[0]
+        lons = trace[:, 0]
+        lats = trace[:, 1]
+
         # Does the file include a rupture model?
-        if len(rupts['events'][i]['lats']) > 1:
+        if len(lats) > 1:
 
             dip = rupts['events'][i]['dip']
 
             width = rupts['events'][i]['width']
             ztor = rupts['events'][i]['ztor']
 
-            lons = rupts['events'][i]['lons']
-            lats = rupts['events'][i]['lats']
             xp0 = np.array(lons[:-1])
             xp1 = np.array(lons[1:])
             yp0 = np.array(lats[:-1])
@@ -289,23 +451,18 @@ def parse_json_nshmp(rupts, args):
             P2 = geo.point.Point(lons[-1], lats[-1])
             strike = np.array([P1.azimuth(P2)])
 
-            # Dummy origin
-            origin = Origin(
-                {'mag': 0, 'id': '', 'lat': 0, 'lon': 0, 'depth': 0})
-            rupt = QuadRupture.fromTrace(xp0, yp0, xp1, yp1, zp,
-                                         widths, dips, origin, strike=strike,
-                                         reference=args.reference)
-
-            quads = rupt.getQuadrilaterals()
+            corners = get_trace_corners(xp0, yp0, xp1, yp1, zp, widths, dips,
+                                        strike=strike)
+            quads = fix_quads(corners)
             edges = get_rupture_edges(quads)  # for hypo placement
             hlat, hlon, hdepth = get_hypo(edges, args)
         else:
-            rupt = None
+            quads = None
             edges = None
-            hlat = float(rupts['events'][i]['lats'][0])
-            hlon = float(rupts['events'][i]['lons'][0])
+            hlat = float(lats[0])
+            hlon = float(lons[0])
 
-        id_str, eventsourcecode, real_desc = get_event_id(
+        _, _, real_desc = get_event_id(
             event_name, magnitude, args.directivity, args.dirind,
             quads, id=id)
 
@@ -322,12 +479,11 @@ def parse_json_nshmp(rupts, args):
                  'created': ShakeDateTime.utcfromtimestamp(int(time.time()))
                  }
 
-        # Update rupture with new origin info
-        if rupt is not None:
-            origin = Origin(event)
-            rupt = QuadRupture.fromTrace(xp0, yp0, xp1, yp1, zp,
-                                         widths, dips, origin, strike=strike,
-                                         reference=args.reference)
+        if quads is not None:
+            rupt = _quads_to_rupture(corners, Origin(event), None,
+                                     args.reference)
+        else:
+            rupt = None
 
         rdict = {'rupture': rupt,
                  'event': event,
@@ -335,28 +491,44 @@ def parse_json_nshmp(rupts, args):
                  'id_str': id_str,
                  'short_name': short_name,
                  'real_desc': real_desc,
-                 'eventsourcecode': eventsourcecode
+                 'eventsourcecode': eventsourcecode,
+                 'source_hash': source_hash
                  }
-        rlist.append(rdict)
+        yield rdict
 
-    return rlist
 
+def parse_json_nshmp(rupts, args):
+    """
+    List version of iter_json_nshmp.
+
+    Args:
+        rupts (dict): Python translation of rupture json file using json.load
+            method, or a RuptureSet.
+        args (ArgumentParser): argparse object.
+
+    Returns:
+        list: List of dictionaries of rupture information.
 
-def parse_json_nshmp_sub(rupts, args):
+    """
+    return list(iter_json_nshmp(rupts, args))
+
+
+def iter_json_nshmp_sub(rupts, args):
     """
     This is an alternative version of parse_json to use with the Cascadia
     subduction zone JSON rupture file.
 
     Args:
         rupts (dict): Python translation of rupture json file using json.load
-            method.
+            method, or a RuptureSet.
         args (ArgumentParser): argparse object.
 
-    Returns:
-        dict: Dictionary of rupture information.
+    Yields:
+        dict: Dictionary of rupture information, one rupture at a time. In
+        incremental mode, the events that are unchanged are only marked as
+        such (see _get_unchanged).
 
     """
-    rlist = []
     nrup = len(rupts['events'])
 
     if args.index is not None:
@@ -375,31 +547,26 @@ def parse_json_nshmp_sub(rupts, args):
         else:
             rake = None
 
-        toplons = np.array(rupts['events'][i]['toplons'])
-        toplats = np.array(rupts['events'][i]['toplats'])
-        topdeps = np.array(rupts['events'][i]['topdeps'])
-        botlons = np.array(rupts['events'][i]['botlons'])
-        botlats = np.array(rupts['events'][i]['botlats'])
-        botdeps = np.array(rupts['events'][i]['botdeps'])
-
-        # Dummy origin
-        origin = Origin({'mag': 0, 'id': '', 'lat': 0, 'lon': 0, 'depth': 0})
-
-        rupt = EdgeRupture.fromArrays(toplons=toplons,
-                                      toplats=toplats,
-                                      topdeps=topdeps,
-                                      botlons=botlons,
-                                      botlats=botlats,
-                                      botdeps=botdeps,
-                                      origin=origin,
-                                      reference=args.reference)
-        rupt._segment_index = np.zeros_like(toplons)
-
-        quads = rupt.getQuadrilaterals()
-        edges = get_rupture_edges(quads)  # for hypo placement
+        id_str, eventsourcecode = get_event_ids(
+            event_name, magnitude, args.directivity, args.dirind, id=id)
+        source_hash = get_source_hash(rupts['events'][i],
+                                      rupts.get('format', ''), args)
+        unchanged = _get_unchanged(args, id_str, source_hash)
+        if unchanged is not None:
+            yield unchanged
+            continue
+
+        top, bot = [np.array(part) for part in _get_parts(rupts, i)]
+        toplons, toplats, topdeps = top[:, 0], top[:, 1], top[:, 2]
+        botlons, botlats, botdeps = bot[:, 0], bot[:, 1], bot[:, 2]
+
+        # The edges are given, so the hypocenter is placed on them before
+        # the rupture is built
+        edges = [top, bot]
         hlat, hlon, hdepth = get_hypo(edges, args)
+        quads = np.stack([top[:-1], top[1:], bot[1:], bot[:-1]], axis=1)
 
-        id_str, eventsourcecode, real_desc = get_event_id(
+        _, _, real_desc = get_event_id(
             event_name, magnitude, args.directivity, args.dirind,
             quads, id=id)
 
@@ -415,17 +582,14 @@ def parse_json_nshmp_sub(rupts, args):
         event['time'] = ShakeDateTime.utcfromtimestamp(int(time.time()))
         event['created'] = ShakeDateTime.utcfromtimestamp(int(time.time()))
 
-        # Update rupture with new origin info
-        if rupt is not None:
-            origin = Origin(event)
-            rupt = EdgeRupture.fromArrays(toplons=toplons,
-                                          toplats=toplats,
-                                          topdeps=topdeps,
-                                          botlons=botlons,
-                                          botlats=botlats,
-                                          botdeps=botdeps,
-                                          origin=origin,
-                                          reference=args.reference)
+        rupt = EdgeRupture.fromArrays(toplons=toplons,
+                                      toplats=toplats,
+                                      topdeps=topdeps,
+                                      botlons=botlons,
+                                      botlats=botlats,
+                                      botdeps=botdeps,
+                                      origin=Origin(event),
+                                      reference=args.reference)
 
         rdict = {'rupture': rupt,
                  'event': event,
@@ -433,14 +597,29 @@ def parse_json_nshmp_sub(rupts, args):
                  'id_str': id_str,
                  'short_name': short_name,
                  'real_desc': real_desc,
-                 'eventsourcecode': eventsourcecode
+                 'eventsourcecode': eventsourcecode,
+                 'source_hash': source_hash
                  }
-        rlist.append(rdict)
+        yield rdict
 
-    return rlist
 
+def parse_json_nshmp_sub(rupts, args):
+    """
+    List version of iter_json_nshmp_sub.
 
-def parse_json_shakemap(rupts, args):
+    Args:
+        rupts (dict): Python translation of rupture json file using json.load
+            method, or a RuptureSet.
+        args (ArgumentParser): argparse object.
+
+    Returns:
+        list: List of dictionaries of rupture information.
+
+    """
+    return list(iter_json_nshmp_sub(rupts, args))
+
+
+def iter_json_shakemap(rupts, args):
     """
     This parses a json format that is basically a list of rupture.json formats,
     are multipolygon features, and very similar to the ShakeMap 3.5 fault file
@@ -452,14 +631,15 @@ def parse_json_shakemap(rupts, args):
 
     Args:
         rupts (dict): Python translation of rupture json file using json.load
-            method.
+            method, or a RuptureSet.
         args (ArgumentParser): argparse object.
 
-    Returns:
-        dict: Dictionary of rupture information.
+    Yields:
+        dict: Dictionary of rupture information, one rupture at a time. In
+        incremental mode, the events that are unchanged are only marked as
+        such (see _get_unchanged).
 
     """
-    rlist = []
     nrup = len(rupts['events'])
 
     if args.index is not None:
@@ -479,30 +659,30 @@ def parse_json_shakemap(rupts, args):
         else:
             rake = None
 
+        id_str, eventsourcecode = get_event_ids(
+            event_name, magnitude, args.directivity, args.dirind, id=id)
+        source_hash = get_source_hash(rupts['events'][i],
+                                      rupts.get('format', ''), args)
+        unchanged = _get_unchanged(args, id_str, source_hash)
+        if unchanged is not None:
+            yield unchanged
+            continue
+
         # Does the event include a rupture model?
         if rupts['events'][i]['features'][0]['geometry']['type'] == \
            "MultiPolygon":
 
-            # Dummy origin
-            origin = Origin(
-                {'mag': 0, 'id': '', 'lat': 0, 'lon': 0, 'depth': 0})
-            rupt = json_to_rupture(rupts['events'][i], origin)
-
-            quads = rupt.getQuadrilaterals()
+            # Quads from the polygon vertices, for placing the hypocenter
+            # before the rupture is built
+            quads = fix_quads(get_polygon_corners(_get_parts(rupts, i)))
             edges = get_rupture_edges(quads)  # for hypo placement
             hlat, hlon, hdepth = get_hypo(edges, args)
         else:
-            rupt = None
             edges = None
             quads = None
-            hlon = float(rupts['events'][i]['features'][0]
-                         ['geometry']['coordinates'][0])
-            hlat = float(rupts['events'][i]['features'][0]
-                         ['geometry']['coordinates'][1])
-            hdepth = float(rupts['events'][i]['features']
-                           [0]['geometry']['coordinates'][2])
-
-        id_str, eventsourcecode, real_desc = get_event_id(
+            hlon, hlat, hdepth = [float(c) for c in _get_parts(rupts, i)[0][0]]
+
+        _, _, real_desc = get_event_id(
             event_name, magnitude, args.directivity, args.dirind,
             quads, id=id)
 
@@ -519,10 +699,10 @@ def parse_json_shakemap(rupts, args):
                  'created': ShakeDateTime.utcfromtimestamp(int(time.time()))
                  }
 
-        # Update rupture with new origin info
-        if rupt is not None:
-            origin = Origin(event)
-            rupt = json_to_rupture(rupts['events'][i], origin)
+        if quads is not None:
+            rupt = json_to_rupture(rupts['events'][i], Origin(event))
+        else:
+            rupt = None
 
         rdict = {'rupture': rupt,
                  'event': event,
@@ -530,8 +710,299 @@ def parse_json_shakemap(rupts, args):
                  'id_str': id_str,
                  'short_name': short_name,
                  'real_desc': real_desc,
-                 'eventsourcecode': eventsourcecode
+                 'eventsourcecode': eventsourcecode,
+                 'source_hash': source_hash
                  }
-        rlist.append(rdict)
+        yield rdict
+
+
+def parse_json_shakemap(rupts, args):
+    """
+    List version of iter_json_shakemap.
+
+    Args:
+        rupts (dict): Python translation of rupture json file using json.load
+            method, or a RuptureSet.
+        args (ArgumentParser): argparse object.
+
+    Returns:
+        list: List of dictionaries of rupture information.
+
+    """
+    return list(iter_json_shakemap(rupts, args))
+
+
+def iter_ruptures(rupts, args):
+    """
+    Parse a rupture set with the parser for its format, one rupture at a
+    time, so that each event can be written as soon as it is parsed.
+
+    Args:
+        rupts (dict): Python translation of rupture json file using json.load
+            method, or a RuptureSet.
+        args (ArgumentParser): argparse object.
+
+    Returns:
+        generator: Generator of rupture dictionaries.
+
+    """
+    if rupts['format'].lower() == 'ucerf':
+        return iter_bssc2014_ucerf(rupts, args)
+    elif rupts['format'].lower() == 'nshmp':
+        return iter_json_nshmp(rupts, args)
+    elif rupts['format'].lower() == 'nshmp_sub':
+        return iter_json_nshmp_sub(rupts, args)
+    elif rupts['format'].lower() == 'shakemap':
+        return iter_json_shakemap(rupts, args)
+    else:
+        raise Exception('Unknown rupture file format.')
+
+
+def parse_ruptures(rupts, args):
+    """
+    List version of iter_ruptures.
+
+    Args:
+        rupts (dict): Python translation of rupture json file using json.load
+            method, or a RuptureSet.
+        args (ArgumentParser): argparse object.
+
+    Returns:
+        list: List of rupture dictionaries.
 
-    return rlist
+    """
+    return list(iter_ruptures(rupts, args))
+
+
+def write_input_dir(datdir, rdict, directivity, incremental=False):
+    """
+    Write the input directory (rupture files, event.xml, and source hash)
+    for one event.
+
+    Args:
+        datdir (str): Path of the ShakeMap data directory.
+        rdict (dict): Rupture dictionary.
+        directivity (bool): Include directivity?
+        incremental (bool): Skip the event if its input directory has the
+            same source hash?
+
+    Returns:
+        bool: Was the input directory written?
+
+    """
+    id_str = rdict['id_str']
+    evt_dir = os.path.join(datdir, id_str)
+    input_dir = os.path.join(evt_dir, 'input')
+    hash_file = os.path.join(input_dir, SOURCE_HASH_FILE)
+
+    # Skip the event if it hasn't changed; the parsers already mark the
+    # unchanged events if they are given the data directory
+    if rdict.get('unchanged', False) is True or (
+            incremental is True and
+            is_unchanged(datdir, id_str, rdict['source_hash'])):
+        print('%s (unchanged)' % evt_dir)
+        return False
+
+    # Create event directory if it doesn't exist
+    if os.path.isdir(evt_dir) == False:
+        os.mkdir(evt_dir)
+    print(evt_dir)
+
+    # Create input directory if it doesn't exist
+    if os.path.isdir(input_dir) == False:
+        os.mkdir(input_dir)
+
+    #---------------------------------------------------------------------------
+    # Write rupture files and event.xml
+    #---------------------------------------------------------------------------
+    if rdict['rupture'] is not None:
+        write_rupture_files(input_dir, rdict)
+
+    write_event_xml(input_dir, rdict, directivity)
+    with open(hash_file, 'w') as f:
+        f.write(rdict['source_hash'] + '\n')
+    return True
+
+
+# Rupture set and arguments for the worker processes of make_input_dirs; set
+# before the workers are forked so that the rupture set is not pickled for
+# each rupture.
+_pool_state = None
+
+
+def _make_one_input_dir(i):
+    """
+    Parse one rupture of the rupture set in _pool_state and write its input
+    directory. Exceptions are caught so that one bad rupture does not stop
+    the others.
+
+    Args:
+        i (int): Index of the rupture in the rupture set.
+
+    Returns:
+        tuple: The index, the list of ids of the events that were written,
+        and the traceback if there was an error (otherwise None).
+
+    """
+    rupts, args, datdir, incremental = _pool_state
+    ids = []
+    try:
+        args = copy.copy(args)
+        args.index = [i]
+        for rdict in iter_ruptures(rupts, args):
+            if write_input_dir(datdir, rdict, args.directivity,
+                               incremental=incremental):
+                ids.append(rdict['id_str'])
+        return i, ids, None
+    except Exception:
+        return i, ids, traceback.format_exc()
+
+
+def _run_input_dirs(task, conn):
+    """
+    Make the input directories of the ruptures of a task in this (child)
+    process, sending the result for each rupture to the parent as soon as it
+    is done.
+
+    Args:
+        task (list): Indices of the ruptures in the rupture set.
+        conn (Connection): Write end of a pipe to the parent.
+
+    """
+    for i in task:
+        conn.send(_make_one_input_dir(i))
+    conn.close()
+
+
+def _run_input_dir_tasks(tasks, nproc):
+    """
+    Run tasks of make_input_dirs on up to nproc child processes at a time,
+    forked from this process so that they share the rupture set in
+    _pool_state. A child that dies fails only the ruptures of its task that
+    had not finished; the other tasks still run.
+
+    Args:
+        tasks (list): Lists of rupture indices.
+        nproc (int): Maximum number of child processes.
+
+    Returns:
+        list: Results (see _make_one_input_dir) in the order of the ruptures
+        in tasks.
+
+    """
+    ctx = multiprocessing.get_context('fork')
+    pending = list(tasks)
+    running = {}
+    results = {}
+    while len(pending) > 0 or len(running) > 0:
+        while len(pending) > 0 and len(running) < nproc:
+            task = pending.pop(0)
+            reader, writer = ctx.Pipe(duplex=False)
+            proc = ctx.Process(target=_run_input_dirs, args=(task, writer))
+            proc.start()
+            writer.close()
+            running[reader] = (proc, task)
+        for reader in multiprocessing.connection.wait(list(running.keys())):
+            proc, task = running[reader]
+            try:
+                result = reader.recv()
+                results[result[0]] = result
+                continue
+            except EOFError:
+                # The child has exited
+                pass
+            del running[reader]
+            reader.close()
+            proc.join()
+            for i in task:
+                if i not in results:
+                    results[i] = (i, [], 'Worker process exited with code '
+                                  '%i.\n' % proc.exitcode)
+    return [results[i] for task in tasks for i in task]
+
+
+def make_input_dirs(rfile, reference='', dirind=-1, index=None,
+                    incremental=False, nproc=1):
+    """
+    Create ShakeMap input directories (event.xml and rupture files) for the
+    events in a rupture set file. The source hash of each event (see
+    get_source_hash) is written to input/source_hash.txt. Each rupture is
+    parsed and written independently; if any of them fail, the others are
+    still written and then an exception is raised.
+
+    Args:
+        rfile (str): Rupture set JSON file.
+        reference (str): Reference for rupture source.
+        dirind (int): Directivity; -1 for no directivity; 0 and 2 are the two
+            opposing unilateral directions, 1 is for bilateral.
+        index (list): Optional list of rupture indices to run; None runs all
+            of the ruptures in the file.
+        incremental (bool): Skip the events whose input directory has the
+            same source hash, i.e., that have not changed?
+        nproc (int): Number of processors to distribute the ruptures onto.
+
+    Returns:
+        list: Ids of the events that were written.
+
+    """
+    global _pool_state
+    config = ConfigObj(os.path.join(os.path.expanduser('~'), 'scenarios.conf'))
+    shakehome = config['system']['shakehome']
+
+    # Open rupture file, through its compiled cache so that only the selected
+    # events are decoded
+    rupts = load_rupture_set(rfile)
+    nrup = len(rupts['events'])
+    print('Total number of ruptures: %d' % nrup)
+
+    if rupts['format'].lower() not in ['ucerf', 'nshmp', 'nshmp_sub',
+                                       'shakemap']:
+        raise Exception('Unknown rupture file format.')
+
+    if index is not None:
+        indices = [int(i) for i in index]
+    else:
+        indices = list(range(nrup))
+
+    # Create base directory if it doesn't exist
+    datdir = os.path.join(shakehome, 'data')
+    if os.path.isdir(datdir) == False:
+        os.mkdir(datdir)
+
+    # The parsers skip the unchanged events before building their ruptures
+    args = argparse.Namespace(file=rfile, reference=reference, dirind=dirind,
+                              index=index, directivity=(dirind != -1),
+                              datdir=datdir, incremental=incremental)
+
+    #---------------------------------------------------------------------------
+    # Parse and write the ruptures, on forked processes if requested
+    #---------------------------------------------------------------------------
+    _pool_state = (rupts, args, datdir, incremental)
+    try:
+        if nproc > 1 and len(indices) > 1:
+            # A few tasks per process, to balance the load without forking
+            # a process for each rupture
+            ntask = min(len(indices), 4 * nproc)
+            tasks = [[int(i) for i in task]
+                     for task in np.array_split(indices, ntask)]
+            results = _run_input_dir_tasks(tasks, nproc)
+        else:
+            results = [_make_one_input_dir(i) for i in indices]
+    finally:
+        _pool_state = None
+
+    ids = []
+    failed = []
+    for i, rids, error in results:
+        ids.extend(rids)
+        if error is not None:
+            failed.append(i)
+            print('Rupture %i failed:\n%s' % (i, error))
+
+    if len(failed) > 0:
+        raise Exception('Failed to make the input directories for %i of %i '
+                        'ruptures (indices: %s).'
+                        % (len(failed), len(indices),
+                           ' '.join(str(i) for i in failed)))
+
+    return ids
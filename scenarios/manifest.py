@@ -0,0 +1,232 @@
+import os
+import glob
+import json
+import hashlib
+from datetime import datetime
+
+import scenarios
+
+MANIFEST_FILE = 'manifest.json'
+
+
+def hash_file(filename):
+    """
+    Compute the sha1 hash of a file.
+
+    Args:
+        filename (str): Path of the file.
+
+    Returns:
+        str: Hex digest of the hash.
+
+    """
+    sha = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def get_config_hash(config):
+    """
+    Compute a hash of the scenarios config (including the GMPE sets and
+    modules), of the size and modification time of the Vs30 file, and, if a
+    Vs30 store is configured, of its geodict.json and the size and
+    modification time of each of its level files.
+
+    Args:
+        config (ConfigObj): Scenarios config.
+
+    Returns:
+        str: Hex digest of the hash.
+
+    """
+    sha = hashlib.sha1()
+    cdict = config.dict() if hasattr(config, 'dict') else dict(config)
+    sha.update(json.dumps(cdict, sort_keys=True, default=str).encode())
+    vs30file = config['data']['vs30file']
+    if vs30file and os.path.isfile(vs30file):
+        stat = os.stat(vs30file)
+        sha.update(('%i %f' % (stat.st_size, stat.st_mtime)).encode())
+    store_dir = config['data'].get('vs30store', '')
+    if store_dir and os.path.isdir(store_dir):
+        gfile = os.path.join(store_dir, 'geodict.json')
+        if os.path.isfile(gfile):
+            with open(gfile, 'rb') as f:
+                sha.update(f.read())
+        for lfile in sorted(glob.glob(os.path.join(store_dir, '*.npy'))):
+            stat = os.stat(lfile)
+            sha.update(('%s %i %f' % (os.path.basename(lfile), stat.st_size,
+                                      stat.st_mtime)).encode())
+    return sha.hexdigest()
+
+
+def get_input_files(input_dir):
+    """
+    Get the input files (event.xml and rupture files) of an event.
+
+    Args:
+        input_dir (str): Path of the event input directory.
+
+    Returns:
+        list: Names of the input files, relative to input_dir.
+
+    """
+    files = []
+    if os.path.isfile(os.path.join(input_dir, 'event.xml')):
+        files.append('event.xml')
+    for pattern in ['*rupture.json', '*_fault.txt']:
+        files.extend(sorted(
+            os.path.basename(f)
+            for f in glob.glob(os.path.join(input_dir, pattern))))
+    return files
+
+
+def get_run_params(res, nmax, mesh_dx, extent=None, rock_coarse=None,
+                   rock_rrup=None, rock_tol=None):
+    """
+    Get the mkscenariogrids parameters that affect the outputs, as stored in
+    the manifest. The tile size, number of processors, and family mode are
+    not included because they do not change the results.
+
+    Args:
+        res (float): The resolution in decimal degrees.
+        nmax (int): Maximum number of cells allowed.
+        mesh_dx (float): The resolution for rupture mesh in km.
+        extent (list): Optional extent: lonmin, latmin, lonmax, latmax.
+        rock_coarse (int): Sub-grid factor of the rock fast path, if used.
+        rock_rrup (float): Distance within which the rock fast path
+            evaluates the rock fields directly.
+        rock_tol (float): Error tolerance of the rock fast path.
+
+    Returns:
+        dict: The run parameters.
+
+    """
+    if extent is not None:
+        extent = [float(e) for e in extent]
+    params = {'res': float(res),
+              'nmax': int(nmax),
+              'mesh_dx': float(mesh_dx),
+              'extent': extent}
+    if rock_coarse is not None and rock_coarse > 1:
+        params['rock'] = {'factor': int(rock_coarse),
+                          'rrup': float(rock_rrup),
+                          'tol': float(rock_tol)}
+    return params
+
+
+def make_manifest(input_dir, config, params, outputs):
+    """
+    Make the completion manifest for an event.
+
+    Args:
+        input_dir (str): Path of the event input directory.
+        config (ConfigObj): Scenarios config.
+        params (dict): Run parameters that affect the outputs.
+        outputs (list): Names of the output files, relative to input_dir.
+
+    Returns:
+        dict: The manifest.
+
+    """
+    inputs = {f: hash_file(os.path.join(input_dir, f))
+              for f in get_input_files(input_dir)}
+    outputs = {f: os.path.getsize(os.path.join(input_dir, f))
+               for f in outputs}
+    return {'version': scenarios.__version__,
+            'config_hash': get_config_hash(config),
+            'params': params,
+            'inputs': inputs,
+            'outputs': outputs,
+            'timestamp': datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')}
+
+
+def write_manifest(input_dir, manifest):
+    """
+    Write the completion manifest of an event. The manifest is written to a
+    temporary file first so that a partially written manifest is never read.
+
+    Args:
+        input_dir (str): Path of the event input directory.
+        manifest (dict): The manifest (see make_manifest).
+
+    """
+    mfile = os.path.join(input_dir, MANIFEST_FILE)
+    tmpfile = '%s.tmp%i' % (mfile, os.getpid())
+    with open(tmpfile, 'w') as f:
+        json.dump(manifest, f, indent=4, sort_keys=True)
+    os.rename(tmpfile, mfile)
+
+
+def read_manifest(input_dir):
+    """
+    Read the completion manifest of an event.
+
+    Args:
+        input_dir (str): Path of the event input directory.
+
+    Returns:
+        dict: The manifest, or None if there isn't a (readable) manifest.
+
+    """
+    mfile = os.path.join(input_dir, MANIFEST_FILE)
+    if not os.path.isfile(mfile):
+        return None
+    try:
+        with open(mfile) as f:
+            return json.load(f)
+    except ValueError:
+        return None
+
+
+def remove_manifest(input_dir):
+    """
+    Remove the completion manifest of an event, if there is one.
+
+    Args:
+        input_dir (str): Path of the event input directory.
+
+    """
+    mfile = os.path.join(input_dir, MANIFEST_FILE)
+    if os.path.isfile(mfile):
+        os.remove(mfile)
+
+
+def is_complete(input_dir, config, params):
+    """
+    Check if the outputs of an event are complete and up to date, i.e., the
+    event has a manifest that matches the code version, config, run
+    parameters, and input files, and all of its output files exist.
+
+    Args:
+        input_dir (str): Path of the event input directory.
+        config (ConfigObj): Scenarios config.
+        params (dict): Run parameters that affect the outputs.
+
+    Returns:
+        bool: Is the event complete?
+
+    """
+    manifest = read_manifest(input_dir)
+    if manifest is None:
+        return False
+    if manifest.get('version') != scenarios.__version__:
+        return False
+    if manifest.get('params') != params:
+        return False
+    if manifest.get('config_hash') != get_config_hash(config):
+        return False
+
+    inputs = manifest.get('inputs', {})
+    if sorted(inputs.keys()) != sorted(get_input_files(input_dir)):
+        return False
+    for f, sha in inputs.items():
+        if hash_file(os.path.join(input_dir, f)) != sha:
+            return False
+
+    for f, size in manifest.get('outputs', {}).items():
+        ofile = os.path.join(input_dir, f)
+        if not os.path.isfile(ofile) or os.path.getsize(ofile) != size:
+            return False
+    return True
@@ -0,0 +1,420 @@
+import os
+import json
+import shutil
+
+import numpy as np
+from configobj import ConfigObj
+
+from scenarios.manifest import hash_file
+
+# Version of the layout of the compiled rupture set cache; bump this when the
+# layout changes so that old caches are not used.
+CACHE_VERSION = 2
+
+
+def get_cache_dir():
+    """
+    Get the directory that holds the compiled rupture set caches. This can be
+    set with 'cache_dir' in the [system] section of the scenarios conf file;
+    the default is ~/.scenarios/cache.
+
+    Returns:
+        str: Path of the cache directory.
+
+    """
+    default = os.path.join(os.path.expanduser('~'), '.scenarios', 'cache')
+    conf_file = os.path.join(os.path.expanduser('~'), 'scenarios.conf')
+    if not os.path.isfile(conf_file):
+        return default
+    config = ConfigObj(conf_file)
+    if 'system' in config and 'cache_dir' in config['system']:
+        return os.path.expanduser(config['system']['cache_dir'])
+    return default
+
+
+def get_event_name(event, fmt):
+    """
+    Get the name (description) of an event in a rupture set.
+
+    Args:
+        event (dict): The entry for the rupture in the 'events' list of the
+            rupture set file.
+        fmt (str): Format of the rupture set file.
+
+    Returns:
+        str: The name.
+
+    """
+    fmt = fmt.lower()
+    if fmt == 'ucerf':
+        return str(event['name'])
+    elif fmt == 'shakemap':
+        return str(event['metadata']['locstring'])
+    else:
+        return str(event['desc'])
+
+
+def get_event_mag(event, fmt):
+    """
+    Get the magnitude of an event in a rupture set.
+
+    Args:
+        event (dict): The entry for the rupture in the 'events' list of the
+            rupture set file.
+        fmt (str): Format of the rupture set file.
+
+    Returns:
+        float: The magnitude.
+
+    """
+    fmt = fmt.lower()
+    if fmt == 'ucerf':
+        return float(event['magnitude'])
+    elif fmt == 'shakemap':
+        return float(event['metadata']['mag'])
+    else:
+        return float(event['mag'])
+
+
+def get_event_parts(event, fmt):
+    """
+    Get the coordinates that define the rupture of an event in a rupture set,
+    split into their parts: the section traces for UCERF, the trace for
+    NSHMP, the top and bottom edges for NSHMP subduction, and the polygon
+    rings for ShakeMap.
+
+    Args:
+        event (dict): The entry for the rupture in the 'events' list of the
+            rupture set file.
+        fmt (str): Format of the rupture set file.
+
+    Returns:
+        list: List of arrays with shape (n, 3) of longitude, latitude, and
+        depth.
+
+    """
+    fmt = fmt.lower()
+    if fmt == 'ucerf':
+        parts = [np.array(s['resampledTrace'], dtype=float).reshape(-1, 3)
+                 for s in event['sections']]
+    elif fmt == 'nshmp':
+        lons = np.array(event['lons'], dtype=float)
+        lats = np.array(event['lats'], dtype=float)
+        deps = np.ones_like(lons) * float(event.get('ztor', 0.0))
+        parts = [np.column_stack([lons, lats, deps])]
+    elif fmt == 'nshmp_sub':
+        parts = [np.column_stack([
+            np.array(event[pre + 'lons'], dtype=float),
+            np.array(event[pre + 'lats'], dtype=float),
+            np.array(event[pre + 'deps'], dtype=float)])
+            for pre in ['top', 'bot']]
+    elif fmt == 'shakemap':
+        # Flatten the (possibly ragged) nesting of the geometry coordinates
+        parts = []
+        stack = [event['features'][0]['geometry']['coordinates']]
+        while stack:
+            c = stack.pop()
+            if len(c) > 0 and not isinstance(c[0], list):
+                parts.append(np.array(c, dtype=float).reshape(-1, 3))
+            else:
+                stack.extend(c[::-1])
+        # A point is a single part
+        if len(parts) > 1 and all(len(p) == 1 for p in parts):
+            parts = [np.concatenate(parts)]
+    else:
+        raise Exception('Unknown rupture file format.')
+    return parts
+
+
+def get_event_coords(event, fmt):
+    """
+    Get the coordinates that define the rupture of an event in a rupture set
+    (see get_event_parts).
+
+    Args:
+        event (dict): The entry for the rupture in the 'events' list of the
+            rupture set file.
+        fmt (str): Format of the rupture set file.
+
+    Returns:
+        array: Array with shape (n, 3) of longitude, latitude, and depth.
+
+    """
+    parts = get_event_parts(event, fmt)
+    if len(parts) == 0:
+        return np.zeros((0, 3))
+    return np.concatenate(parts)
+
+
+def write_rupture_set_cache(rupts, cache_path, rfile=None):
+    """
+    Write the compiled cache of a rupture set. The cache is a directory of
+    .npy files that can be memory mapped:
+
+        - events.npy: the JSON of each event, concatenated (uint8).
+        - event_offsets.npy: offsets of each event in events.npy.
+        - coords.npy: rupture coordinates of each event, concatenated
+          (see get_event_coords).
+        - coord_offsets.npy: offsets of each event in coords.npy.
+        - part_offsets.npy: offsets of each part (see get_event_parts) in
+          coords.npy.
+        - event_part_offsets.npy: offsets of each event in
+          part_offsets.npy.
+        - bboxes.npy: bounding box (lonmin, latmin, lonmax, latmax) of the
+          coordinates of each event.
+        - mags.npy: magnitude of each event.
+
+    and meta.json, which holds the top level entries of the rupture set
+    (other than 'events'), the name of each event, and the path of the
+    rupture set file. The files are written to a temporary directory first so
+    that a partially written cache is never read.
+
+    Args:
+        rupts (dict): Python translation of rupture json file using json.load
+            method.
+        cache_path (str): Path of the cache directory to create.
+        rfile (str): Rupture set JSON file, which is used to find the stale
+            caches of the file (see prune_rupture_set_caches).
+
+    """
+    fmt = rupts['format']
+    events = rupts['events']
+    nev = len(events)
+
+    blobs = [json.dumps(e).encode() for e in events]
+    event_offsets = np.zeros(nev + 1, dtype=np.int64)
+    event_offsets[1:] = np.cumsum([len(b) for b in blobs])
+    parts = [get_event_parts(e, fmt) for e in events]
+    event_part_offsets = np.zeros(nev + 1, dtype=np.int64)
+    event_part_offsets[1:] = np.cumsum([len(p) for p in parts])
+    parts = [p for ep in parts for p in ep]
+    part_offsets = np.zeros(len(parts) + 1, dtype=np.int64)
+    part_offsets[1:] = np.cumsum([len(p) for p in parts])
+    coord_offsets = part_offsets[event_part_offsets]
+    if len(parts) > 0:
+        coords = np.concatenate(parts)
+    else:
+        coords = np.zeros((0, 3))
+
+    # Bounding box (lonmin, latmin, lonmax, latmax) of each event
+    bboxes = np.full((nev, 4), np.nan)
+    for i in range(nev):
+        c = coords[coord_offsets[i]:coord_offsets[i + 1]]
+        if len(c) > 0:
+            bboxes[i] = [c[:, 0].min(), c[:, 1].min(),
+                         c[:, 0].max(), c[:, 1].max()]
+
+    meta = {k: v for k, v in rupts.items() if k != 'events'}
+    meta['event_names'] = [get_event_name(e, fmt) for e in events]
+    meta['cache_version'] = CACHE_VERSION
+    meta['source_file'] = os.path.abspath(rfile) if rfile else None
+
+    parent = os.path.dirname(cache_path)
+    if not os.path.isdir(parent):
+        os.makedirs(parent, exist_ok=True)
+    tmp_path = '%s.tmp%i' % (cache_path, os.getpid())
+    if os.path.isdir(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.mkdir(tmp_path)
+    np.save(os.path.join(tmp_path, 'events.npy'),
+            np.frombuffer(b''.join(blobs), dtype=np.uint8))
+    np.save(os.path.join(tmp_path, 'event_offsets.npy'), event_offsets)
+    np.save(os.path.join(tmp_path, 'coords.npy'), coords)
+    np.save(os.path.join(tmp_path, 'coord_offsets.npy'), coord_offsets)
+    np.save(os.path.join(tmp_path, 'part_offsets.npy'), part_offsets)
+    np.save(os.path.join(tmp_path, 'event_part_offsets.npy'),
+            event_part_offsets)
+    np.save(os.path.join(tmp_path, 'bboxes.npy'), bboxes)
+    np.save(os.path.join(tmp_path, 'mags.npy'), np.array(
+        [get_event_mag(e, fmt) for e in events], dtype=float))
+    with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+
+    try:
+        os.rename(tmp_path, cache_path)
+    except OSError:
+        # Another process wrote the same cache first
+        shutil.rmtree(tmp_path)
+
+
+class _EventList(object):
+    """
+    Read-only list of the events of a compiled rupture set; each event is
+    decoded from the memory mapped JSON when it is accessed. The last event
+    is kept because the parsers access the same event many times in a row.
+    """
+
+    def __init__(self, blob, offsets):
+        self._blob = blob
+        self._offsets = offsets
+        self._last = (None, None)
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        i = int(i)
+        if i < 0:
+            i += len(self)
+        if i < 0 or i >= len(self):
+            raise IndexError('event index out of range')
+        if self._last[0] != i:
+            start, stop = self._offsets[i], self._offsets[i + 1]
+            event = json.loads(bytes(self._blob[start:stop]).decode())
+            self._last = (i, event)
+        return self._last[1]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+class RuptureSet(object):
+    """
+    Compiled rupture set (see write_rupture_set_cache). This can be used in
+    place of the dictionary from loading the rupture set file with json.load
+    (e.g., rupts['format'], rupts['events'][i]), but only the requested
+    events are decoded.
+    """
+
+    def __init__(self, cache_path):
+        self.cache_path = cache_path
+        with open(os.path.join(cache_path, 'meta.json')) as f:
+            self._meta = json.load(f)
+        self.names = self._meta.pop('event_names')
+        self._meta.pop('cache_version')
+        self._meta.pop('source_file', None)
+
+        def load(name):
+            return np.load(os.path.join(cache_path, name + '.npy'),
+                           mmap_mode='r')
+        self.events = _EventList(load('events'), load('event_offsets'))
+        self.coords = load('coords')
+        self.coord_offsets = load('coord_offsets')
+        self.part_offsets = load('part_offsets')
+        self.event_part_offsets = load('event_part_offsets')
+        self.bboxes = load('bboxes')
+        self.mags = load('mags')
+
+    def __len__(self):
+        return len(self.events)
+
+    def __getitem__(self, key):
+        if key == 'events':
+            return self.events
+        return self._meta[key]
+
+    def __contains__(self, key):
+        return key == 'events' or key in self._meta
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+    def keys(self):
+        return ['events'] + list(self._meta.keys())
+
+    def get_coords(self, i):
+        """
+        Get the rupture coordinates of an event (see get_event_coords).
+
+        Args:
+            i (int): Index of the event.
+
+        Returns:
+            array: Array with shape (n, 3) of longitude, latitude, and depth.
+
+        """
+        return self.coords[self.coord_offsets[i]:self.coord_offsets[i + 1]]
+
+    def get_parts(self, i):
+        """
+        Get the rupture coordinates of an event, split into their parts (see
+        get_event_parts).
+
+        Args:
+            i (int): Index of the event.
+
+        Returns:
+            list: List of arrays with shape (n, 3) of longitude, latitude,
+            and depth. The arrays are writable copies, not views of the
+            read-only cache, so they can be passed to compiled projection
+            functions.
+
+        """
+        pstart = self.event_part_offsets[i]
+        pstop = self.event_part_offsets[i + 1]
+        offsets = self.part_offsets[pstart:pstop + 1]
+        return [np.array(self.coords[offsets[j]:offsets[j + 1]])
+                for j in range(len(offsets) - 1)]
+
+
+def prune_rupture_set_caches(cache_dir, rfile, keep):
+    """
+    Remove the caches of a rupture set file other than the current one
+    (i.e., those written for earlier contents of the file), and the caches
+    with another layout version. Temporary directories of caches that are
+    being written are left alone.
+
+    Args:
+        cache_dir (str): Directory that holds the caches.
+        rfile (str): Rupture set JSON file.
+        keep (str): Name of the current cache of the file.
+
+    """
+    rfile = os.path.abspath(rfile)
+    suffix = '.v%i' % CACHE_VERSION
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        if name == keep or '.tmp' in name or not os.path.isdir(path):
+            continue
+        if not name.endswith(suffix):
+            shutil.rmtree(path, ignore_errors=True)
+            continue
+        try:
+            with open(os.path.join(path, 'meta.json')) as f:
+                source_file = json.load(f).get('source_file')
+        except (OSError, ValueError):
+            continue
+        if source_file == rfile:
+            shutil.rmtree(path, ignore_errors=True)
+
+
+def load_rupture_set(rfile, cache_dir=None):
+    """
+    Load a rupture set file through its compiled cache. The cache is keyed by
+    the content hash of the file, so it is rebuilt if the file changes, and
+    the caches of earlier contents of the file are then removed. If the
+    cache cannot be written or read, the file is parsed with json.load.
+
+    Args:
+        rfile (str): Rupture set JSON file.
+        cache_dir (str): Directory that holds the caches; default from
+            get_cache_dir.
+
+    Returns:
+        RuptureSet or dict: The rupture set.
+
+    """
+    if cache_dir is None:
+        cache_dir = get_cache_dir()
+    name = '%s.v%i' % (hash_file(rfile), CACHE_VERSION)
+    cache_path = os.path.join(cache_dir, name)
+    rupts = None
+    try:
+        if not os.path.isfile(os.path.join(cache_path, 'meta.json')):
+            with open(rfile) as f:
+                rupts = json.load(f)
+            write_rupture_set_cache(rupts, cache_path, rfile=rfile)
+            prune_rupture_set_caches(cache_dir, rfile, name)
+        return RuptureSet(cache_path)
+    except Exception as e:
+        print('Could not use the rupture set cache in %s: %s'
+              % (cache_path, e))
+    if rupts is None:
+        with open(rfile) as f:
+            rupts = json.load(f)
+    return rupts
@@ -0,0 +1,330 @@
+import os
+import re
+import json
+import bisect
+
+import numpy as np
+
+from shapely.geometry import Point
+from shapely.geometry import LineString
+from shapely.geometry import Polygon
+
+from openquake.hazardlib.geo.utils import get_orthographic_projection
+
+from scenarios.rupture_set import RuptureSet
+from scenarios.rupture_set import load_rupture_set
+from scenarios.rupture_set import get_event_name
+from scenarios.rupture_set import get_event_mag
+from scenarios.rupture_set import get_event_parts
+
+INDEX_FILE = 'search_index.json'
+
+# Kilometers per degree of latitude
+DEG_KM = 111.195
+
+# Search indices that have been loaded in this process, keyed by the path of
+# the compiled rupture set.
+_index_cache = {}
+
+
+def tokenize(text):
+    """
+    Split text into lower case alphanumeric tokens.
+
+    Args:
+        text (str): The text.
+
+    Returns:
+        list: The tokens.
+
+    """
+    return re.findall(r'[a-z0-9]+', text.lower())
+
+
+class SearchIndex(object):
+    """
+    Search index over the names and magnitudes of the events of a rupture
+    set. The names are joined into one string so that substring searches run
+    in a single pass, and the tokens of the names are kept in an inverted
+    index.
+    """
+
+    def __init__(self, names, mags, tokens=None):
+        self.names = list(names)
+        self.mags = np.asarray(mags, dtype=float)
+        self._text = '\n'.join(self.names)
+        self._starts = []
+        start = 0
+        for name in self.names:
+            self._starts.append(start)
+            start += len(name) + 1
+        if tokens is None:
+            tokens = {}
+            for i, name in enumerate(self.names):
+                for tok in sorted(set(tokenize(name))):
+                    tokens.setdefault(tok, []).append(i)
+        self.tokens = tokens
+
+    @classmethod
+    def fromRuptureSet(cls, rupts):
+        """
+        Build the search index of a rupture set, reading it from (or writing
+        it to) the compiled rupture set cache if there is one.
+
+        Args:
+            rupts (RuptureSet or dict): The rupture set.
+
+        Returns:
+            SearchIndex: The search index.
+
+        """
+        if not isinstance(rupts, RuptureSet):
+            fmt = rupts['format']
+            return cls([get_event_name(e, fmt) for e in rupts['events']],
+                       [get_event_mag(e, fmt) for e in rupts['events']])
+
+        if rupts.cache_path in _index_cache:
+            return _index_cache[rupts.cache_path]
+
+        ifile = os.path.join(rupts.cache_path, INDEX_FILE)
+        if os.path.isfile(ifile):
+            with open(ifile) as f:
+                tokens = json.load(f)['tokens']
+            index = cls(rupts.names, rupts.mags, tokens)
+        else:
+            index = cls(rupts.names, rupts.mags)
+            tmpfile = '%s.tmp%i' % (ifile, os.getpid())
+            try:
+                with open(tmpfile, 'w') as f:
+                    json.dump({'tokens': index.tokens}, f)
+                os.rename(tmpfile, ifile)
+            except OSError:
+                pass
+        _index_cache[rupts.cache_path] = index
+        return index
+
+    def search(self, pattern=None, tokens=None, regex=None, mag_min=None,
+               mag_max=None):
+        """
+        Find the events that match all of the given criteria.
+
+        Args:
+            pattern (str): Substring of the name (case sensitive).
+            tokens (str): Words that must all be in the name (case
+                insensitive), e.g., 'san andreas'.
+            regex (str): Regular expression to search for in the name.
+            mag_min (float): Minimum magnitude.
+            mag_max (float): Maximum magnitude.
+
+        Returns:
+            array: Sorted indices of the matching events.
+
+        """
+        keep = np.ones(len(self.names), dtype=bool)
+
+        if pattern is not None:
+            found = np.zeros_like(keep)
+            # The names don't have newlines, so a match of a pattern without
+            # newlines can't span two names
+            if '\n' in pattern:
+                pos = -1
+            else:
+                pos = self._text.find(pattern)
+            while pos >= 0:
+                i = bisect.bisect_right(self._starts, pos) - 1
+                found[i] = True
+                # Continue with the next name
+                if i + 1 < len(self._starts):
+                    pos = self._text.find(pattern, self._starts[i + 1])
+                else:
+                    pos = -1
+            keep &= found
+
+        if tokens is not None:
+            for tok in tokenize(tokens):
+                found = np.zeros_like(keep)
+                found[self.tokens.get(tok, [])] = True
+                keep &= found
+
+        if regex is not None:
+            prog = re.compile(regex)
+            found = np.array([prog.search(name) is not None
+                              for name in self.names], dtype=bool)
+            keep &= found
+
+        if mag_min is not None:
+            keep &= self.mags >= mag_min
+        if mag_max is not None:
+            keep &= self.mags <= mag_max
+
+        return np.where(keep)[0]
+
+
+def search_ruptures(rfile, pattern=None, tokens=None, regex=None,
+                    mag_min=None, mag_max=None):
+    """
+    Find the events in a rupture set file that match all of the given
+    criteria; see SearchIndex.search. The index is built once per rupture set
+    file and stored with its compiled cache (see load_rupture_set).
+
+    Args:
+        rfile (str): Rupture set JSON file.
+        pattern (str): Substring of the name (case sensitive).
+        tokens (str): Words that must all be in the name (case insensitive).
+        regex (str): Regular expression to search for in the name.
+        mag_min (float): Minimum magnitude.
+        mag_max (float): Maximum magnitude.
+
+    Returns:
+        tuple: Array of the indices and array of the names of the matching
+        events.
+
+    """
+    index = SearchIndex.fromRuptureSet(load_rupture_set(rfile))
+    ind = index.search(pattern=pattern, tokens=tokens, regex=regex,
+                       mag_min=mag_min, mag_max=mag_max)
+    return ind, np.array(index.names)[ind]
+
+
+def get_event_geometries(parts, fmt, proj):
+    """
+    Get the geometry of the rupture of an event in a rupture set in a
+    projection: the traces of UCERF and NSHMP ruptures are lines, and the
+    ruptures in NSHMP subduction (top and bottom edges) and ShakeMap
+    (polygons) formats are polygons, i.e., their surface projection.
+
+    Note that the UCERF and NSHMP geometries are only the traces, not the
+    surface projections of the dipping faults, because the rupture set
+    indices only keep the coordinates. Distances to them are distances to
+    the trace, which can exceed the Joyner-Boore distance on the hanging wall
+    side by up to the horizontal width of the fault (width * cos(dip)).
+
+    Args:
+        parts (list): The parts of the rupture coordinates (see
+            scenarios.rupture_set.get_event_parts).
+        fmt (str): Format of the rupture set file.
+        proj (function): Projection function (see
+            get_orthographic_projection).
+
+    Returns:
+        list: List of shapely geometries in projected coordinates.
+
+    """
+    fmt = fmt.lower()
+    xy = []
+    for p in parts:
+        x, y = proj(np.asarray(p[:, 0]), np.asarray(p[:, 1]))
+        xy.append(np.column_stack([x, y]))
+    if fmt == 'nshmp_sub' and len(xy) == 2:
+        xy = [np.concatenate([xy[0], xy[1][::-1]])]
+
+    geoms = []
+    for p in xy:
+        if len(p) == 1:
+            geoms.append(Point(p[0]))
+        elif len(p) == 2 or fmt not in ['nshmp_sub', 'shakemap']:
+            geoms.append(LineString(p))
+        else:
+            geoms.append(Polygon(p))
+    return geoms
+
+
+class SpatialIndex(object):
+    """
+    Spatial index over the ruptures of a rupture set for proximity queries.
+    Candidates are selected with the bounding boxes of the rupture
+    coordinates, and then the distance to each candidate is computed from its
+    geometry (see get_event_geometries); for UCERF and NSHMP ruptures this is
+    the distance to the trace.
+    """
+
+    def __init__(self, rupts):
+        self.format = rupts['format']
+        if isinstance(rupts, RuptureSet):
+            self.bboxes = rupts.bboxes
+            self._get_parts = rupts.get_parts
+        else:
+            parts = [get_event_parts(e, self.format)
+                     for e in rupts['events']]
+            self.bboxes = np.full((len(parts), 4), np.nan)
+            for i, ep in enumerate(parts):
+                if len(ep) > 0 and sum(len(p) for p in ep) > 0:
+                    c = np.concatenate(ep)
+                    self.bboxes[i] = [c[:, 0].min(), c[:, 1].min(),
+                                      c[:, 0].max(), c[:, 1].max()]
+            self._get_parts = parts.__getitem__
+
+    def find_near(self, lon, lat, distance):
+        """
+        Find the ruptures within a distance of a point. The distances are
+        computed in an orthographic projection centered near the point, so
+        they are accurate for distances of up to a few hundred km. For UCERF
+        and NSHMP ruptures they are distances to the trace, so pad the
+        distance by the horizontal width of the faults to also find the
+        ruptures whose surface projection (but not trace) is within it.
+
+        Args:
+            lon (float): Longitude of the point.
+            lat (float): Latitude of the point.
+            distance (float): Distance in km.
+
+        Returns:
+            tuple: Array of the indices of the ruptures, and array of their
+            distances in km; sorted by index.
+
+        """
+        dlat = distance / DEG_KM
+        coslat = np.cos(np.radians(min(abs(lat) + dlat, 89.0)))
+        dlon = min(dlat / coslat, 180.0)
+        b = self.bboxes
+        cand = np.zeros(len(b), dtype=bool)
+        with np.errstate(invalid='ignore'):
+            # The query box is also shifted by 360 degrees so that it matches
+            # the bounding boxes on the other side of the antimeridian
+            for shift in (-360.0, 0.0, 360.0):
+                cand |= (b[:, 0] <= lon + shift + dlon) & \
+                        (b[:, 2] >= lon + shift - dlon) & \
+                        (b[:, 1] <= lat + dlat) & (b[:, 3] >= lat - dlat)
+        cand = np.where(cand)[0]
+
+        # The projection is centered on the middle of the great circle arc
+        # between the corners of the box, which is not exactly at the point
+        proj = get_orthographic_projection(lon - 4, lon + 4, lat + 4, lat - 4)
+        x0, y0 = proj(np.array([lon]), np.array([lat]))
+        origin = Point(x0[0], y0[0])
+        ind = []
+        dist = []
+        for i in cand:
+            geoms = get_event_geometries(self._get_parts(i), self.format, proj)
+            d = min(g.distance(origin) for g in geoms)
+            if d <= distance:
+                ind.append(i)
+                dist.append(d)
+        return np.array(ind, dtype=int), np.array(dist)
+
+
+def search_near(rfile, lon, lat, distance):
+    """
+    Find the ruptures in a rupture set file within a distance of a point; see
+    SpatialIndex.find_near. The bounding boxes are stored with the compiled
+    cache of the rupture set (see load_rupture_set), so the ruptures do not
+    need to be parsed or constructed.
+
+    Args:
+        rfile (str): Rupture set JSON file.
+        lon (float): Longitude of the point.
+        lat (float): Latitude of the point.
+        distance (float): Distance in km.
+
+    Returns:
+        tuple: Array of the indices, array of the distances in km, and array
+        of the names of the ruptures.
+
+    """
+    rupts = load_rupture_set(rfile)
+    ind, dist = SpatialIndex(rupts).find_near(lon, lat, distance)
+    if isinstance(rupts, RuptureSet):
+        names = rupts.names
+    else:
+        names = [get_event_name(e, rupts['format']) for e in rupts['events']]
+    return ind, dist, np.array(names)[ind]
@@ -1,7 +1,6 @@
 
 import os
 import json
-import copy
 import shutil
 import ast
 
@@ -11,20 +10,33 @@ from configobj import ConfigObj
 
 from shapely.geometry import Polygon
 from shapely.geometry import Point
+from shapely.prepared import prep
+try:
+    from shapely import contains_xy
+except ImportError:
+    # shapely < 2.0
+    from shapely.vectorized import contains as contains_xy
 
 import openquake.hazardlib.geo as geo
-from openquake.hazardlib.geo.utils import get_orthographic_projection
 
 from mapio.gmt import GMTGrid
 from impactutils.io.cmd import get_command_output
 from impactutils.vectorutils.ecef import ecef2latlon
-from impactutils.vectorutils.vector import Vector
+from impactutils.vectorutils.ecef import latlon2ecef
 from impactutils.time.ancient_time import HistoricTime as ShakeDateTime
 
 from shakelib.rupture.origin import read_event_file
+from shakelib.rupture.point_rupture import PointRupture
 from shakelib.rupture.edge_rupture import EdgeRupture
 from shakelib.rupture.quad_rupture import QuadRupture
 
+from scenarios.search import search_ruptures
+from scenarios.search import search_near
+
+# Boundary of the US stable tectonic region (see get_stable_region); it is
+# loaded the first time it is needed.
+_stable_region = None
+
 
 def set_shakehome(path):
     """
@@ -83,211 +95,480 @@ def set_gmpe(gmpe):
     return old_gmpe
 
 
-def find_rupture(pattern, file):
+def set_cache_dir(path):
+    """
+    Helper function for managing the rupture set cache directory in the
+    scenario conf file (see scenarios.rupture_set.get_cache_dir).
+
+    Args:
+        path (str): Path to the cache directory; None for the default.
+
+    Returns:
+        str: Previous cache directory (None for the default), which can be
+             used to restor to previous config.
+    """
+    conf_file = os.path.join(os.path.expanduser('~'), 'scenarios.conf')
+    config = ConfigObj(conf_file)
+    old_cache_dir = config['system'].get('cache_dir')
+    if path is None:
+        config['system'].pop('cache_dir', None)
+    else:
+        config['system']['cache_dir'] = path
+    config.write()
+    return old_cache_dir
+
+
+def find_rupture(pattern, file, tokens=None, regex=None, mag_min=None,
+                 mag_max=None):
     """
     Convenience method for finding name and index of a rupture based on pattern
-    matching the description.
+    matching the description. This uses a search index that is built once
+    for each rupture set file (see scenarios.search), and the optional
+    arguments can be used to narrow down the search.
 
     Args:
-        pattern (str): Pattern to search for.
+        pattern (str): Pattern to search for; None to match all names.
         file (str): JSON rupture file to look in.
+        tokens (str): Words that must all be in the name (case insensitive).
+        regex (str): Regular expression to search for in the name.
+        mag_min (float): Minimum magnitude.
+        mag_max (float): Maximum magnitude.
 
     Return:
         tuple: List of descriptions and list of indices.
 
     """
-    with open(file) as f:
-        rupts = json.load(f)
+    ind, result = search_ruptures(file, pattern=pattern, tokens=tokens,
+                                  regex=regex, mag_min=mag_min,
+                                  mag_max=mag_max)
 
-    # The key for the search is different for UCERF3 than other
-    # files:
-    if rupts['name'] == '2014 NSHMP Determinisitc Event Set':
-        skey = 'name'
-    else:
-        skey = 'desc'
+    for i in range(len(ind)):
+        print('%i: %s' % (ind[i], result[i]))
+
+    return ind, result
+
+
+def find_ruptures_near(lon, lat, distance, file):
+    """
+    Convenience method for finding the ruptures in a rupture set that come
+    within a distance of a point, e.g., for selecting the indices to pass to
+    mkinputdir. This does not construct the ruptures; the distances are to
+    the rupture traces (or to the surface projection for ruptures defined by
+    their edges or polygons), see scenarios.search.
+
+    Args:
+        lon (float): Longitude of the point.
+        lat (float): Latitude of the point.
+        distance (float): Distance in km.
+        file (str): JSON rupture file to look in.
 
-    desc = [r[skey] for r in rupts['events']]
+    Return:
+        tuple: Array of indices and array of distances (km).
 
-    ind = np.where(list(map(lambda x: pattern in str(x), desc)))[0]
-    result = np.array(desc)[ind]
+    """
+    ind, dist, result = search_near(file, lon, lat, distance)
 
     for i in range(len(ind)):
-        print('%i: %s' % (ind[i], result[i]))
+        print('%i: %s (%.1f km)' % (ind[i], result[i], dist[i]))
 
-    return ind, result
+    return ind, dist
 
 
-def get_hypo(edges, args):
+def get_hypo_position(dirind):
     """
+    Get the relative position of the hypocenter on the rupture for a
+    directivity index.
+
     Args:
-        edges (list): A list of two lists of points; the first list corresponds
-            to the top edge and the second is the bottom edge.
-        args (ArgumentParser): argparse object.
+        dirind (int): Directivity; -1 for no directivity; 0 and 2 are the two
+            opposing unilateral directions, 1 is for bilateral.
 
     Returns:
-        tuple: Hypocenter (lat, lon depth).
+        tuple: Along strike and along dip distance (0-1).
 
     """
-    top = copy.deepcopy(edges[0])
-    bot = copy.deepcopy(edges[1])
-
-    # Along strike and along dip distance (0-1)
     # NOTE: This could also be made a function of mechanism
-    if args.dirind == -1:
+    if dirind == -1:
         # no directivity
         dxp = 0.5  # strike
         dyp = 0.6  # dip
-    elif args.dirind == 0:
+    elif dirind == 0:
         # first unilateral
         dxp = 0.05  # strike
         dyp = 0.6  # dip
-    elif args.dirind == 2:
+    elif dirind == 2:
         # second unilateral
         dxp = 0.95  # strike
         dyp = 0.6  # dip
-    elif args.dirind == 1:
+    elif dirind == 1:
         # bilateral
         dxp = 0.5  # strike
         dyp = 0.6  # dip
+    return dxp, dyp
+
+
+def _edge_to_array(edge):
+    """
+    Convert an edge to an array of longitude, latitude, and depth.
+
+    Args:
+        edge (list or array): List of points, or array with shape (n, 3).
+
+    Returns:
+        array: Array with shape (n, 3).
+
+    """
+    if isinstance(edge, np.ndarray):
+        return edge
+    return np.array([[p.longitude, p.latitude, p.depth] for p in edge])
+
 
-    # Convert to ECEF
-    topxy = [Vector.fromPoint(geo.point.Point(p.longitude,
-                                              p.latitude,
-                                              p.depth))
-             for p in top]
-    botxy = [Vector.fromPoint(geo.point.Point(p.longitude,
-                                              p.latitude,
-                                              p.depth))
-             for p in bot]
-
-    # Compute distances along edges for each vertex
-    t0 = topxy[0]
-    b0 = botxy[0]
-    topdist = np.array([t0.distance(p) for p in topxy])
-    botdist = np.array([b0.distance(p) for p in botxy])
-
-    # Normalize distance from 0 to 1
-    topdist = topdist / np.max(topdist)
-    botdist = botdist / np.max(botdist)
-
-    #---------------------------------------------------------------------------
-    # Find points of surrounding quad
-    #---------------------------------------------------------------------------
-    tix0 = np.amax(np.where(topdist < dxp))
-    tix1 = np.amin(np.where(topdist > dxp))
-    bix0 = np.amax(np.where(botdist < dxp))
-    bix1 = np.amin(np.where(botdist > dxp))
-
-    # top left
-    pp0 = topxy[tix0]
-
-    # top right
-    pp1 = topxy[tix1]
-
-    # bottom right
-    pp2 = botxy[bix0]
-
-    # bottom left
-    pp3 = botxy[bix1]
-
-    # How far from pp0 to pp1, and pp2 to pp3?
-    dxt = (dxp - topdist[tix0]) / (topdist[tix1] - topdist[tix0])
-    dxb = (dxp - botdist[bix0]) / (botdist[bix1] - botdist[bix0])
-
-    mp0 = pp0 + (pp1 - pp0) * dxt
-    mp1 = pp3 + (pp2 - pp3) * dxb
-    rp = mp0 + (mp1 - mp0) * dyp
-    hlat, hlon, hdepth = ecef2latlon(rp.x, rp.y, rp.z)
+def _quads_to_array(quads):
+    """
+    Convert quadrilaterals to an array of their corners.
 
+    Args:
+        quads (list or array): List of quads (lists of points), or array
+            with shape (n, 4, 3).
+
+    Returns:
+        array: Array with shape (n, 4, 3) of longitude, latitude, and depth.
+
+    """
+    if isinstance(quads, np.ndarray):
+        return quads
+    return np.array([[(p.longitude, p.latitude, p.depth) for p in quad[:4]]
+                     for quad in quads], dtype=float).reshape(-1, 4, 3)
+
+
+def get_hypos(edges, dxp, dyp):
+    """
+    Place hypocenters on many ruptures, and/or at many positions on each
+    rupture, at once. The edges are converted to ECEF coordinates with
+    array operations, and the hypocenter is interpolated between the
+    vertices of the top and bottom edges that surround the along strike
+    position (by distance from the first vertex), and then down dip.
+
+    Args:
+        edges (list): List of the edges of each rupture; the edges of a
+            rupture are a list of the top and bottom edge, each of which is a
+            list of points or an array of longitude, latitude, and depth (see
+            get_rupture_edges).
+        dxp (float or array): Along strike distance (0-1).
+        dyp (float or array): Along dip distance (0-1); must have the same
+            length as dxp.
+
+    Returns:
+        tuple: Arrays of the hypocenter latitude, longitude, and depth, with
+        shape (number of ruptures, number of positions).
+
+    """
+    dxp = np.atleast_1d(np.asarray(dxp, dtype=float))
+    dyp = np.atleast_1d(np.asarray(dyp, dtype=float))
+    npos = len(dxp)
+    nrup = len(edges)
+    hx = np.zeros((nrup, npos))
+    hy = np.zeros((nrup, npos))
+    hz = np.zeros((nrup, npos))
+
+    for i in range(nrup):
+        top = _edge_to_array(edges[i][0])
+        bot = _edge_to_array(edges[i][1])
+
+        # Convert to ECEF
+        topxy = np.column_stack(latlon2ecef(top[:, 1], top[:, 0], top[:, 2]))
+        botxy = np.column_stack(latlon2ecef(bot[:, 1], bot[:, 0], bot[:, 2]))
+
+        # Distances along edges for each vertex, normalized from 0 to 1
+        topdist = np.sqrt(np.sum((topxy - topxy[0])**2, axis=1))
+        botdist = np.sqrt(np.sum((botxy - botxy[0])**2, axis=1))
+        topdist = topdist / np.max(topdist)
+        botdist = botdist / np.max(botdist)
+
+        #-----------------------------------------------------------------------
+        # Find points of surrounding quad: the last vertex before and the
+        # first vertex after each along strike position
+        #-----------------------------------------------------------------------
+        tlt = topdist[None, :] < dxp[:, None]
+        tgt = topdist[None, :] > dxp[:, None]
+        blt = botdist[None, :] < dxp[:, None]
+        bgt = botdist[None, :] > dxp[:, None]
+        if not (tlt.any(axis=1) & tgt.any(axis=1) &
+                blt.any(axis=1) & bgt.any(axis=1)).all():
+            raise ValueError('Along strike position is not inside the '
+                             'rupture edges.')
+        tix0 = len(topdist) - 1 - np.argmax(tlt[:, ::-1], axis=1)
+        tix1 = np.argmax(tgt, axis=1)
+        bix0 = len(botdist) - 1 - np.argmax(blt[:, ::-1], axis=1)
+        bix1 = np.argmax(bgt, axis=1)
+
+        # top left, top right, bottom right, bottom left
+        pp0 = topxy[tix0]
+        pp1 = topxy[tix1]
+        pp2 = botxy[bix0]
+        pp3 = botxy[bix1]
+
+        # How far from pp0 to pp1, and pp2 to pp3?
+        dxt = (dxp - topdist[tix0]) / (topdist[tix1] - topdist[tix0])
+        dxb = (dxp - botdist[bix0]) / (botdist[bix1] - botdist[bix0])
+
+        mp0 = pp0 + (pp1 - pp0) * dxt[:, None]
+        mp1 = pp3 + (pp2 - pp3) * dxb[:, None]
+        rp = mp0 + (mp1 - mp0) * dyp[:, None]
+        hx[i], hy[i], hz[i] = rp[:, 0], rp[:, 1], rp[:, 2]
+
+    hlat, hlon, hdepth = ecef2latlon(hx, hy, hz)
     return hlat, hlon, hdepth
 
 
-def get_extent(origin, rupture=None):
+def get_hypo(edges, args):
     """
-    Method to compute map extent from rupture.
+    Args:
+        edges (list): A list of two lists of points; the first list corresponds
+            to the top edge and the second is the bottom edge. The edges can
+            also be arrays of longitude, latitude, and depth.
+        args (ArgumentParser): argparse object.
+
+    Returns:
+        tuple: Hypocenter (lat, lon depth).
+
+    """
+    # Along strike and along dip distance (0-1)
+    dxp, dyp = get_hypo_position(args.dirind)
+    hlat, hlon, hdepth = get_hypos([edges], dxp, dyp)
+    return hlat[0, 0], hlon[0, 0], hdepth[0, 0]
+
+
+def _get_projection_center(clons, clats):
+    """
+    Get the centers of the orthographic projections of get_extent for many
+    events at once. This is the middle point of the 8 degree box around each
+    center, as in openquake's get_orthographic_projection.
 
     Args:
-        origin (Origin): A ShakeMap Origin instance.
-        rupture (Rupture): A ShakeMap Rupture instance (optional).
+        clons (array): Longitudes of the centers of the events.
+        clats (array): Latitudes of the centers of the events.
 
     Returns:
-        tuple: lonmin, lonmax, latmin, latmax.
+        tuple: Arrays of the longitudes and latitudes of the projection
+        centers.
 
     """
+    west = clons - 4
+    east = clons + 4
+    north = clats + 4
+    south = clats - 4
+    dist = geo.geodetic.geodetic_distance(west, north, east, south)
+    azimuth = geo.geodetic.azimuth(west, north, east, south)
+    return geo.geodetic.point_at(west, north, azimuth, dist / 2.0)
 
-    # Is there a rupture?
-    if isinstance(rupture, (QuadRupture, EdgeRupture)):
-        lats = rupture.lats
-        lons = rupture.lons
 
-        # Remove nans
-        lons = lons[~np.isnan(lons)]
-        lats = lats[~np.isnan(lats)]
+def _orthographic(lon0, lat0, x, y, reverse=False):
+    """
+    Orthographic projection with different centers for different points;
+    this is the projection of openquake's get_orthographic_projection, but
+    it broadcasts over the centers.
 
-        clat = 0.5 * (np.nanmax(lats) + np.nanmin(lats))
-        clon = 0.5 * (np.nanmax(lons) + np.nanmin(lons))
-    else:
-        clat = origin.lat
-        clon = origin.lon
+    Args:
+        lon0 (array): Longitudes of the projection centers.
+        lat0 (array): Latitudes of the projection centers.
+        x (array): Longitudes of the points, or abscissae in km for the
+            reverse projection.
+        y (array): Latitudes of the points, or ordinates in km for the
+            reverse projection.
+        reverse (bool): Project from km back to longitude and latitude?
 
-    mag = origin.mag
+    Returns:
+        tuple: Arrays of abscissae and ordinates in km, or longitudes and
+        latitudes for the reverse projection.
 
-    # Is this a stable or active tectonic event?
-    # (this could be made an attribute of the ShakeMap Origin class)
-    hypo = origin.getHypo()
-    stable = is_stable(hypo.longitude, hypo.latitude)
+    """
+    lambda0 = np.radians(lon0)
+    phi0 = np.radians(lat0)
+    cos_phi0 = np.cos(phi0)
+    sin_phi0 = np.sin(phi0)
+    radius = geo.geodetic.EARTH_RADIUS
+    if not reverse:
+        lambdas = np.radians(x) - lambda0
+        phis = np.radians(y)
+        cos_phis = np.cos(phis)
+        xx = cos_phis * np.sin(lambdas)
+        yy = cos_phi0 * np.sin(phis) - sin_phi0 * cos_phis * np.cos(lambdas)
+        return xx * radius, yy * radius
+    xx = x / radius
+    yy = y / radius
+    cos_c = np.sqrt(1 - (xx**2 + yy**2))
+    phis = np.arcsin(cos_c * sin_phi0 + yy * cos_phi0)
+    lambdas = np.arctan2(xx, cos_phi0 * cos_c - yy * sin_phi0)
+    lons = np.degrees(lambda0 + lambdas)
+    lats = np.degrees(phis)
+    lons = np.where(lons >= 180., lons - 360., lons)
+    lons = np.where(lons <= -180., lons + 360., lons)
+    return lons, lats
+
+
+def get_extents(lons, lats, mags, rupture_coords=None):
+    """
+    Compute the map extents of many events at once. The results are the same
+    as from get_extent, but the tectonic region lookup, the distance
+    polynomials, and the projections are evaluated for all of the events
+    together.
 
-    if stable is False:
-        if mag < 6.48:
-            mindist_km = 100.
-        else:
-            mindist_km = 27.24 * mag**2 - 250.4 * mag + 579.1
-    else:
-        if mag < 6.10:
-            mindist_km = 100.
+    Args:
+        lons (array): Longitudes of the hypocenters.
+        lats (array): Latitudes of the hypocenters.
+        mags (array): Magnitudes.
+        rupture_coords (list): Optional list with an array for each event,
+            with the longitudes and latitudes of the rupture coordinates in
+            the first two columns (e.g., from RuptureSet.get_coords), or None
+            if the event does not have a rupture.
+
+    Returns:
+        tuple: Arrays of lonmin, lonmax, latmin, latmax.
+
+    """
+    lons = np.atleast_1d(np.asarray(lons, dtype=float))
+    lats = np.atleast_1d(np.asarray(lats, dtype=float))
+    mags = np.atleast_1d(np.asarray(mags, dtype=float))
+    nev = len(lons)
+    if rupture_coords is None:
+        rupture_coords = [None] * nev
+
+    # Rupture coordinates, padded with nans; the events without a rupture
+    # only have the hypocenter
+    npts = max([len(c) for c in rupture_coords if c is not None] + [1])
+    rlons = np.full((nev, npts), np.nan)
+    rlats = np.full((nev, npts), np.nan)
+    for i, c in enumerate(rupture_coords):
+        if c is not None and len(c) > 0:
+            c = np.asarray(c, dtype=float)
+            rlons[i, :len(c)] = c[:, 0]
+            rlats[i, :len(c)] = c[:, 1]
         else:
-            mindist_km = 63.4 * mag**2 - 465.4 * mag + 581.3
+            rlons[i, 0] = lons[i]
+            rlats[i, 0] = lats[i]
+    clons = 0.5 * (np.nanmax(rlons, axis=1) + np.nanmin(rlons, axis=1))
+    clats = 0.5 * (np.nanmax(rlats, axis=1) + np.nanmin(rlats, axis=1))
+
+    stable = is_stable(lons, lats)
+    mindist_km = np.where(
+        stable,
+        np.where(mags < 6.10, 100., 63.4 * mags**2 - 465.4 * mags + 581.3),
+        np.where(mags < 6.48, 100., 27.24 * mags**2 - 250.4 * mags + 579.1))
 
     # Apply an upper limit on extent. This should only matter for large
     # magnitudes (> ~8.25) in stable tectonic environments.
-    if mindist_km > 1000.:
-        mindist_km = 1000.
+    mindist_km = np.minimum(mindist_km, 1000.)
 
     # Projection
-    proj = get_orthographic_projection(clon - 4, clon + 4, clat + 4, clat - 4)
-    if isinstance(rupture, (QuadRupture, EdgeRupture)):
-        ruptx, rupty = proj(lons, lats)
-    else:
-        ruptx, rupty = proj(clon, clat)
+    lon0, lat0 = _get_projection_center(clons, clats)
+    ruptx, rupty = _orthographic(lon0[:, None], lat0[:, None], rlons, rlats)
 
-    xmin = np.nanmin(ruptx) - mindist_km
-    ymin = np.nanmin(rupty) - mindist_km
-    xmax = np.nanmax(ruptx) + mindist_km
-    ymax = np.nanmax(rupty) + mindist_km
+    xmin = np.nanmin(ruptx, axis=1) - mindist_km
+    ymin = np.nanmin(rupty, axis=1) - mindist_km
+    xmax = np.nanmax(ruptx, axis=1) + mindist_km
+    ymax = np.nanmax(rupty, axis=1) + mindist_km
 
     # Put a limit on range of aspect ratio
     dx = xmax - xmin
     dy = ymax - ymin
     ar = dy / dx
-    if ar > 1.25:
-        # Inflate x
-        dx_target = dy / 1.25
-        ddx = dx_target - dx
-        xmax = xmax + ddx / 2
-        xmin = xmin - ddx / 2
-    if ar < 0.6:
-        # inflate y
-        dy_target = dx * 0.6
-        ddy = dy_target - dy
-        ymax = ymax + ddy / 2
-        ymin = ymin - ddy / 2
-
-    lonmin, latmin = proj(np.array([xmin]), np.array([ymin]), reverse=True)
-    lonmax, latmax = proj(np.array([xmax]), np.array([ymax]), reverse=True)
+    # Inflate x
+    ddx = np.where(ar > 1.25, dy / 1.25 - dx, 0.)
+    xmax = xmax + ddx / 2
+    xmin = xmin - ddx / 2
+    # Inflate y
+    ddy = np.where(ar < 0.6, dx * 0.6 - dy, 0.)
+    ymax = ymax + ddy / 2
+    ymin = ymin - ddy / 2
+
+    lonmin, latmin = _orthographic(lon0, lat0, xmin, ymin, reverse=True)
+    lonmax, latmax = _orthographic(lon0, lat0, xmax, ymax, reverse=True)
 
     return lonmin, lonmax, latmin, latmax
 
 
+def get_extent(origin, rupture=None):
+    """
+    Method to compute map extent from rupture.
+
+    Args:
+        origin (Origin): A ShakeMap Origin instance.
+        rupture (Rupture): A ShakeMap Rupture instance (optional).
+
+    Returns:
+        tuple: lonmin, lonmax, latmin, latmax.
+
+    """
+
+    # Is there a rupture?
+    if isinstance(rupture, (QuadRupture, EdgeRupture)):
+        rupture_coords = [np.column_stack([rupture.lons, rupture.lats])]
+    else:
+        rupture_coords = None
+
+    # Is this a stable or active tectonic event?
+    # (this could be made an attribute of the ShakeMap Origin class)
+    hypo = origin.getHypo()
+    return get_extents([hypo.longitude], [hypo.latitude], [origin.mag],
+                       rupture_coords)
+
+
+def estimate_cost(sampledict, rupt, ngmpe=1):
+    """
+    Estimate the relative cost of running mkscenariogrids for an event. This
+    is only meant for ordering events (e.g., longest first), not for
+    predicting runtimes.
+
+    The cost is ncell * (ngmpe + nquad). Every grid cell is evaluated for
+    each of the ngmpe GMPEs, and the distances of every cell are computed to
+    each of the nquad quadrilaterals of the rupture, so both terms are linear
+    in the number of cells. They are weighted equally because one GMPE
+    evaluation and the distances to one quadrilateral cost about the same per
+    cell.
+
+    Args:
+        sampledict (GeoDict): Geodictionary of the event grid (e.g., from
+            scenarios.grids.get_grid_geodict).
+        rupt (Rupture): The rupture of the event.
+        ngmpe (int): Number of GMPEs in the GMPE set.
+
+    Returns:
+        float: Relative cost.
+
+    """
+    if isinstance(rupt, PointRupture):
+        nquad = 1
+    else:
+        nquad = len(rupt.getQuadrilaterals())
+    ncell = sampledict.nx * sampledict.ny
+    return float(ncell * (ngmpe + nquad))
+
+
+def get_stable_region():
+    """
+    Get the boundary of the US stable tectonic region. It is read from
+    scenarios/data/nshmp_stable.json the first time and then kept for the
+    rest of the process.
+
+    Returns:
+        tuple: The region as a shapely Polygon, and prepared for fast
+        predicates.
+
+    """
+    global _stable_region
+    if _stable_region is None:
+        here = os.path.dirname(os.path.abspath(__file__))
+        pfile = os.path.join(here, 'data', 'nshmp_stable.json')
+        with open(pfile) as f:
+            coords = json.load(f)
+        tmp = [(float(x), float(y))
+               for x, y in zip(coords['lon'], coords['lat'])]
+        poly = Polygon(tmp)
+        _stable_region = (poly, prep(poly))
+    return _stable_region
+
+
 def is_stable(lon, lat):
     """
     Determine if point is located in the US stable tectonic region. Uses the
@@ -295,21 +576,21 @@ def is_stable(lon, lat):
     work outside of the US.
 
     Args:
-        lon (float): Lognitude.
-        lat (float): Latitude.
+        lon (float or array): Lognitude.
+        lat (float or array): Latitude.
 
     Returns:
-        bool: Is the point classified as tectonically stable.
+        bool or array: Is the point classified as tectonically stable. For
+        arrays of points, this is a boolean array (with the broadcast shape
+        of lon and lat).
 
     """
-    here = os.path.dirname(os.path.abspath(__file__))
-    pfile = os.path.join(here, 'data', 'nshmp_stable.json')
-    with open(pfile) as f:
-        coords = json.load(f)
-    tmp = [(float(x), float(y)) for x, y in zip(coords['lon'], coords['lat'])]
-    poly = Polygon(tmp)
-    p = Point((lon, lat))
-    return p.within(poly)
+    poly, prepared = get_stable_region()
+    if np.isscalar(lon) and np.isscalar(lat):
+        return bool(prepared.contains(Point((lon, lat))))
+    lon, lat = np.broadcast_arrays(np.asarray(lon, dtype=float),
+                                   np.asarray(lat, dtype=float))
+    return np.asarray(contains_xy(poly, lon, lat), dtype=bool)
 
 
 def rake_to_type(rake):
@@ -372,23 +653,22 @@ def strike_to_quadrant(strike):
     return q
 
 
-def get_event_id(event_name, mag, directivity, i_dir, quads, id=None):
+def get_event_ids(event_name, mag, directivity, i_dir, id=None):
     """
-    This is to sort out the event id, event source code, realization
-    description, and the quadrilateral that was selected for placing
-    the hypocenter on.
+    Get the event id and event source code. Unlike get_event_id, this does
+    not need the rupture, so it can be used to find the input directory of an
+    event before the rupture is built.
 
     Args:
         event_name (str): Event name/description.
         mag (float): Earthquake magnitude.
         directivity (bool): Is directivity applied?
         i_dir (int): Directivity orientation indicator. Valid values are 0, 1, 2.
-        quads (list): List of quadrilaterals describing the rupture.
         id (str): Optional event id. If None, then event id is constructed from
             event_name.
 
     Returns:
-        tuple: id_str, eventsourcecode, real_desc, selquad.
+        tuple: id_str, eventsourcecode.
     """
 
     event_legal = "".join(x for x in event_name if x.isalnum())
@@ -399,26 +679,67 @@ def get_event_id(event_name, mag, directivity, i_dir, quads, id=None):
     # PDL requrement: no ".", so replace with "p"
     mag_str = mag_str.replace('.', 'p')
 
+    if directivity:
+        dirtag = 'dir' + str(i_dir)
+        if id is None:
+            id_str = "%s_M%s_se~%s" % (event_legal[:20], mag_str, dirtag)
+        else:
+            if id[-3:] == '_se':
+                id_str = id
+            else:
+                id_str = "%s_M%s_se~%s" % (id[:20], mag_str, dirtag)
+        id_str = id_str.lower()
+    else:
+        if id is None:
+            id_str = "%s_M%s_se" % (event_legal[:20], mag_str)
+        else:
+            if id[-3:] == '_se':
+                id_str = id
+            else:
+                id_str = "%s_M%s_se" % (id[:20], mag_str)
+        id_str = id_str.lower()
+
+    if id is None:
+        eventsourcecode = "%s_M%s_se" % (event_legal[:20], mag_str)
+    else:
+        if id[-3:] == '_se':
+            eventsourcecode = id
+        else:
+            eventsourcecode = "%s_M%s_se" % (id[:20], mag_str)
+
+    eventsourcecode = eventsourcecode.lower()
+    return id_str, eventsourcecode
+
+
+def get_event_id(event_name, mag, directivity, i_dir, quads, id=None):
+    """
+    This is to sort out the event id, event source code, realization
+    description, and the quadrilateral that was selected for placing
+    the hypocenter on.
+
+    Args:
+        event_name (str): Event name/description.
+        mag (float): Earthquake magnitude.
+        directivity (bool): Is directivity applied?
+        i_dir (int): Directivity orientation indicator. Valid values are 0, 1, 2.
+        quads (list): List of quadrilaterals describing the rupture, or array
+            of their corners (see get_trace_corners).
+        id (str): Optional event id. If None, then event id is constructed from
+            event_name.
+
+    Returns:
+        tuple: id_str, eventsourcecode, real_desc, selquad.
+    """
+
     # Get an 'average strike' from first quad to mean of trace
     if quads is not None:
-        lat0 = [q[0].latitude for q in quads]
-        lon0 = [q[0].longitude for q in quads]
-        lat1 = [q[1].latitude for q in quads]
-        lon1 = [q[1].longitude for q in quads]
-        lat2 = [q[2].latitude for q in quads]
-        lon2 = [q[2].longitude for q in quads]
-        lat3 = [q[3].latitude for q in quads]
-        lon3 = [q[3].longitude for q in quads]
-        clat = np.mean(np.array([lat0, lat1, lat2, lat3]))
-        clon = np.mean(np.array([lon0, lon1, lon2, lon3]))
-        strike = geo.geodetic.azimuth(lon0[0], lat0[0], clon, clat)
+        corners = _quads_to_array(quads)
+        clat = np.mean(corners[:, :, 1])
+        clon = np.mean(corners[:, :, 0])
+        strike = geo.geodetic.azimuth(corners[0, 0, 0], corners[0, 0, 1],
+                                      clon, clat)
         squadrant = strike_to_quadrant(strike)
 
-        if directivity:
-            dirtag = 'dir' + str(i_dir)
-        else:
-            dirtag = ''
-
         if (i_dir == 0) and (directivity):
             if squadrant == 1:
                 ddes = "Northern directivity"
@@ -440,107 +761,200 @@ def get_event_id(event_name, mag, directivity, i_dir, quads, id=None):
             if squadrant == 4:
                 ddes = "Eastern directivity"
 
+    id_str, eventsourcecode = get_event_ids(event_name, mag, directivity,
+                                            i_dir, id=id)
     if directivity:
-        if id is None:
-            id_str = "%s_M%s_se~%s" % (event_legal[:20], mag_str, dirtag)
-        else:
-            if id[-3:] == '_se':
-                id_str = id
-            else:
-                id_str = "%s_M%s_se~%s" % (id[:20], mag_str, dirtag)
-        id_str = id_str.lower()
         real_desc = ddes
     else:
-        if id is None:
-            id_str = "%s_M%s_se" % (event_legal[:20], mag_str)
-        else:
-            if id[-3:] == '_se':
-                id_str = id
-            else:
-                id_str = "%s_M%s_se" % (id[:20], mag_str)
-        id_str = id_str.lower()
         real_desc = 'Median ground motions'
-
-    if id is None:
-        eventsourcecode = "%s_M%s_se" % (event_legal[:20], mag_str)
-    else:
-        if id[-3:] == '_se':
-            eventsourcecode = id
-        else:
-            eventsourcecode = "%s_M%s_se" % (id[:20], mag_str)
-
-    eventsourcecode = eventsourcecode.lower()
     return id_str, eventsourcecode, real_desc
 
 
-def get_rupture_edges(q, rev=None):
+def get_rupture_edges(q, rev=None, as_points=False):
     """
     Return a list of the top and bottom edges of the rupture. This is
     useful as a simplified visual representation of the rupture and placing
     the hypocenter but not used for distance calculaitons.
 
     Args:
-        q (list): List of quads.
+        q (list): List of quads, or array of their corners with shape
+            (number of quads, 4, 3) (see get_trace_corners).
         rev (list): Optional list of booleans indicating whether or not
         the quad is reversed.
+        as_points (bool): Return the edges as lists of points rather than
+            arrays?
 
     Returns:
-        list: A list of two lists of points; the first list corresponds to
-        the top edge and the second is the bottom edge.
+        list: A list of the top edge and the bottom edge. Each edge is an
+        array with shape (2 * number of quads, 3) of longitude, latitude, and
+        depth, or a list of points if as_points is True.
     """
     nq = len(q)
 
     if rev is None:
         rev = np.zeros(nq, dtype=bool)
     else:
-        rev = rev.astype('bool')
-
-    top_lat = np.array([[]])
-    top_lon = np.array([[]])
-    top_dep = np.array([[]])
-    bot_lat = np.array([[]])
-    bot_lon = np.array([[]])
-    bot_dep = np.array([[]])
-
-    for j in range(0, nq):
-        if rev[j] == True:
-            top_lat = np.append(top_lat, q[j][1].latitude)
-            top_lat = np.append(top_lat, q[j][0].latitude)
-            top_lon = np.append(top_lon, q[j][1].longitude)
-            top_lon = np.append(top_lon, q[j][0].longitude)
-            top_dep = np.append(top_dep, q[j][1].depth)
-            top_dep = np.append(top_dep, q[j][0].depth)
-            bot_lat = np.append(bot_lat, q[j][2].latitude)
-            bot_lat = np.append(bot_lat, q[j][3].latitude)
-            bot_lon = np.append(bot_lon, q[j][2].longitude)
-            bot_lon = np.append(bot_lon, q[j][3].longitude)
-            bot_dep = np.append(bot_dep, q[j][2].depth)
-            bot_dep = np.append(bot_dep, q[j][3].depth)
-        else:
-            top_lat = np.append(top_lat, q[j][0].latitude)
-            top_lat = np.append(top_lat, q[j][1].latitude)
-            top_lon = np.append(top_lon, q[j][0].longitude)
-            top_lon = np.append(top_lon, q[j][1].longitude)
-            top_dep = np.append(top_dep, q[j][0].depth)
-            top_dep = np.append(top_dep, q[j][1].depth)
-            bot_lat = np.append(bot_lat, q[j][3].latitude)
-            bot_lat = np.append(bot_lat, q[j][2].latitude)
-            bot_lon = np.append(bot_lon, q[j][3].longitude)
-            bot_lon = np.append(bot_lon, q[j][2].longitude)
-            bot_dep = np.append(bot_dep, q[j][3].depth)
-            bot_dep = np.append(bot_dep, q[j][2].depth)
-
-    nl = len(top_lon)
-    topp = [None] * nl
-    botp = [None] * nl
-    for i in range(0, nl):
-        topp[i] = geo.point.Point(top_lon[i], top_lat[i], top_dep[i])
-        botp[i] = geo.point.Point(bot_lon[i], bot_lat[i], bot_dep[i])
-
-    edges = [topp, botp]
+        rev = np.asarray(rev).astype('bool')
+
+    # Corners of the quads, with shape (nq, 4, 3)
+    corners = _quads_to_array(q)
+
+    # The top edge goes from corner 0 to 1 and the bottom edge from corner 3
+    # to 2, or the other way around if the quad is reversed
+    iq = np.arange(nq)
+    top = np.stack([corners[iq, np.where(rev, 1, 0)],
+                    corners[iq, np.where(rev, 0, 1)]], axis=1).reshape(-1, 3)
+    bot = np.stack([corners[iq, np.where(rev, 2, 3)],
+                    corners[iq, np.where(rev, 3, 2)]], axis=1).reshape(-1, 3)
+
+    if as_points is True:
+        topp = [geo.point.Point(p[0], p[1], p[2]) for p in top]
+        botp = [geo.point.Point(p[0], p[1], p[2]) for p in bot]
+        return [topp, botp]
+
+    edges = [top, bot]
     return edges
 
 
+def get_trace_corners(xp0, yp0, xp1, yp1, zp, widths, dips, strike=None):
+    """
+    Compute the corners of the quadrilaterals that QuadRupture.fromTrace
+    builds from a trace, without building the rupture. This is the bottom
+    edge computation of fromTrace with array operations, so that the parsers
+    can place the hypocenter before the rupture exists and then build the
+    rupture once, with fromVertices and the real origin.
+
+    Args:
+        xp0 (array): Longitudes of the first top vertex of each quad.
+        yp0 (array): Latitudes of the first top vertex of each quad.
+        xp1 (array): Longitudes of the second top vertex of each quad.
+        yp1 (array): Latitudes of the second top vertex of each quad.
+        zp (array): Depth of the top of each quad (km).
+        widths (array): Width of each quad (km).
+        dips (array): Dip of each quad (degrees).
+        strike (array): Strike of all quads (one value) or of each quad; if
+            None, the strike is computed from the top vertices of each quad,
+            as in fromTrace.
+
+    Returns:
+        array: Corners p0, p1, p2, p3 of each quad (see fromVertices), with
+        shape (number of quads, 4, 3) of longitude, latitude, and depth.
+
+    """
+    xp0 = np.array(xp0, dtype='d')
+    xp1 = np.array(xp1, dtype='d')
+    yp0 = np.array(yp0, dtype='d')
+    yp1 = np.array(yp1, dtype='d')
+    zp = np.array(zp, dtype='d')
+    widths = np.array(widths, dtype='d')
+    dips = np.radians(np.array(dips, dtype='d'))
+
+    # Projected coordinates are in km
+    west = np.min((xp0.min(), xp1.min()))
+    east = np.max((xp0.max(), xp1.max()))
+    south = np.min((yp0.min(), yp1.min()))
+    north = np.max((yp0.max(), yp1.max()))
+    proj = geo.utils.get_orthographic_projection(west, east, north, south)
+    p0x, p0y = proj(xp0, yp0)
+    p1x, p1y = proj(xp1, yp1)
+
+    # Rotation angle (from north) of each quad
+    if strike is None:
+        theta = np.arctan2(p1x - p0x, p1y - p0y)
+    else:
+        theta = np.radians(np.array(strike, dtype='d'))
+        if len(theta) == 1:
+            theta = np.full_like(xp0, theta[0])
+    cos, sin = np.cos(theta), np.sin(theta)
+    cosb, sinb = np.cos(-theta), np.sin(-theta)
+
+    # Rotate the top edge so that it is vertical, move it across by the
+    # horizontal width, and rotate it back
+    dx = np.cos(dips) * widths
+    p3xp = cos * p0x - sin * p0y + dx
+    p3yp = sin * p0x + cos * p0y
+    p2xp = cos * p1x - sin * p1y + dx
+    p2yp = sin * p1x + cos * p1y
+    lon3, lat3 = proj(cosb * p3xp - sinb * p3yp, sinb * p3xp + cosb * p3yp,
+                      reverse=True)
+    lon2, lat2 = proj(cosb * p2xp - sinb * p2yp, sinb * p2xp + cosb * p2yp,
+                      reverse=True)
+    zpdown = zp + np.sin(dips) * widths
+
+    return np.stack([np.column_stack([xp0, yp0, zp]),
+                     np.column_stack([xp1, yp1, zp]),
+                     np.column_stack([lon2, lat2, zpdown]),
+                     np.column_stack([lon3, lat3, zpdown])], axis=1)
+
+
+def fix_quads(corners):
+    """
+    Apply the corrections that QuadRupture makes to its quadrilaterals, with
+    array operations: p2 is moved so that the bottom edge is parallel to the
+    top edge, and quads that dip the wrong way are reversed. This gives the
+    quads that getQuadrilaterals would return for a rupture built from the
+    corners, without building it.
+
+    Args:
+        corners (array): Corners of the quads, with shape (number of quads,
+            4, 3) (see get_trace_corners).
+
+    Returns:
+        array: Corners of the corrected quads, with the same shape.
+
+    """
+    lat = corners[:, :, 1]
+    lon = corners[:, :, 0]
+    dep = corners[:, :, 2]
+    xyz = np.stack(latlon2ecef(lat, lon, dep), axis=-1)
+    p0, p1, p2, p3 = xyz[:, 0], xyz[:, 1], xyz[:, 2], xyz[:, 3]
+
+    # Move p2 from p3 the length of the bottom edge in the direction of the
+    # top edge
+    v0 = p1 - p0
+    v0 = v0 / np.linalg.norm(v0, axis=1)[:, None]
+    d = np.linalg.norm(p3 - p2, axis=1)
+    p2 = p3 + v0 * d[:, None]
+
+    # Reverse the quads whose normal points down
+    qnv = np.cross(p2 - p0, p1 - p0)
+    qnv = qnv / np.linalg.norm(qnv, axis=1)[:, None]
+    tmp = p0 + qnv
+    _, _, tmpz = ecef2latlon(tmp[:, 0], tmp[:, 1], tmp[:, 2])
+    rev = (tmpz - dep[:, 0]) >= 1e-6
+
+    xyz = np.stack([p0, p1, p2, p3], axis=1)
+    xyz[rev] = xyz[rev][:, [1, 0, 3, 2]]
+    flat, flon, fdep = ecef2latlon(xyz[..., 0].ravel(), xyz[..., 1].ravel(),
+                                   xyz[..., 2].ravel())
+    return np.stack([flon, flat, fdep], axis=-1).reshape(corners.shape)
+
+
+def get_polygon_corners(polys):
+    """
+    Split the polygons of a rupture GeoJSON into quadrilaterals in the same
+    way as the rupture classes do: each polygon runs along the top edge and
+    back along the bottom edge, and quad j of a polygon joins top vertices j
+    and j + 1 to the bottom vertices below them.
+
+    Args:
+        polys (list): The closed rings of the polygons, each a list or array
+            of longitude, latitude, and depth (e.g., from get_event_parts).
+
+    Returns:
+        array: Corners p0, p1, p2, p3 of each quad, with shape (number of
+        quads, 4, 3).
+
+    """
+    corners = []
+    for poly in polys:
+        pts = np.array(poly, dtype=float)[:-1]
+        npts = len(pts)
+        for j in range((npts - 4) // 2 + 1):
+            corners.append(pts[[j, j + 1, npts - 2 - j, npts - 1 - j]])
+    return np.array(corners).reshape(-1, 4, 3)
+
+
 def run_one_old_shakemap(eventid, topo=True, genex=True):
     """
     Convenience method for running old (v 3.5) shakemap with new estimates. This
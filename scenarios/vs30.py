@@ -0,0 +1,518 @@
+import os
+import json
+import shutil
+import warnings
+import multiprocessing
+
+import numpy as np
+
+from mapio.geodict import GeoDict
+from mapio.gmt import GMTGrid
+
+# Files of a Vs30 store (see write_vs30_store)
+DATA_FILE = 'vs30.npy'
+LEVEL_FILE = 'vs30_%i.npy'
+GEODICT_FILE = 'geodict.json'
+
+# Downsampling factors of the levels of a Vs30 store; 1 is the full
+# resolution grid
+LEVELS = (1, 2, 4, 8)
+
+# Tolerance, as a fraction of a cell, for a grid to be considered aligned
+# with the Vs30 store
+ALIGN_TOL = 1e-6
+
+# Vs30 stores that have been opened in this process, keyed by path
+_store_cache = {}
+
+# Full resolution Vs30 window in shared memory, as the values of its
+# geodictionary and the grid (see load_shared_vs30). It is set before worker
+# processes are forked so that they inherit it.
+_shared_vs30 = None
+
+
+def get_geodict_values(geodict):
+    """
+    Get the values of a geodictionary that define a grid.
+
+    Args:
+        geodict (GeoDict): The geodictionary.
+
+    Returns:
+        dict: xmin, xmax, ymin, ymax, dx, dy, nx, and ny.
+
+    """
+    return {'xmin': float(geodict.xmin),
+            'xmax': float(geodict.xmax),
+            'ymin': float(geodict.ymin),
+            'ymax': float(geodict.ymax),
+            'dx': float(geodict.dx),
+            'dy': float(geodict.dy),
+            'nx': int(geodict.nx),
+            'ny': int(geodict.ny)}
+
+
+def get_window_geodict(gdict, rows, cols):
+    """
+    Get the geodictionary of a window of rows and columns of a grid.
+
+    Args:
+        gdict (dict): Values of the geodictionary of the grid (see
+            get_geodict_values).
+        rows (slice): Rows of the window.
+        cols (slice): Columns of the window.
+
+    Returns:
+        GeoDict: Geodictionary of the window.
+
+    """
+    return GeoDict({'xmin': gdict['xmin'] + cols.start * gdict['dx'],
+                    'xmax': gdict['xmin'] + (cols.stop - 1) * gdict['dx'],
+                    'ymin': gdict['ymax'] - (rows.stop - 1) * gdict['dy'],
+                    'ymax': gdict['ymax'] - rows.start * gdict['dy'],
+                    'dx': gdict['dx'],
+                    'dy': gdict['dy'],
+                    'nx': cols.stop - cols.start,
+                    'ny': rows.stop - rows.start})
+
+
+def get_level_geodict(gdict, factor):
+    """
+    Get the geodictionary of a downsampled level of a grid, in which each
+    cell is the mean of a block of factor by factor cells of the grid. The
+    rows and columns at the south and east edges that do not fill a block
+    are dropped.
+
+    Args:
+        gdict (dict): Values of the geodictionary of the grid (see
+            get_geodict_values).
+        factor (int): Downsampling factor.
+
+    Returns:
+        dict: Values of the geodictionary of the level.
+
+    """
+    nx = gdict['nx'] // factor
+    ny = gdict['ny'] // factor
+    dx = gdict['dx'] * factor
+    dy = gdict['dy'] * factor
+    xmin = gdict['xmin'] + 0.5 * (factor - 1) * gdict['dx']
+    ymax = gdict['ymax'] - 0.5 * (factor - 1) * gdict['dy']
+    return {'xmin': xmin,
+            'xmax': xmin + (nx - 1) * dx,
+            'ymin': ymax - (ny - 1) * dy,
+            'ymax': ymax,
+            'dx': dx,
+            'dy': dy,
+            'nx': nx,
+            'ny': ny}
+
+
+def block_mean(data, factor):
+    """
+    Downsample a grid by the mean of blocks of cells, ignoring nans.
+
+    Args:
+        data (array): The grid.
+        factor (int): Number of rows and columns in a block.
+
+    Returns:
+        array: The downsampled grid; the rows and columns that do not fill a
+        block are dropped.
+
+    """
+    ny = data.shape[0] // factor
+    nx = data.shape[1] // factor
+    blocks = np.asarray(data[:ny * factor, :nx * factor], dtype=float)
+    blocks = blocks.reshape(ny, factor, nx, factor)
+    with warnings.catch_warnings():
+        # Blocks that are all nan
+        warnings.simplefilter('ignore', RuntimeWarning)
+        return np.nanmean(blocks, axis=(1, 3))
+
+
+def read_file_window(vs30file, gdict, rows, cols):
+    """
+    Read a window of rows and columns of a Vs30 grid file.
+
+    Args:
+        vs30file (str): Vs30 grid file.
+        gdict (dict): Values of the geodictionary of the file (see
+            get_geodict_values).
+        rows (slice): Rows of the window.
+        cols (slice): Columns of the window.
+
+    Returns:
+        array: The Vs30 of the window.
+
+    """
+    data = GMTGrid.load(vs30file, get_window_geodict(gdict, rows, cols),
+                        resample=False).getData()
+    if data.shape != (rows.stop - rows.start, cols.stop - cols.start):
+        raise Exception('Unexpected shape %s of rows %i to %i of %s.'
+                        % (data.shape, rows.start, rows.stop - 1, vs30file))
+    return data
+
+
+def write_vs30_store(vs30file, store_dir, levels=LEVELS, band_rows=1000,
+                     verbose=False):
+    """
+    Convert a Vs30 grid file into a store that can be memory mapped, so that
+    the Vs30 of an event extent can be read without opening and resampling
+    the grid file. The store is a directory with:
+
+        - vs30.npy: the Vs30 grid, with the first row at the north edge.
+        - vs30_<factor>.npy: the Vs30 grid downsampled by the mean of blocks
+          of factor by factor cells (see block_mean), for each of the
+          other levels.
+        - geodict.json: the geodictionary of the grid and the downsampling
+          factors of the levels.
+
+    The grid file is read in bands of rows so that it does not need to fit
+    in memory, and the store is written to a temporary directory first so
+    that a partially written store is never read.
+
+    Args:
+        vs30file (str): Vs30 grid file (e.g., the 'vs30file' of the
+            scenarios conf file).
+        store_dir (str): Path of the store directory to create.
+        levels (list): Downsampling factors of the levels; the full
+            resolution grid (1) is always included.
+        band_rows (int): Number of rows to read at once.
+        verbose (bool): Print progress?
+
+    """
+    fdict = GMTGrid.getFileGeoDict(vs30file)[0]
+    gdict = get_geodict_values(fdict)
+    nx = gdict['nx']
+    ny = gdict['ny']
+    cols = slice(0, nx)
+    levels = sorted(set([1] + [int(f) for f in levels]))
+
+    tmp_dir = '%s.tmp%i' % (os.path.normpath(store_dir), os.getpid())
+    if os.path.isdir(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+
+    data = None
+    for start in range(0, ny, band_rows):
+        rows = slice(start, min(start + band_rows, ny))
+        if verbose is True:
+            print('Rows %i to %i of %i' % (rows.start, rows.stop - 1, ny))
+        try:
+            band = read_file_window(vs30file, gdict, rows, cols)
+        except Exception:
+            shutil.rmtree(tmp_dir)
+            raise
+        if data is None:
+            data = np.lib.format.open_memmap(
+                os.path.join(tmp_dir, DATA_FILE), mode='w+',
+                dtype=band.dtype, shape=(ny, nx))
+        data[rows] = band
+    data.flush()
+
+    # Downsampled levels, computed from the full resolution grid in bands of
+    # whole blocks
+    for factor in levels[1:]:
+        ldict = get_level_geodict(gdict, factor)
+        if ldict['nx'] < 1 or ldict['ny'] < 1:
+            shutil.rmtree(tmp_dir)
+            raise Exception('The Vs30 grid is too small for level %i.'
+                            % factor)
+        if verbose is True:
+            print('Level %i: %i by %i' % (factor, ldict['ny'], ldict['nx']))
+        level = np.lib.format.open_memmap(
+            os.path.join(tmp_dir, LEVEL_FILE % factor), mode='w+',
+            dtype=data.dtype, shape=(ldict['ny'], ldict['nx']))
+        nrows = max(1, band_rows // factor)
+        for start in range(0, ldict['ny'], nrows):
+            stop = min(start + nrows, ldict['ny'])
+            level[start:stop] = block_mean(
+                data[start * factor:stop * factor], factor)
+        level.flush()
+        del level
+    del data
+
+    gdict['levels'] = levels
+    gdict['vs30file'] = os.path.abspath(vs30file)
+    with open(os.path.join(tmp_dir, GEODICT_FILE), 'w') as f:
+        json.dump(gdict, f, indent=4, sort_keys=True)
+
+    if os.path.isdir(store_dir):
+        shutil.rmtree(store_dir)
+    os.rename(tmp_dir, store_dir)
+
+
+def open_vs30_store(store_dir):
+    """
+    Open a Vs30 store (see write_vs30_store). The grids are memory mapped,
+    and the store is kept open for the rest of the process, so forked
+    processes share the pages that have been read.
+
+    Args:
+        store_dir (str): Path of the store directory.
+
+    Returns:
+        list: The levels of the store, from the finest to the coarsest; each
+        is a tuple of the values of the geodictionary of the level (see
+        get_geodict_values) and the memory mapped grid.
+
+    """
+    store_dir = os.path.abspath(store_dir)
+    if store_dir not in _store_cache:
+        with open(os.path.join(store_dir, GEODICT_FILE)) as f:
+            gdict = json.load(f)
+        levels = []
+        for factor in gdict.get('levels', [1]):
+            if factor == 1:
+                ldict = gdict
+                lfile = DATA_FILE
+            else:
+                ldict = get_level_geodict(gdict, factor)
+                lfile = LEVEL_FILE % factor
+            levels.append((ldict, np.load(os.path.join(store_dir, lfile),
+                                          mmap_mode='r')))
+        _store_cache[store_dir] = levels
+    return _store_cache[store_dir]
+
+
+def is_within(gdict, sampledict):
+    """
+    Check if a sample grid is within a grid.
+
+    Args:
+        gdict (dict): Values of the geodictionary of the grid (see
+            get_geodict_values).
+        sampledict (GeoDict): Geodictionary of the sample grid.
+
+    Returns:
+        bool: Is the sample grid within the grid?
+
+    """
+    tol_x = ALIGN_TOL * gdict['dx']
+    tol_y = ALIGN_TOL * gdict['dy']
+    return bool(sampledict.xmin >= gdict['xmin'] - tol_x and
+                sampledict.xmax <= gdict['xmax'] + tol_x and
+                sampledict.ymin >= gdict['ymin'] - tol_y and
+                sampledict.ymax <= gdict['ymax'] + tol_y)
+
+
+def select_level(levels, sampledict):
+    """
+    Select the level of a Vs30 store for a sample grid: the coarsest level
+    that is at least as fine as the sample grid and covers it.
+
+    Args:
+        levels (list): The levels of the store (see open_vs30_store).
+        sampledict (GeoDict): Geodictionary of the sample grid.
+
+    Returns:
+        tuple: The values of the geodictionary of the level and its grid.
+
+    """
+    selected = levels[0]
+    for ldict, data in levels[1:]:
+        finer = (ldict['dx'] <= sampledict.dx * (1 + ALIGN_TOL) and
+                 ldict['dy'] <= sampledict.dy * (1 + ALIGN_TOL))
+        if finer and is_within(ldict, sampledict):
+            selected = (ldict, data)
+    return selected
+
+
+def get_window(gdict, sampledict):
+    """
+    Find the window of a grid that covers a sample grid.
+
+    Args:
+        gdict (dict): Values of the geodictionary of the grid (see
+            get_geodict_values).
+        sampledict (GeoDict): Geodictionary of the sample grid.
+
+    Returns:
+        tuple: Slices of the rows and columns of the window, and whether the
+        sample grid is aligned with the grid; if it is, the window has the
+        same cells as the sample grid. Otherwise, the window has a margin of
+        a cell for interpolation.
+
+    """
+    if not is_within(gdict, sampledict):
+        raise Exception('The sample grid is not within the Vs30 grid.')
+    col = (sampledict.xmin - gdict['xmin']) / gdict['dx']
+    row = (gdict['ymax'] - sampledict.ymax) / gdict['dy']
+    ncol = (sampledict.nx - 1) * sampledict.dx / gdict['dx']
+    nrow = (sampledict.ny - 1) * sampledict.dy / gdict['dy']
+
+    aligned = (
+        abs(sampledict.dx - gdict['dx']) < ALIGN_TOL * gdict['dx'] and
+        abs(sampledict.dy - gdict['dy']) < ALIGN_TOL * gdict['dy'] and
+        abs(col - np.round(col)) < ALIGN_TOL and
+        abs(row - np.round(row)) < ALIGN_TOL)
+    if aligned:
+        col = int(np.round(col))
+        row = int(np.round(row))
+        return (slice(row, row + int(sampledict.ny)),
+                slice(col, col + int(sampledict.nx)), True)
+
+    rows = slice(max(int(np.floor(row)) - 1, 0),
+                 min(int(np.ceil(row + nrow)) + 2, gdict['ny']))
+    cols = slice(max(int(np.floor(col)) - 1, 0),
+                 min(int(np.ceil(col + ncol)) + 2, gdict['nx']))
+    return rows, cols, False
+
+
+def read_vs30_window(gdict, data, sampledict):
+    """
+    Read the Vs30 of a sample grid from a grid. If the sample grid is aligned
+    with the grid, the data are a view of the grid; otherwise, only the
+    window that covers the sample grid is read and it is interpolated to the
+    sample grid.
+
+    Args:
+        gdict (dict): Values of the geodictionary of the grid (see
+            get_geodict_values).
+        data (array): The grid.
+        sampledict (GeoDict): Geodictionary of the sample grid.
+
+    Returns:
+        GMTGrid: The Vs30 grid.
+
+    """
+    rows, cols, aligned = get_window(gdict, sampledict)
+    if aligned:
+        return GMTGrid(data[rows, cols], sampledict)
+    window = GMTGrid(np.array(data[rows, cols]),
+                     get_window_geodict(gdict, rows, cols))
+    return window.interpolateToGrid(sampledict, method='linear')
+
+
+def read_vs30_store(store_dir, sampledict):
+    """
+    Read the Vs30 of a sample grid from a Vs30 store, using the level that is
+    closest to the resolution of the sample grid without being coarser (see
+    select_level). If the sample grid is aligned with the level, the data
+    are a (read only) view of the memory mapped level; otherwise, it is
+    interpolated from the window of the level that covers it (see
+    read_vs30_window).
+
+    Args:
+        store_dir (str): Path of the store directory.
+        sampledict (GeoDict): Geodictionary of the sample grid.
+
+    Returns:
+        GMTGrid: The Vs30 grid.
+
+    """
+    gdict, data = select_level(open_vs30_store(store_dir), sampledict)
+    return read_vs30_window(gdict, data, sampledict)
+
+
+def uses_full_resolution(config, sampledict):
+    """
+    Check if the Vs30 of a sample grid is read at the full resolution of the
+    Vs30 grid, i.e., if it does not use a downsampled level of the Vs30
+    store.
+
+    Args:
+        config (dict): Validated config (see scenarios.grids.get_config).
+        sampledict (GeoDict): Geodictionary of the sample grid.
+
+    Returns:
+        bool: Is the full resolution used?
+
+    """
+    store_dir = config['data'].get('vs30store', '')
+    if not store_dir:
+        return True
+    levels = open_vs30_store(store_dir)
+    return select_level(levels, sampledict) is levels[0]
+
+
+def load_shared_vs30(config, sampledicts, max_cells=100000000):
+    """
+    Load the full resolution Vs30 of the union of a list of sample grids
+    (e.g., the grids of a batch of events) into shared memory. Processes
+    that are forked afterwards read the Vs30 of the sample grids from it
+    (see load_vs30_grid), so that the window is read only once and its
+    memory is shared. Sample grids that use a downsampled level of the Vs30
+    store, or that are not within the Vs30 grid, are left out.
+
+    Args:
+        config (dict): Validated config (see scenarios.grids.get_config).
+        sampledicts (list): List of geodictionaries of the sample grids.
+        max_cells (int): Maximum number of cells of the shared window.
+
+    Returns:
+        bool: Was the shared window loaded? It is not if there aren't any
+        sample grids to share it, or if it would exceed max_cells.
+
+    """
+    global _shared_vs30
+    _shared_vs30 = None
+
+    store_dir = config['data'].get('vs30store', '')
+    vs30file = config['data']['vs30file']
+    if store_dir:
+        gdict, data = open_vs30_store(store_dir)[0]
+    else:
+        gdict = get_geodict_values(GMTGrid.getFileGeoDict(vs30file)[0])
+        data = None
+
+    windows = [get_window(gdict, s)[:2] for s in sampledicts
+               if is_within(gdict, s) and uses_full_resolution(config, s)]
+    if len(windows) == 0:
+        return False
+    rows = slice(min(w[0].start for w in windows),
+                 max(w[0].stop for w in windows))
+    cols = slice(min(w[1].start for w in windows),
+                 max(w[1].stop for w in windows))
+    shape = (rows.stop - rows.start, cols.stop - cols.start)
+    if shape[0] * shape[1] > max_cells:
+        return False
+
+    if data is None:
+        window = read_file_window(vs30file, gdict, rows, cols)
+    else:
+        window = data[rows, cols]
+    raw = multiprocessing.RawArray(
+        np.ctypeslib.as_ctypes_type(window.dtype), shape[0] * shape[1])
+    shared = np.frombuffer(raw, dtype=window.dtype).reshape(shape)
+    shared[:] = window
+    shared.flags.writeable = False
+    _shared_vs30 = (get_geodict_values(get_window_geodict(gdict, rows, cols)),
+                    shared)
+    return True
+
+
+def release_shared_vs30():
+    """
+    Release the shared Vs30 window (see load_shared_vs30).
+    """
+    global _shared_vs30
+    _shared_vs30 = None
+
+
+def load_vs30_grid(config, sampledict):
+    """
+    Load the Vs30 grid for a sample grid: from the shared Vs30 window if
+    there is one that covers the sample grid (see load_shared_vs30), from
+    the Vs30 store if one is configured ('vs30store' in the [data] section
+    of the scenarios conf file), or else from the Vs30 file.
+
+    Args:
+        config (dict): Validated config (see scenarios.grids.get_config).
+        sampledict (GeoDict): Geodictionary of the sample grid.
+
+    Returns:
+        Grid2D: The Vs30 grid.
+
+    """
+    if _shared_vs30 is not None:
+        gdict, data = _shared_vs30
+        if is_within(gdict, sampledict) and \
+                uses_full_resolution(config, sampledict):
+            return read_vs30_window(gdict, data, sampledict)
+    store_dir = config['data'].get('vs30store', '')
+    if store_dir:
+        return read_vs30_store(store_dir, sampledict)
+    return GMTGrid.load(config['data']['vs30file'], sampledict,
+                        resample=True)
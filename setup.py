@@ -13,5 +13,6 @@ setup(name='scenarios',
       package_data={'scenarios': [os.path.join('..', 'rupture_sets', '*'),
                                   os.path.join('data', '*'),
                                   os.path.join('..', 'tests', 'data', '*')]},
-      scripts=['runscenarios', 'mkinputdir', 'mkscenariogrids'],
+      scripts=['runscenarios', 'mkinputdir', 'mkscenariogrids', 'scenariod',
+               'mkvs30store'],
       )
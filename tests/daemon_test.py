@@ -0,0 +1,79 @@
+# stdlib imports
+import io
+import os
+import sys
+import shutil
+import tempfile
+import threading
+
+from impactutils.testing.grd import grdcmp
+
+from scenarios.utils import set_shakehome, set_vs30file, set_gmpe
+from scenarios.client import is_daemon_running
+from scenarios.client import submit_job
+from scenarios.daemon import ScenarioServer
+
+homedir = os.path.dirname(os.path.abspath(__file__))  # where is this script?
+shakedir = os.path.abspath(os.path.join(homedir, '..'))
+sys.path.insert(0, shakedir)
+
+
+def test_daemon(tmpdir):
+    p = os.path.join(str(tmpdir), "sub")
+    if not os.path.exists(p):
+        os.makedirs(p)
+    old_shakedir = set_shakehome(p)
+    v = os.path.join(shakedir, 'tests/data/elsinoreVs30.grd')
+    old_vs30file = set_vs30file(v)
+    old_gmpe = set_gmpe('active_crustal_nshmp2014')
+    jsonfile = os.path.join(
+        shakedir, 'rupture_sets/BSSC2014/UCERF3_EventSet_All.json')
+
+    testinput = os.path.join(p, 'data/elsinoretsellbgeol_m7p02_se~dir0/input')
+    targetinput = os.path.join(
+        shakedir, 'tests/output/elsinore/input')
+
+    sock = os.path.join(str(tmpdir), 'scenarios.sock')
+    server = ScenarioServer(socket_path=sock)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    try:
+        assert is_daemon_running(sock) is True
+
+        # Chained mkinputdir and mkscenariogrids job
+        job = {'mkinputdir': {'rfile': jsonfile, 'index': ['269'],
+                              'dirind': 0},
+               'mkscenariogrids': {'nmax': 500, 'mesh_dx': 3.0}}
+        out = io.StringIO()
+        assert submit_job(job, socket_path=sock, stream=out) is True
+        assert 'elsinoretsellbgeol_m7p02_se~dir0' in out.getvalue()
+
+        for name in ['mi', 'pga', 'pgv', 'psa03', 'psa10', 'psa30']:
+            for kind in ['estimates', 'sd']:
+                fname = '%s_%s.grd' % (name, kind)
+                grdcmp(os.path.join(testinput, fname),
+                       os.path.join(targetinput, fname))
+
+        # A failing job is reported without stopping the daemon
+        job = {'mkscenariogrids': {'event': 'not_an_event'}}
+        out = io.StringIO()
+        assert submit_job(job, socket_path=sock, stream=out) is False
+        assert 'Traceback' in out.getvalue()
+        assert is_daemon_running(sock) is True
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
+
+    assert is_daemon_running(sock) is False
+
+    # Clean up
+    set_shakehome(old_shakedir)
+    set_vs30file(old_vs30file)
+    set_gmpe(old_gmpe)
+    shutil.rmtree(p)
+
+
+if __name__ == "__main__":
+    td1 = tempfile.TemporaryDirectory()
+    test_daemon(td1.name)
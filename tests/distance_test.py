@@ -0,0 +1,159 @@
+# stdlib imports
+import os
+import sys
+import tempfile
+
+import numpy as np
+
+from openquake.hazardlib.gsim.abrahamson_2014 import AbrahamsonEtAl2014
+from openquake.hazardlib.gsim.boore_2014 import BooreEtAl2014
+
+from shakelib.distance import Distance
+from shakelib.rupture.origin import Origin
+from shakelib.rupture.quad_rupture import QuadRupture
+
+import scenarios.distance as distance
+from scenarios.distance import BASE_DISTANCES
+from scenarios.distance import get_distance_context
+from scenarios.distance import get_geometry_key
+from scenarios.distance import find_distance_cache
+from scenarios.distance import write_distance_cache
+from scenarios.distance import prune_distance_cache
+
+homedir = os.path.dirname(os.path.abspath(__file__))  # where is this script?
+shakedir = os.path.abspath(os.path.join(homedir, '..'))
+sys.path.insert(0, shakedir)
+
+FAMILY = 'elsinoretsellbgeol_m7p02_se'
+
+
+def get_rupture(hlat):
+    origin = Origin({'id': '', 'lat': hlat, 'lon': -116.9, 'depth': 8.0,
+                     'mag': 7.0})
+    return QuadRupture.fromTrace(
+        np.array([-117.0]), np.array([33.0]),
+        np.array([-116.8]), np.array([33.4]),
+        np.array([0.0]), np.array([15.0]), np.array([60.0]), origin)
+
+
+def get_mesh(nlat=6):
+    lon, lat = np.meshgrid(np.linspace(-117.5, -116.3, 8),
+                           np.linspace(33.8, 32.6, nlat))
+    return lon, lat, np.zeros_like(lon)
+
+
+class _CountingDistance(object):
+    """
+    Distance class that counts the number of times it is built.
+    """
+    ninit = 0
+
+    def __init__(self, *args):
+        _CountingDistance.ninit += 1
+        self._dist = Distance(*args)
+
+    def getDistanceContext(self):
+        return self._dist.getDistanceContext()
+
+
+def test_family_distance_cache(tmpdir, monkeypatch):
+    datdir = str(tmpdir)
+    gmpe = AbrahamsonEtAl2014()
+    lon, lat, dep = get_mesh()
+    monkeypatch.setattr(distance, 'Distance', _CountingDistance)
+    _CountingDistance.ninit = 0
+
+    # The first realization computes and caches the distances
+    rupt0 = get_rupture(33.1)
+    key = get_geometry_key(rupt0, lon, lat, dep)
+    assert find_distance_cache(datdir, FAMILY + '~dir1', key) is None
+    get_distance_context(gmpe, lon, lat, dep, rupt0, datdir=datdir,
+                         id_str=FAMILY + '~dir0')
+    assert _CountingDistance.ninit == 1
+    assert os.listdir(os.path.join(
+        datdir, FAMILY + '~dir0', 'input', 'distances')) == [key]
+
+    # Another realization (hypocenter) of the rupture reads them
+    rupt1 = get_rupture(33.3)
+    assert get_geometry_key(rupt1, lon, lat, dep) == key
+    dx = get_distance_context(gmpe, lon, lat, dep, rupt1, datdir=datdir,
+                              id_str=FAMILY + '~dir1')
+    assert _CountingDistance.ninit == 1
+    assert not os.path.exists(os.path.join(datdir, FAMILY + '~dir1'))
+    target = Distance(gmpe, lon, lat, dep, rupt1).getDistanceContext()
+    for name in ['rrup', 'rjb', 'rx', 'ry0']:
+        np.testing.assert_allclose(getattr(dx, name), getattr(target, name))
+    np.testing.assert_allclose(dx.rhypo, rupt1.computeRhyp(lon, lat, dep))
+    assert np.abs(dx.rhypo - rupt0.computeRhyp(lon, lat, dep)).max() > 1.0
+
+    # Another mesh doesn't match the cached key, so the distances are
+    # computed again
+    lon2, lat2, dep2 = get_mesh(nlat=5)
+    key2 = get_geometry_key(rupt1, lon2, lat2, dep2)
+    assert key2 != key
+    dx = get_distance_context(gmpe, lon2, lat2, dep2, rupt1, datdir=datdir,
+                              id_str=FAMILY + '~dir1')
+    assert _CountingDistance.ninit == 2
+    target = Distance(gmpe, lon2, lat2, dep2, rupt1).getDistanceContext()
+    np.testing.assert_allclose(dx.rrup, target.rrup)
+    assert os.listdir(os.path.join(
+        datdir, FAMILY + '~dir1', 'input', 'distances')) == [key2]
+
+
+def test_family_distance_names(tmpdir):
+    # The cached distances are the same as those that Distance computes,
+    # even for a GMPE that only requires Rjb
+    datdir = str(tmpdir)
+    gmpe = BooreEtAl2014()
+    lon, lat, dep = get_mesh()
+    rupt = get_rupture(33.1)
+    target = Distance(gmpe, lon, lat, dep, rupt).getDistanceContext()
+    for id_str in [FAMILY + '~dir0', FAMILY + '~dir1']:
+        dx = get_distance_context(gmpe, lon, lat, dep, rupt, datdir=datdir,
+                                  id_str=id_str)
+        for name in BASE_DISTANCES:
+            np.testing.assert_allclose(getattr(dx, name),
+                                       getattr(target, name))
+    assert not os.path.exists(os.path.join(datdir, FAMILY + '~dir1'))
+
+
+def test_find_distance_cache_family(tmpdir):
+    datdir = str(tmpdir)
+    dists = {'rrup': np.arange(3.0)}
+
+    # Events whose ids only share a prefix with the family are not part of
+    # it
+    for id_str in [FAMILY + '2~dir0', FAMILY + 'x', FAMILY + '2']:
+        write_distance_cache(
+            os.path.join(datdir, id_str, 'input', 'distances'), 'key', dists)
+    assert find_distance_cache(datdir, FAMILY + '~dir1', 'key') is None
+
+    for id_str in [FAMILY, FAMILY + '~dir0']:
+        write_distance_cache(
+            os.path.join(datdir, id_str, 'input', 'distances'), 'key', dists)
+        result = find_distance_cache(datdir, FAMILY + '~dir1', 'key')
+        np.testing.assert_array_equal(result['rrup'], dists['rrup'])
+        os.rename(os.path.join(datdir, id_str),
+                  os.path.join(datdir, id_str + '.old'))
+
+
+def test_prune_distance_cache(tmpdir):
+    cache_dir = os.path.join(str(tmpdir), 'distances')
+    prune_distance_cache(cache_dir, [])
+    dists = {'rrup': np.arange(3.0)}
+    for key in ['key0', 'key1', 'key2']:
+        write_distance_cache(cache_dir, key, dists)
+    os.mkdir(os.path.join(cache_dir, 'key3.tmp123'))
+    with open(os.path.join(cache_dir, 'stray'), 'w') as f:
+        f.write('')
+
+    prune_distance_cache(cache_dir, ['key0', 'key2'])
+    assert sorted(os.listdir(cache_dir)) == ['key0', 'key2']
+    assert os.listdir(os.path.join(cache_dir, 'key0')) == ['rrup.npy']
+
+
+if __name__ == "__main__":
+    td1 = tempfile.TemporaryDirectory()
+    test_find_distance_cache_family(td1.name)
+    td2 = tempfile.TemporaryDirectory()
+    test_prune_distance_cache(td2.name)
@@ -0,0 +1,225 @@
+# stdlib imports
+import os
+import sys
+import glob
+import tempfile
+import warnings
+
+import numpy as np
+import pytest
+
+from openquake.hazardlib import imt
+from openquake.hazardlib.gsim.base import DistancesContext
+from openquake.hazardlib.gsim.base import SitesContext
+
+from shakelib.rupture.origin import Origin
+from mapio.gmt import GMTGrid
+from mapio.shake import ShakeGrid
+
+from scenarios.grids import get_coarse_nodes
+from scenarios.grids import bilinear_upsample
+from scenarios.grids import evaluate_rock
+from scenarios.grids import read_event_rupture
+from scenarios.grids import get_grid_geodict
+from scenarios.grids import make_scenario_grids
+import scenarios.grids as grids
+from scenarios.input_output import make_input_dirs
+from scenarios.utils import estimate_cost
+from scenarios.utils import set_shakehome
+from scenarios.utils import set_vs30file
+from scenarios.utils import set_gmpe
+from scenarios.utils import set_cache_dir
+
+homedir = os.path.dirname(os.path.abspath(__file__))  # where is this script?
+shakedir = os.path.abspath(os.path.join(homedir, '..'))
+sys.path.insert(0, shakedir)
+
+
+class _DistanceGMPE(object):
+    """
+    Smooth function of distance with the interface of a MultiGMPE, which
+    counts the number of cells that it is evaluated on.
+    """
+
+    def __init__(self):
+        self.ncell = 0
+
+    def get_mean_and_stddevs(self, sx, rx, dx, imt, stddev_types):
+        self.ncell += np.size(dx.rrup)
+        lnmu = -1.3 * np.log(np.sqrt(dx.rrup**2 + 36)) + 0 * sx.vs30
+        return lnmu, [0.6 + 0.01 * np.log(dx.rrup + 1)]
+
+
+def read_grids(input_dir):
+    """
+    Read the grids written by make_scenario_grids for an event, and the
+    layers of its rock_grid.xml.
+    """
+    grids = {}
+    for gfile in glob.glob(os.path.join(input_dir, '*.grd')):
+        grids[os.path.basename(gfile)] = GMTGrid.load(gfile).getData()
+    rock = ShakeGrid.load(os.path.join(input_dir, 'rock_grid.xml'))
+    for name in rock.getLayerNames():
+        grids['rock_' + name] = rock.getLayer(name).getData()
+    return grids
+
+
+def make_event(tmpdir):
+    """
+    Write the input directory of the Mount Diablo rupture (with directivity)
+    in a temporary ShakeMap home, with the Vs30 grid and GMPE of the test.
+    The settings of the conf file are restored by the returned function.
+
+    A single GMPE that only uses Rjb is used so that the grids do not depend
+    on how the sites are split: the standard deviation of a GMPE set depends
+    on the correlation of its GMPEs over the sites that are evaluated
+    together, and Rx and Ry0 on the projection of the site mesh.
+    """
+    p = os.path.join(str(tmpdir), 'sub')
+    os.makedirs(p)
+    old = [set_shakehome(p),
+           set_vs30file(os.path.join(shakedir, 'tests/data/NCalVs30.grd')),
+           set_gmpe('BSSA14'),
+           set_cache_dir(os.path.join(str(tmpdir), 'cache'))]
+
+    def restore():
+        set_shakehome(old[0])
+        set_vs30file(old[1])
+        set_gmpe(old[2])
+        set_cache_dir(old[3])
+
+    try:
+        jsonfile = os.path.join(
+            shakedir, 'rupture_sets/BSSC2014/UCERF3_EventSet_All.json')
+        event = make_input_dirs(jsonfile, dirind=0, index=[0])[0]
+    except Exception:
+        restore()
+        raise
+    return event, os.path.join(p, 'data', event, 'input'), restore
+
+
+def test_bilinear_upsample():
+    assert get_coarse_nodes(9, 4).tolist() == [0, 4, 8]
+    assert get_coarse_nodes(10, 4).tolist() == [0, 4, 8, 9]
+    assert get_coarse_nodes(1, 4).tolist() == [0]
+
+    # Bilinear fields are reproduced exactly
+    rows, cols = np.meshgrid(np.arange(23), np.arange(37), indexing='ij')
+    field = 3 + 2 * rows - 0.5 * cols + 0.1 * rows * cols
+    rnodes = get_coarse_nodes(23, 4)
+    cnodes = get_coarse_nodes(37, 4)
+    up = bilinear_upsample(field[np.ix_(rnodes, cnodes)], rnodes, cnodes,
+                           field.shape)
+    np.testing.assert_allclose(up, field)
+
+
+def test_evaluate_rock():
+    lons, lats = np.meshgrid(np.linspace(-118, -116, 200),
+                             np.linspace(34.5, 34, 60))
+    dx = DistancesContext()
+    dx.rrup = np.hypot((lons + 117) * 92, (lats - 34.25) * 111) + 1
+    sx = SitesContext()
+    sx.vs30 = np.full(lons.shape, 760.0)
+    iimt = imt.PGA()
+
+    gmpe = _DistanceGMPE()
+    target_mu, target_sd = gmpe.get_mean_and_stddevs(sx, None, dx, iimt, [])
+
+    rock = {'factor': 4, 'rrup': 20.0, 'tol': 0.05, 'nsample': 100}
+    gmpe = _DistanceGMPE()
+    with warnings.catch_warnings(record=True) as wlist:
+        warnings.simplefilter('always')
+        lnmu, lnsd = evaluate_rock(gmpe, sx, None, dx, iimt, [], rock)
+    assert len(wlist) == 0
+    assert gmpe.ncell < 0.25 * lons.size
+    np.testing.assert_allclose(lnmu, target_mu, atol=0.01)
+    np.testing.assert_allclose(lnsd[0], target_sd[0], atol=0.001)
+    near = dx.rrup < rock['rrup']
+    np.testing.assert_array_equal(lnmu[near], target_mu[near])
+
+    # Falls back to direct evaluation if the error is too large
+    rock['tol'] = 1e-6
+    with warnings.catch_warnings(record=True) as wlist:
+        warnings.simplefilter('always')
+        lnmu, lnsd = evaluate_rock(gmpe, sx, None, dx, iimt, [], rock)
+    assert len(wlist) == 1
+    np.testing.assert_array_equal(lnmu, target_mu)
+    np.testing.assert_array_equal(lnsd[0], target_sd[0])
+
+
+def test_estimate_cost():
+    # Cascadia (rupture.json), Charlevoix with a fault (*_fault.txt), and
+    # Charlevoix as a point source
+    events = ['charlevoix_0_m7p_noflt_se', 'cascadia', 'charlevoix_0_m7p_se']
+    costs = {}
+    for event in events:
+        input_dir = os.path.join(shakedir, 'tests', 'output', event, 'input')
+        origin = Origin.fromFile(os.path.join(input_dir, 'event.xml'))
+        rupt = read_event_rupture(input_dir, origin)
+        sampledict = get_grid_geodict(origin, rupt, res=0.1, nmax=1e9)
+        costs[event] = estimate_cost(sampledict, rupt, ngmpe=4)
+        assert costs[event] >= sampledict.nx * sampledict.ny * 5
+    order = sorted(events, key=lambda x: costs[x], reverse=True)
+    assert order == ['cascadia', 'charlevoix_0_m7p_se',
+                     'charlevoix_0_m7p_noflt_se']
+
+
+def test_make_scenario_grids_tiled(tmpdir):
+    event, input_dir, restore = make_event(tmpdir)
+    try:
+        make_scenario_grids(event, res=0.05)
+        target = read_grids(input_dir)
+
+        # Tiles of 3 rows, with a shorter last one
+        nx = target['pga_estimates.grd'].shape[1]
+        ny = target['pga_estimates.grd'].shape[0]
+        assert ny % 3 != 0
+        make_scenario_grids(event, res=0.05, tile_size=3 * nx + 1)
+        grids = read_grids(input_dir)
+    finally:
+        restore()
+
+    assert 'fd1.grd' in target
+    assert sorted(grids.keys()) == sorted(target.keys())
+    for name in target:
+        np.testing.assert_array_equal(grids[name], target[name],
+                                      err_msg=name)
+
+
+def test_make_scenario_grids_nproc(tmpdir, monkeypatch):
+    event, input_dir, restore = make_event(tmpdir)
+    try:
+        make_scenario_grids(event, res=0.05)
+        target = read_grids(input_dir)
+        make_scenario_grids(event, res=0.05, nproc=3)
+        grids_nproc = read_grids(input_dir)
+        assert grids._pool_state is None
+
+        # A tile that fails in a worker fails the event, and the pool state
+        # is cleared
+        evaluate_tile = grids.evaluate_tile
+
+        def failing_evaluate_tile(rows, state):
+            if rows.start > 0:
+                raise ValueError('tile failed')
+            return evaluate_tile(rows, state)
+
+        monkeypatch.setattr(grids, 'evaluate_tile', failing_evaluate_tile)
+        with pytest.raises(ValueError):
+            make_scenario_grids(event, res=0.05, nproc=3)
+        assert grids._pool_state is None
+    finally:
+        restore()
+
+    assert sorted(grids_nproc.keys()) == sorted(target.keys())
+    for name in target:
+        np.testing.assert_array_equal(grids_nproc[name], target[name],
+                                      err_msg=name)
+
+
+if __name__ == "__main__":
+    test_bilinear_upsample()
+    test_evaluate_rock()
+    test_estimate_cost()
+    td1 = tempfile.TemporaryDirectory()
+    test_make_scenario_grids_tiled(td1.name)
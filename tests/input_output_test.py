@@ -0,0 +1,113 @@
+# stdlib imports
+import os
+import sys
+import json
+import filecmp
+
+from lxml import etree
+import pytest
+
+from scenarios.utils import set_shakehome
+from scenarios.utils import set_cache_dir
+import scenarios.input_output as input_output
+from scenarios.input_output import make_input_dirs
+
+homedir = os.path.dirname(os.path.abspath(__file__))  # where is this script?
+shakedir = os.path.abspath(os.path.join(homedir, '..'))
+sys.path.insert(0, shakedir)
+
+# Attributes of event.xml and metadata of rupture.json that hold the time
+# the files were written
+TIME_KEYS = ['year', 'month', 'day', 'hour', 'minute', 'second']
+RUPTURE_TIME_KEYS = ['time', 'created']
+
+
+def read_event_attributes(xml_file):
+    attrs = dict(etree.parse(xml_file).getroot().attrib)
+    for key in TIME_KEYS:
+        del attrs[key]
+    return attrs
+
+
+def read_rupture(json_file):
+    with open(json_file) as f:
+        rupture = json.load(f)
+    for key in RUPTURE_TIME_KEYS:
+        del rupture['metadata'][key]
+    return rupture
+
+
+def test_make_input_dirs_nproc(tmpdir):
+    jsonfile = os.path.join(
+        shakedir, 'rupture_sets/BSSC2014/UCERF3_EventSet_All.json')
+    index = [0, 1, 2, 3, 269]
+
+    datdirs = []
+    old_shakehome = None
+    old_cache_dir = set_cache_dir(os.path.join(str(tmpdir), 'cache'))
+    try:
+        for nproc in [1, 3]:
+            p = os.path.join(str(tmpdir), 'nproc%i' % nproc)
+            os.makedirs(p)
+            old = set_shakehome(p)
+            if old_shakehome is None:
+                old_shakehome = old
+            ids = make_input_dirs(jsonfile, dirind=0, index=index,
+                                  nproc=nproc)
+            assert len(ids) == len(index)
+            datdirs.append(os.path.join(p, 'data'))
+    finally:
+        if old_shakehome is not None:
+            set_shakehome(old_shakehome)
+        set_cache_dir(old_cache_dir)
+
+    # Same input directories, apart from the times in event.xml and
+    # rupture.json
+    assert sorted(os.listdir(datdirs[0])) == sorted(os.listdir(datdirs[1]))
+    for event in os.listdir(datdirs[0]):
+        input0 = os.path.join(datdirs[0], event, 'input')
+        input1 = os.path.join(datdirs[1], event, 'input')
+        files = sorted(os.listdir(input0))
+        assert files == sorted(os.listdir(input1))
+        for fname in files:
+            file0 = os.path.join(input0, fname)
+            file1 = os.path.join(input1, fname)
+            if fname == 'event.xml':
+                assert read_event_attributes(file0) == \
+                    read_event_attributes(file1)
+            elif fname == 'rupture.json':
+                assert read_rupture(file0) == read_rupture(file1)
+            else:
+                assert filecmp.cmp(file0, file1, shallow=False) is True
+
+
+def test_make_input_dirs_dead_worker(tmpdir, monkeypatch):
+    jsonfile = os.path.join(
+        shakedir, 'rupture_sets/BSSC2014/UCERF3_EventSet_All.json')
+    make_one_input_dir = input_output._make_one_input_dir
+
+    # The worker of rupture 1 dies
+    def dying_make_one_input_dir(i):
+        if i == 1:
+            os._exit(1)
+        return make_one_input_dir(i)
+
+    monkeypatch.setattr(input_output, '_make_one_input_dir',
+                        dying_make_one_input_dir)
+
+    p = os.path.join(str(tmpdir), 'sub')
+    os.makedirs(p)
+    old_shakehome = set_shakehome(p)
+    old_cache_dir = set_cache_dir(os.path.join(str(tmpdir), 'cache'))
+    try:
+        with pytest.raises(Exception) as e:
+            make_input_dirs(jsonfile, index=[0, 1, 2], nproc=2)
+        assert 'indices: 1)' in str(e.value)
+    finally:
+        set_shakehome(old_shakehome)
+        set_cache_dir(old_cache_dir)
+    assert input_output._pool_state is None
+
+    # The other ruptures are still written
+    assert sorted(os.listdir(os.path.join(p, 'data'))) == \
+        ['montereybaytularcito_m7p26_se', 'mountdiablothrustell_m6p67_se']
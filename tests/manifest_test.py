@@ -0,0 +1,91 @@
+# stdlib imports
+import os
+import sys
+import tempfile
+
+from scenarios.manifest import get_run_params
+from scenarios.manifest import make_manifest
+from scenarios.manifest import write_manifest
+from scenarios.manifest import read_manifest
+from scenarios.manifest import remove_manifest
+from scenarios.manifest import is_complete
+from scenarios.manifest import get_config_hash
+
+homedir = os.path.dirname(os.path.abspath(__file__))  # where is this script?
+shakedir = os.path.abspath(os.path.join(homedir, '..'))
+sys.path.insert(0, shakedir)
+
+
+def test_manifest(tmpdir):
+    input_dir = str(tmpdir)
+    config = {'data': {'vs30file': ''},
+              'modeling': {'gmpe': 'active_crustal_nshmp2014'}}
+    params = get_run_params(30 / 60 / 60, 500, 3.0)
+
+    for fname, text in [('event.xml', '<earthquake/>'),
+                        ('test_rupture.json', '{}'),
+                        ('pga_estimates.grd', 'grid')]:
+        with open(os.path.join(input_dir, fname), 'w') as f:
+            f.write(text)
+
+    assert is_complete(input_dir, config, params) is False
+    write_manifest(input_dir, make_manifest(
+        input_dir, config, params, ['pga_estimates.grd']))
+    manifest = read_manifest(input_dir)
+    assert sorted(manifest['inputs'].keys()) == \
+        ['event.xml', 'test_rupture.json']
+    assert is_complete(input_dir, config, params) is True
+
+    # Stale run parameters
+    assert is_complete(input_dir, config,
+                       get_run_params(30 / 60 / 60, 500, 0.5)) is False
+
+    # Stale config
+    config2 = {'data': {'vs30file': ''},
+               'modeling': {'gmpe': 'stable_continental_nshmp2014_rlme'}}
+    assert is_complete(input_dir, config2, params) is False
+
+    # Changed input
+    with open(os.path.join(input_dir, 'event.xml'), 'w') as f:
+        f.write('<earthquake mag="7.0"/>')
+    assert is_complete(input_dir, config, params) is False
+    write_manifest(input_dir, make_manifest(
+        input_dir, config, params, ['pga_estimates.grd']))
+    assert is_complete(input_dir, config, params) is True
+
+    # Missing output
+    os.remove(os.path.join(input_dir, 'pga_estimates.grd'))
+    assert is_complete(input_dir, config, params) is False
+
+    remove_manifest(input_dir)
+    assert read_manifest(input_dir) is None
+
+
+def test_config_hash_vs30store(tmpdir):
+    store_dir = str(tmpdir)
+    config = {'data': {'vs30file': '', 'vs30store': store_dir},
+              'modeling': {'gmpe': 'active_crustal_nshmp2014'}}
+    with open(os.path.join(store_dir, 'geodict.json'), 'w') as f:
+        f.write('{"levels": [1, 2]}')
+    for fname in ['vs30.npy', 'vs30_2.npy']:
+        with open(os.path.join(store_dir, fname), 'w') as f:
+            f.write('data')
+    hash1 = get_config_hash(config)
+    assert get_config_hash(config) == hash1
+
+    # Rebuilt level file
+    os.utime(os.path.join(store_dir, 'vs30_2.npy'), (0, 0))
+    hash2 = get_config_hash(config)
+    assert hash2 != hash1
+
+    # Changed geodict
+    with open(os.path.join(store_dir, 'geodict.json'), 'w') as f:
+        f.write('{"levels": [1]}')
+    assert get_config_hash(config) != hash2
+
+
+if __name__ == "__main__":
+    td1 = tempfile.TemporaryDirectory()
+    test_manifest(td1.name)
+    td2 = tempfile.TemporaryDirectory()
+    test_config_hash_vs30store(td2.name)
@@ -0,0 +1,194 @@
+# stdlib imports
+import os
+import sys
+import json
+import shutil
+import tempfile
+
+import numpy as np
+
+from scenarios.rupture_set import load_rupture_set
+from scenarios.rupture_set import RuptureSet
+from scenarios.rupture_set import CACHE_VERSION
+from scenarios.search import SearchIndex
+from scenarios.search import SpatialIndex
+
+homedir = os.path.dirname(os.path.abspath(__file__))  # where is this script?
+shakedir = os.path.abspath(os.path.join(homedir, '..'))
+sys.path.insert(0, shakedir)
+
+
+def test_rupture_set(tmpdir):
+    cache_dir = str(tmpdir)
+    for rfile in ['UCERF3_EventSet_All.json', 'bssc2014_sub.json']:
+        jsonfile = os.path.join(shakedir, 'rupture_sets', 'BSSC2014', rfile)
+        with open(jsonfile) as f:
+            rupts = json.load(f)
+
+        # First load writes the cache, second load reads it
+        for i in range(2):
+            rset = load_rupture_set(jsonfile, cache_dir=cache_dir)
+            assert isinstance(rset, RuptureSet)
+            assert rset['format'] == rupts['format']
+            assert rset['name'] == rupts['name']
+            assert len(rset['events']) == len(rupts['events'])
+            assert rset['events'][-1] == rupts['events'][-1]
+            assert list(rset['events']) == rupts['events']
+        assert len(os.listdir(cache_dir)) == 1 + (rfile == 'bssc2014_sub.json')
+
+    # Coordinates, names, and magnitudes of the UCERF3 events
+    jsonfile = os.path.join(
+        shakedir, 'rupture_sets/BSSC2014/UCERF3_EventSet_All.json')
+    with open(jsonfile) as f:
+        rupts = json.load(f)
+    rset = load_rupture_set(jsonfile, cache_dir=cache_dir)
+    event = rupts['events'][269]
+    target = np.concatenate([np.array(s['resampledTrace'])
+                             for s in event['sections']])
+    np.testing.assert_allclose(rset.get_coords(269), target)
+    assert rset.names[269] == event['name']
+    assert rset.mags[269] == event['magnitude']
+
+
+def test_rupture_set_cache_prune(tmpdir):
+    cache_dir = os.path.join(str(tmpdir), 'cache')
+    jsonfile = os.path.join(str(tmpdir), 'test.json')
+    shutil.copy(os.path.join(
+        shakedir, 'rupture_sets/BSSC2014/bssc2014_sub.json'), jsonfile)
+    other = os.path.join(
+        shakedir, 'rupture_sets/Montana-2016/US_MT_2016.json')
+
+    # A cache of another layout version and the cache of another file
+    os.makedirs(os.path.join(cache_dir, 'old.v%i' % (CACHE_VERSION - 1)))
+    load_rupture_set(other, cache_dir=cache_dir)
+    rset = load_rupture_set(jsonfile, cache_dir=cache_dir)
+    names = sorted(os.listdir(cache_dir))
+    assert len(names) == 2
+    assert os.path.basename(rset.cache_path) in names
+
+    # Changing the file replaces its cache and keeps the other file's
+    with open(jsonfile) as f:
+        rupts = json.load(f)
+    rupts['name'] = 'changed'
+    with open(jsonfile, 'w') as f:
+        json.dump(rupts, f)
+    rset2 = load_rupture_set(jsonfile, cache_dir=cache_dir)
+    assert rset2['name'] == 'changed'
+    assert rset2.cache_path != rset.cache_path
+    assert not os.path.exists(rset.cache_path)
+    assert len(os.listdir(cache_dir)) == 2
+
+
+def test_rupture_set_cache_fallback(tmpdir):
+    jsonfile = os.path.join(
+        shakedir, 'rupture_sets/BSSC2014/bssc2014_sub.json')
+    with open(jsonfile) as f:
+        rupts = json.load(f)
+
+    # The cache directory cannot be created
+    not_a_dir = os.path.join(str(tmpdir), 'file')
+    with open(not_a_dir, 'w') as f:
+        f.write('')
+    assert load_rupture_set(jsonfile, cache_dir=not_a_dir) == rupts
+
+    # The cache is broken
+    cache_dir = os.path.join(str(tmpdir), 'cache')
+    rset = load_rupture_set(jsonfile, cache_dir=cache_dir)
+    os.remove(os.path.join(rset.cache_path, 'coords.npy'))
+    assert load_rupture_set(jsonfile, cache_dir=cache_dir) == rupts
+
+
+def test_search_index(tmpdir):
+    jsonfile = os.path.join(
+        shakedir, 'rupture_sets/BSSC2014/bssc2014_wus.json')
+    with open(jsonfile) as f:
+        rupts = json.load(f)
+    desc = [e['desc'] for e in rupts['events']]
+    mags = np.array([e['mag'] for e in rupts['events']])
+
+    rset = load_rupture_set(jsonfile, cache_dir=str(tmpdir))
+    index = SearchIndex.fromRuptureSet(rset)
+    assert os.path.isfile(os.path.join(rset.cache_path, 'search_index.json'))
+
+    # Substring
+    for pattern in ['Grand Valley', 'fault', 'zzz', '']:
+        target = [i for i, d in enumerate(desc) if pattern in d]
+        np.testing.assert_array_equal(index.search(pattern), target)
+
+    # Tokens, regex, and magnitude range
+    target = [i for i, d in enumerate(desc)
+              if 'grand' in d.lower() and 'valley' in d.lower()]
+    np.testing.assert_array_equal(index.search(tokens='valley GRAND'),
+                                  target)
+    target = [i for i, d in enumerate(desc) if d.startswith('Wasatch')]
+    np.testing.assert_array_equal(index.search(regex='^Wasatch'), target)
+    target = np.where((mags >= 7.0) & (mags <= 7.2))[0]
+    np.testing.assert_array_equal(index.search(mag_min=7.0, mag_max=7.2),
+                                  target)
+    target = [i for i in target if 'fault' in desc[i]]
+    np.testing.assert_array_equal(
+        index.search('fault', mag_min=7.0, mag_max=7.2), target)
+
+    # Same results from the plain dictionary
+    index2 = SearchIndex.fromRuptureSet(rupts)
+    assert index2.tokens == index.tokens
+    np.testing.assert_array_equal(index2.search('Valley'),
+                                  index.search('Valley'))
+
+
+def test_spatial_index(tmpdir):
+    jsonfile = os.path.join(
+        shakedir, 'rupture_sets/BSSC2014/bssc2014_wus.json')
+    with open(jsonfile) as f:
+        rupts = json.load(f)
+    rset = load_rupture_set(jsonfile, cache_dir=str(tmpdir))
+
+    # Salt Lake City
+    lon, lat = -111.89, 40.76
+    ind, dist = SpatialIndex(rset).find_near(lon, lat, 50.0)
+    assert len(ind) > 0
+    assert np.all(dist <= 50.0)
+
+    # Same results from the plain dictionary
+    ind2, dist2 = SpatialIndex(rupts).find_near(lon, lat, 50.0)
+    np.testing.assert_array_equal(ind2, ind)
+    np.testing.assert_allclose(dist2, dist)
+
+    # Every rupture with a trace vertex within the distance is found, and
+    # the distance to the trace is not larger than to its closest vertex
+    for i in range(len(rset)):
+        c = rset.get_coords(i)
+        lon1, lat1, lon2, lat2 = map(np.radians, (lon, lat, c[:, 0], c[:, 1]))
+        a = np.sin((lat2 - lat1) / 2)**2 + \
+            np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2)**2
+        dmin = np.min(2 * 6371.0 * np.arcsin(np.sqrt(a)))
+        if dmin <= 49.0:
+            assert i in ind
+            assert dist[list(ind).index(i)] <= dmin + 0.5
+
+
+def test_spatial_index_antimeridian():
+    # Polygon just west of the antimeridian
+    coords = [[[[179.8, 0.0, 0.0], [179.9, 0.0, 0.0], [179.9, 0.1, 0.0],
+                [179.8, 0.1, 0.0], [179.8, 0.0, 0.0]]]]
+    rupts = {'format': 'shakemap',
+             'events': [{'features': [{'geometry': {
+                 'type': 'MultiPolygon', 'coordinates': coords}}]}]}
+
+    # Point just east of it
+    ind, dist = SpatialIndex(rupts).find_near(-179.9, 0.05, 50.0)
+    np.testing.assert_array_equal(ind, [0])
+    np.testing.assert_allclose(dist, 0.2 * 111.195, rtol=0.01)
+
+    ind, dist = SpatialIndex(rupts).find_near(-179.9, 0.05, 20.0)
+    assert len(ind) == 0
+
+
+if __name__ == "__main__":
+    td1 = tempfile.TemporaryDirectory()
+    test_rupture_set(td1.name)
+    td2 = tempfile.TemporaryDirectory()
+    test_search_index(td2.name)
+    td3 = tempfile.TemporaryDirectory()
+    test_spatial_index(td3.name)
+    test_spatial_index_antimeridian()
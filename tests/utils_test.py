@@ -6,11 +6,28 @@ import json
 import numpy as np
 
 from shakelib.rupture.origin import Origin
+from shakelib.rupture.quad_rupture import QuadRupture
 
 from scenarios.utils import find_rupture
 from scenarios.utils import get_extent
+from scenarios.utils import get_extents
 from scenarios.utils import get_event_id
+from scenarios.utils import get_trace_corners
+from scenarios.utils import fix_quads
+from scenarios.utils import get_hypo
+from scenarios.utils import get_hypos
+from scenarios.utils import get_hypo_position
+from scenarios.utils import get_rupture_edges
+from scenarios.utils import is_stable
 from scenarios.input_output import parse_bssc2014_ucerf
+from scenarios.input_output import iter_bssc2014_ucerf
+from scenarios.input_output import parse_ruptures
+from scenarios.input_output import get_source_hash
+from scenarios.input_output import write_input_dir
+from scenarios.input_output import SOURCE_HASH_FILE
+import scenarios.input_output as input_output
+from scenarios.rupture_set import load_rupture_set
+from scenarios.rupture_set import RuptureSet
 
 homedir = os.path.dirname(os.path.abspath(__file__))  # where is this script?
 shakedir = os.path.abspath(os.path.join(homedir, '..'))
@@ -36,6 +53,43 @@ def test_get_extent_no_rup():
                   [  36.19336348],
                   [  37.99597076]]))
 
+
+def test_get_extents():
+    jsonfile = os.path.join(
+        shakedir, 'rupture_sets/BSSC2014/UCERF3_EventSet_All.json')
+    with open(jsonfile) as f:
+        rupts = json.load(f)
+
+    args = type('', (), {})()
+    args.index = [2, 150, 269]
+    args.reference = ''
+    args.directivity = False
+    args.dirind = -1
+    ruptures = [rdict['rupture']
+                for rdict in parse_bssc2014_ucerf(rupts, args)]
+    origins = [r._origin for r in ruptures]
+    coords = [np.column_stack([r.lons, r.lats]) for r in ruptures]
+
+    # Events without ruptures, in the active and stable regions
+    for lat, lon, mag in [(37.1, -122.1, 8.5), (37.1, -122.1, 6.0),
+                          (35.15, -90.05, 7.7), (39.74, -104.99, 5.5)]:
+        origins.append(Origin({'id': 'test', 'lat': lat, 'lon': lon,
+                               'depth': 5.0, 'mag': mag}))
+        ruptures.append(None)
+        coords.append(None)
+
+    extents = get_extents([o.lon for o in origins], [o.lat for o in origins],
+                          [o.mag for o in origins], coords)
+    extents = np.array(extents)
+    assert extents.shape == (4, len(origins))
+    for i in range(len(origins)):
+        target = np.array(get_extent(origins[i], ruptures[i])).ravel()
+        np.testing.assert_allclose(extents[:, i], target)
+    np.testing.assert_allclose(extents[:, 3],
+                               [-126.5981497, -117.13214326,
+                                33.23305437, 40.77859864])
+
+
 def test_get_hypo_and_event_id():
     jsonfile = os.path.join(
         shakedir, 'rupture_sets/BSSC2014/UCERF3_EventSet_All.json')
@@ -87,9 +141,260 @@ def test_get_hypo_and_event_id():
     assert real_desc == 'Eastern directivity'
 
 
+def test_get_hypos():
+    jsonfile = os.path.join(
+        shakedir, 'rupture_sets/BSSC2014/UCERF3_EventSet_All.json')
+    with open(jsonfile) as f:
+        rupts = json.load(f)
+
+    args = type('', (), {})()
+    args.index = [2, 269]
+    args.reference = ''
+    args.directivity = True
+    args.dirind = 0
+    rlist = parse_bssc2014_ucerf(rupts, args)
+    edges = [rdict['edges'] for rdict in rlist]
+
+    # All ruptures and directivity positions at once
+    dirinds = [-1, 0, 1, 2]
+    pos = np.array([get_hypo_position(d) for d in dirinds])
+    hlat, hlon, hdepth = get_hypos(edges, pos[:, 0], pos[:, 1])
+    assert hlat.shape == (2, 4)
+    np.testing.assert_allclose(hlat[0, 1], 36.376584141401686)
+    np.testing.assert_allclose(hlon[0, 1], -121.54438439782552)
+    np.testing.assert_allclose(hdepth[0, 1], 8.96001742487494)
+    for i in range(len(edges)):
+        for j, dirind in enumerate(dirinds):
+            args.dirind = dirind
+            target = get_hypo(edges[i], args)
+            np.testing.assert_allclose(
+                [hlat[i, j], hlon[i, j], hdepth[i, j]], target)
+
+
+def test_get_rupture_edges():
+    jsonfile = os.path.join(
+        shakedir, 'rupture_sets/BSSC2014/UCERF3_EventSet_All.json')
+    with open(jsonfile) as f:
+        rupts = json.load(f)
+
+    args = type('', (), {})()
+    args.index = [269]
+    args.reference = ''
+    args.directivity = False
+    args.dirind = -1
+    rup = parse_bssc2014_ucerf(rupts, args)[0]
+    quads = rup['rupture'].getQuadrilaterals()
+    nq = len(quads)
+
+    rev = np.zeros(nq, dtype=bool)
+    rev[::2] = True
+    top, bot = get_rupture_edges(quads, rev)
+    assert top.shape == (2 * nq, 3)
+    assert bot.shape == (2 * nq, 3)
+    np.testing.assert_allclose(top[0], [quads[0][1].longitude,
+                                        quads[0][1].latitude,
+                                        quads[0][1].depth])
+    np.testing.assert_allclose(bot[3], [quads[1][2].longitude,
+                                        quads[1][2].latitude,
+                                        quads[1][2].depth])
+
+    topp, botp = get_rupture_edges(quads, rev, as_points=True)
+    np.testing.assert_allclose(
+        [[p.longitude, p.latitude, p.depth] for p in topp], top)
+    np.testing.assert_allclose(
+        [[p.longitude, p.latitude, p.depth] for p in botp], bot)
+
+
+def test_iter_ruptures():
+    jsonfile = os.path.join(
+        shakedir, 'rupture_sets/BSSC2014/UCERF3_EventSet_All.json')
+    with open(jsonfile) as f:
+        rupts = json.load(f)
+
+    args = type('', (), {})()
+    args.index = [2, 269]
+    args.reference = ''
+    args.directivity = True
+    args.dirind = 0
+
+    rlist = parse_bssc2014_ucerf(rupts, args)
+    rgen = iter_bssc2014_ucerf(rupts, args)
+    for rdict in rlist:
+        rdict2 = next(rgen)
+        assert rdict2['id_str'] == rdict['id_str']
+        assert rdict2['source_hash'] == rdict['source_hash']
+        np.testing.assert_allclose(rdict2['event']['lat'],
+                                   rdict['event']['lat'])
+    assert next(rgen, None) is None
+
+
+def test_get_source_hash(monkeypatch):
+    event = {'name': 'test', 'magnitude': 7.0, 'rake': 180.0,
+             'sections': [{'dip': 90.0, 'width': 12.0}]}
+    args = type('', (), {})()
+    args.reference = ''
+    args.dirind = 0
+
+    h1 = get_source_hash(event, 'UCERF', args)
+    assert h1 == get_source_hash(dict(event), 'ucerf', args)
+
+    # Different rupture definition
+    event2 = dict(event)
+    event2['magnitude'] = 7.1
+    assert get_source_hash(event2, 'ucerf', args) != h1
+
+    # Different reference and directivity
+    args.reference = 'Test reference'
+    h2 = get_source_hash(event, 'ucerf', args)
+    assert h2 != h1
+    args.dirind = 2
+    h3 = get_source_hash(event, 'ucerf', args)
+    assert h3 != h2
+
+    # Different version of the parsers
+    monkeypatch.setattr(input_output, 'PARSER_VERSION',
+                        input_output.PARSER_VERSION + 1)
+    assert get_source_hash(event, 'ucerf', args) != h3
+
+
+def test_iter_ruptures_incremental(tmpdir, monkeypatch):
+    jsonfile = os.path.join(
+        shakedir, 'rupture_sets/BSSC2014/UCERF3_EventSet_All.json')
+    with open(jsonfile) as f:
+        rupts = json.load(f)
+
+    datdir = str(tmpdir)
+    args = type('', (), {})()
+    args.index = [2]
+    args.reference = ''
+    args.directivity = True
+    args.dirind = 0
+    args.incremental = True
+    args.datdir = datdir
+
+    rdict = parse_ruptures(rupts, args)[0]
+    assert 'unchanged' not in rdict
+    input_dir = os.path.join(datdir, rdict['id_str'], 'input')
+    os.makedirs(input_dir)
+    with open(os.path.join(input_dir, SOURCE_HASH_FILE), 'w') as f:
+        f.write(rdict['source_hash'] + '\n')
+
+    # The unchanged event is skipped before its rupture is built
+    def fail(*args, **kwargs):
+        raise AssertionError('The rupture of an unchanged event was built.')
+
+    monkeypatch.setattr(input_output, 'get_trace_corners', fail)
+    rdict2 = parse_ruptures(rupts, args)[0]
+    assert rdict2 == {'id_str': rdict['id_str'],
+                      'source_hash': rdict['source_hash'],
+                      'unchanged': True}
+    assert write_input_dir(datdir, rdict2, args.directivity) is False
+
+
+def test_get_trace_corners():
+    xp0 = np.array([-121.0, -120.8])
+    xp1 = np.array([-120.8, -120.6])
+    yp0 = np.array([37.0, 37.1])
+    yp1 = np.array([37.1, 37.3])
+    zp = np.array([0.0, 2.0])
+    widths = np.array([15.0, 12.0])
+    dips = np.array([80.0, 45.0])
+    origin = Origin({'mag': 0, 'id': '', 'lat': 0, 'lon': 0, 'depth': 0})
+
+    # The strike of the second quad is opposite to its trace, so that
+    # QuadRupture reverses it
+    for strike in [None, np.array([30.0]), np.array([30.0, 210.0])]:
+        target = QuadRupture.fromTrace(xp0, yp0, xp1, yp1, zp, widths, dips,
+                                       origin, strike=strike,
+                                       group_index=[0, 1], reference='test')
+        corners = get_trace_corners(xp0, yp0, xp1, yp1, zp, widths, dips,
+                                    strike=strike)
+        rupt = QuadRupture.fromVertices(
+            corners[:, 0, 0], corners[:, 0, 1], corners[:, 0, 2],
+            corners[:, 1, 0], corners[:, 1, 1], corners[:, 1, 2],
+            corners[:, 2, 0], corners[:, 2, 1], corners[:, 2, 2],
+            corners[:, 3, 0], corners[:, 3, 1], corners[:, 3, 2],
+            origin, group_index=[0, 1], reference='test')
+        np.testing.assert_allclose(
+            rupt._geojson['features'][0]['geometry']['coordinates'],
+            target._geojson['features'][0]['geometry']['coordinates'],
+            rtol=0, atol=1e-10)
+
+        tquads = np.array([[[p.longitude, p.latitude, p.depth] for p in q]
+                           for q in target.getQuadrilaterals()])
+        np.testing.assert_allclose(fix_quads(corners), tquads,
+                                   rtol=0, atol=1e-8)
+
+
+def test_build_ruptures_once(monkeypatch):
+    ninit = []
+    init = QuadRupture.__init__
+
+    def counting_init(self, *args, **kwargs):
+        ninit.append(1)
+        init(self, *args, **kwargs)
+
+    monkeypatch.setattr(QuadRupture, '__init__', counting_init)
+
+    args = type('', (), {})()
+    args.index = [2, 269]
+    args.reference = ''
+    args.directivity = True
+    args.dirind = 0
+    for rfile in ['UCERF3_EventSet_All.json', 'bssc2014_wus.json']:
+        jsonfile = os.path.join(shakedir, 'rupture_sets/BSSC2014', rfile)
+        with open(jsonfile) as f:
+            rupts = json.load(f)
+        del ninit[:]
+        rlist = parse_ruptures(rupts, args)
+        assert len(ninit) == len(rlist) == 2
+        for rdict in rlist:
+            assert rdict['rupture']._origin.lat == rdict['event']['lat']
+            assert rdict['rupture']._origin.lon == rdict['event']['lon']
+
+
+def test_parse_rupture_set(tmpdir):
+    args = type('', (), {})()
+    args.index = [0]
+    args.reference = ''
+    args.directivity = True
+    args.dirind = 0
+    for rfile in ['UCERF3_EventSet_All.json', 'bssc2014_wus.json',
+                  'bssc2014_sub.json']:
+        jsonfile = os.path.join(shakedir, 'rupture_sets/BSSC2014', rfile)
+        with open(jsonfile) as f:
+            rupts = json.load(f)
+        rset = load_rupture_set(jsonfile, cache_dir=str(tmpdir))
+        assert isinstance(rset, RuptureSet)
+
+        # Same ruptures from the compiled rupture set as from the json
+        rdict = parse_ruptures(rupts, args)[0]
+        rdict2 = parse_ruptures(rset, args)[0]
+        for key in ['id_str', 'real_desc', 'source_hash']:
+            assert rdict2[key] == rdict[key]
+        for key in ['lat', 'lon', 'depth']:
+            assert rdict2['event'][key] == rdict['event'][key]
+        np.testing.assert_array_equal(
+            rdict2['rupture'].lats, rdict['rupture'].lats)
+        np.testing.assert_array_equal(
+            rdict2['rupture'].lons, rdict['rupture'].lons)
+
 
 def test_find_rupture():
     rfile = os.path.join('rupture_sets', 'BSSC2014', 'bssc2014_wus.json')
     ind, result = find_rupture('Grand Valley', rfile)
     assert ind == np.array([250])
     assert result == np.array(['Grand Valley fault'])
+
+
+def test_is_stable():
+    # Denver, Salt Lake City, Memphis, Los Angeles
+    lons = np.array([-104.99, -111.89, -90.05, -118.24])
+    lats = np.array([39.74, 40.76, 35.15, 34.05])
+    target = np.array([True, False, True, False])
+    for lon, lat, t in zip(lons, lats, target):
+        assert is_stable(lon, lat) is bool(t)
+    np.testing.assert_array_equal(is_stable(lons, lats), target)
+    np.testing.assert_array_equal(
+        is_stable(lons.reshape(2, 2), lats.reshape(2, 2)),
+        target.reshape(2, 2))
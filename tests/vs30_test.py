@@ -0,0 +1,116 @@
+# stdlib imports
+import os
+import sys
+import tempfile
+
+import numpy as np
+
+from mapio.geodict import GeoDict
+from mapio.gmt import GMTGrid
+
+from scenarios.vs30 import get_geodict_values
+from scenarios.vs30 import get_window_geodict
+from scenarios.vs30 import write_vs30_store
+from scenarios.vs30 import open_vs30_store
+from scenarios.vs30 import read_vs30_store
+from scenarios.vs30 import select_level
+from scenarios.vs30 import block_mean
+from scenarios.vs30 import load_shared_vs30
+from scenarios.vs30 import release_shared_vs30
+from scenarios.vs30 import load_vs30_grid
+
+homedir = os.path.dirname(os.path.abspath(__file__))  # where is this script?
+shakedir = os.path.abspath(os.path.join(homedir, '..'))
+sys.path.insert(0, shakedir)
+
+
+def test_vs30_store(tmpdir):
+    vs30file = os.path.join(homedir, 'data', 'NCalVs30.grd')
+    store_dir = os.path.join(str(tmpdir), 'vs30store')
+    write_vs30_store(vs30file, store_dir, band_rows=100)
+
+    full = GMTGrid.load(vs30file)
+    levels = open_vs30_store(store_dir)
+    assert len(levels) == 4
+    gdict, data = levels[0]
+    assert gdict['nx'] == full.getGeoDict().nx
+    assert gdict['ny'] == full.getGeoDict().ny
+    np.testing.assert_array_equal(data, full.getData())
+
+    # An aligned grid is a view of the store
+    rows = slice(10, 50)
+    cols = slice(20, 80)
+    sampledict = get_window_geodict(
+        get_geodict_values(full.getGeoDict()), rows, cols)
+    grid = read_vs30_store(store_dir, sampledict)
+    assert grid.getData().base is not None
+    np.testing.assert_array_equal(grid.getData(), full.getData()[rows, cols])
+
+    # Other grids are interpolated like GMTGrid.load
+    fdict = full.getGeoDict()
+    xmin = fdict.xmin + 10.3 * fdict.dx
+    ymax = fdict.ymax - 12.6 * fdict.dy
+    dx = 1.7 * fdict.dx
+    dy = 1.7 * fdict.dy
+    sampledict = GeoDict({'xmin': xmin, 'xmax': xmin + 19 * dx,
+                          'ymin': ymax - 14 * dy, 'ymax': ymax,
+                          'dx': dx, 'dy': dy, 'nx': 20, 'ny': 15})
+    target = GMTGrid.load(vs30file, sampledict, resample=True)
+    grid = read_vs30_store(store_dir, sampledict)
+    np.testing.assert_allclose(grid.getData(), target.getData())
+
+    # Downsampled levels
+    gdict4, data4 = levels[2]
+    assert gdict4['dx'] == 4 * gdict['dx']
+    np.testing.assert_allclose(
+        data4, block_mean(full.getData(), 4).astype(data4.dtype))
+    np.testing.assert_allclose(data4[0, 0], np.nanmean(data[:4, :4]),
+                               rtol=1e-6)
+
+    # A coarser grid uses the nearest level that is at least as fine
+    dx = 5 * fdict.dx
+    sampledict = GeoDict({'xmin': xmin, 'xmax': xmin + 19 * dx,
+                          'ymin': ymax - 14 * dx, 'ymax': ymax,
+                          'dx': dx, 'dy': dx, 'nx': 20, 'ny': 15})
+    assert select_level(levels, sampledict)[0]['dx'] == gdict4['dx']
+    sampledict = get_window_geodict(gdict4, slice(2, 12), slice(3, 20))
+    grid = read_vs30_store(store_dir, sampledict)
+    assert grid.getData().base is not None
+    np.testing.assert_array_equal(grid.getData(), data4[2:12, 3:20])
+
+
+def test_shared_vs30():
+    vs30file = os.path.join(homedir, 'data', 'NCalVs30.grd')
+    config = {'data': {'vs30file': vs30file, 'vs30store': ''}}
+    full = GMTGrid.load(vs30file)
+    gdict = get_geodict_values(full.getGeoDict())
+
+    windows = [(slice(10, 50), slice(20, 80)), (slice(30, 90), slice(5, 40))]
+    sampledicts = [get_window_geodict(gdict, rows, cols)
+                   for rows, cols in windows]
+    assert load_shared_vs30(config, sampledicts) is True
+    try:
+        for (rows, cols), sampledict in zip(windows, sampledicts):
+            grid = load_vs30_grid(config, sampledict)
+            assert grid.getData().base is not None
+            assert grid.getData().flags.writeable is False
+            np.testing.assert_array_equal(grid.getData(),
+                                          full.getData()[rows, cols])
+
+        # A grid outside of the shared window is read from the file
+        sampledict = get_window_geodict(gdict, slice(100, 120),
+                                        slice(100, 130))
+        grid = load_vs30_grid(config, sampledict)
+        np.testing.assert_array_equal(grid.getData(),
+                                      full.getData()[100:120, 100:130])
+    finally:
+        release_shared_vs30()
+
+    # Too large
+    assert load_shared_vs30(config, sampledicts, max_cells=100) is False
+
+
+if __name__ == "__main__":
+    td1 = tempfile.TemporaryDirectory()
+    test_vs30_store(td1.name)
+    test_shared_vs30()